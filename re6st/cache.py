@@ -1,4 +1,5 @@
 import base64, json, logging, os, sqlite3, socket, subprocess, sys, time, zlib
+from collections.abc import Iterator
 from itertools import chain
 from .registry import RegistryClient
 from . import utils, version, x509
@@ -81,6 +82,8 @@ class Cache:
                 v = json.loads(v)
                 if k == 'crl':
                     v = set(v)
+            elif k == 'registry_prefix':
+                v = utils.Prefix.fromBin(v)
             if hasattr(cls, k):
                 continue
             setattr(self, k, v)
@@ -183,14 +186,14 @@ class Cache:
             q("DELETE FROM peer WHERE prefix IN (?)", a)
             q("DELETE FROM volatile.stat WHERE peer IN (?)", a)
 
-    def connecting(self, prefix: str, connecting: bool):
+    def connecting(self, prefix: utils.Prefix, connecting: bool):
         self._db.execute("UPDATE volatile.stat SET try=? WHERE peer=?",
                          (connecting, prefix))
 
     def resetConnecting(self):
         self._db.execute("UPDATE volatile.stat SET try=0")
 
-    def getAddress(self, prefix: str) -> bool:
+    def getAddress(self, prefix: utils.Prefix) -> bool:
         r = self._db.execute("SELECT address FROM peer, volatile.stat"
                              " WHERE prefix=? AND prefix=peer AND try=0",
                              (prefix,)).fetchone()
@@ -221,20 +224,23 @@ class Cache:
     _get_peer_sql = "SELECT %s FROM peer, volatile.stat" \
                     " WHERE prefix=peer AND prefix!=? AND try=?"
     def getPeerList(self, failed=False, __sql=_get_peer_sql % "prefix, address"
-                                                        + " ORDER BY RANDOM()"):
-        return self._db.execute(__sql, (self._prefix, failed))
+                                                        + " ORDER BY RANDOM()"
+                    ) -> Iterator[tuple[utils.Prefix, str]]:
+        for prefix, address in self._db.execute(__sql, (self._prefix, failed)):
+            yield utils.Prefix.fromBin(prefix), address
 
     def getPeerCount(self, failed=False, __sql=_get_peer_sql % "COUNT(*)") \
             -> int:
         return self._db.execute(__sql, (self._prefix, failed)).next()[0]
 
-    def getBootstrapPeer(self) -> tuple[str, str]:
+    def getBootstrapPeer(self) -> tuple[utils.Prefix, str]:
         logging.info('Getting Boot peer...')
         try:
             bootpeer = self._registry.getBootstrapPeer(self._prefix)
             if bootpeer is None:
                 return
             prefix, address = self._decrypt(bootpeer).decode().split()
+            prefix = utils.Prefix.fromBin(prefix)
         except (subprocess.CalledProcessError, ValueError) as e:
             logging.warning('Failed to bootstrap (%s)',
                             e if bootpeer else 'no peer returned')
@@ -244,7 +250,7 @@ class Cache:
                 return prefix, address
             logging.warning('Buggy registry sent us our own address')
 
-    def addPeer(self, prefix: str, address: str, set_preferred=False):
+    def addPeer(self, prefix: utils.Prefix, address: str, set_preferred=False):
         logging.debug('Adding peer %s: %s', prefix, address)
         with self._db:
             q = self._db.execute
@@ -77,11 +77,11 @@ def main():
     network = x509.networkFromCa(ca)
     if config.is_needed:
         with subprocess.Popen(('ip', '-6', '-o', 'route', 'get',
-                               utils.ipFromBin(network)),
+                               network.ip()),
                               stdout=subprocess.PIPE) as proc:
             route, err = proc.communicate()
         sys.exit(err or route and
-            utils.binFromIp(route.split()[8]).startswith(network))
+            utils.Prefix.fromIp(route.split()[8].decode()).startswith(network))
 
     create(ca_path, crypto.dump_certificate(crypto.FILETYPE_PEM, ca))
     if config.ca_only:
@@ -194,9 +194,8 @@ key %s
         print("Sample configuration file created.")
 
     cn = x509.subnetFromCert(cert)
-    subnet = network + utils.binFromSubnet(cn)
-    print("Your subnet: %s/%u (CN=%s)"
-        % (utils.ipFromBin(subnet), len(subnet), cn))
+    subnet = network + utils.Prefix.fromSubnet(cn)
+    print("Your subnet: %s/%u (CN=%s)" % (subnet.ip(), len(subnet), cn))
 
 if __name__ == "__main__":
     main()
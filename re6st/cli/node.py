@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 import atexit, errno, logging, os, shutil, signal
-import socket, struct, subprocess, sys
+import socket, struct, subprocess, sys, time
 from collections import deque
 from functools import partial
 if 're6st' not in sys.modules:
     sys.path[0] = os.path.dirname(os.path.dirname(sys.path[0]))
-from re6st import plib, tunnel, utils, version, x509
+from re6st import plib, routing, rtnetlink, tunnel, utils, version, x509
 from re6st.cache import Cache
 from re6st.utils import exit, ReexecException
 
@@ -34,7 +34,9 @@ def getConfig():
              "- <iface>.log: 1 file per spawned OpenVPN\n")
     _('-r', '--run', default='/var/run/re6stnet',
         help="Path to re6stnet runtime directory:\n"
-             "- babeld.sock (option -R of babeld)\n")
+             "- babeld.sock (option -R of babeld)\n"
+             "- babeld.sock.local (option local-path of babeld)\n"
+             "- <iface>.management: 1 management socket per OpenVPN server\n")
     _('-s', '--state', default='/var/lib/re6stnet',
         help="Path to re6stnet state directory:\n"
              "- cache.db: cache of network parameters and peer addresses\n"
@@ -54,9 +56,10 @@ def getConfig():
     _('--up', metavar='CMD',
         help="Shell command to run after successful initialization.")
     _('--daemon', action='append', metavar='CMD',
-        help="Same as --up, but run in background: the command will be killed"
-             " at exit (with a TERM signal, followed by KILL 5 seconds later"
-             " if process is still alive).")
+        help="Same as --up, but run in background: the command is restarted"
+             " if it fails (non-zero exit status or signal), and it will be"
+             " killed at exit (with a TERM signal, followed by KILL 5 seconds"
+             " later if process is still alive).")
     _('--test', metavar='EXPR',
         help="Exit after configuration parsing. Status code is the"
              " result of the given Python expression. For example:\n"
@@ -104,6 +107,10 @@ def getConfig():
     _('--client-count', type=int,
         help="Number of client tunnels to set up."
              " (default: value from registry)")
+    _('--iface-pool', type=int, default=0, metavar='COUNT',
+        help="Number of client tunnel interfaces to create at startup,"
+             " instead of when tunnels are made. Hits and misses of this"
+             " pool are logged at debug level, to help choosing a size.")
     _('--max-clients', type=int,
         help="Maximum number of accepted clients per OpenVPN server."
              " (default: value from registry)")
@@ -122,6 +129,11 @@ def getConfig():
     _('--neighbour', metavar='CN', action='append', default=[],
         help="List of peers that should be reachable directly, by creating"
              " tunnels if necesssary.")
+    _('--tunnel-score', choices=tunnel.tunnel_score_dict, default='routes',
+        help="Policy to choose which tunnels to remove and which ones to"
+             " make: 'routes' only considers the number of routes carried"
+             " by tunnels, whereas 'latency' also uses RTTs and route"
+             " metrics measured by babeld.")
 
     return parser.parse_args()
 
@@ -150,22 +162,29 @@ def main():
     cache = Cache(db_path, config.registry, cert)
     network = cert.network
 
-    if config.client_count is None:
-        config.client_count = cache.client_count
-    if config.max_clients is None:
-        config.max_clients = cache.max_clients
+    # Network parameters that can be overridden at command line.
+    overridden = []
+    for k in 'client_count', 'max_clients':
+        if getattr(config, k) is None:
+            setattr(config, k, getattr(cache, k))
+        else:
+            overridden.append(k)
 
     if config.disable_proto is None:
         config.disable_proto = DEFAULT_DISABLED_PROTO
     elif 'none' in config.disable_proto:
         config.disable_proto = ()
 
-    x = ['ip', '-6', 'route', 'add', 'unreachable', '::/128', 'from', '::/128']
-    has_ipv6_subtrees = not subprocess.call(x)
-    if has_ipv6_subtrees:
-        x[3] = 'del'
-        subprocess.check_call(x)
+    netlink = rtnetlink.Netlink()
+    x = '::/128', 'unreachable'
+    try:
+        netlink.route('add', *x, src='::/128')
+    except OSError:
+        has_ipv6_subtrees = False
     else:
+        has_ipv6_subtrees = True
+        netlink.route('del', *x, src='::/128')
+    if not has_ipv6_subtrees:
         logging.warning(
             "Source address based routing is not enabled in your kernel"
             " (CONFIG_IPV6_SUBTREES). %s",
@@ -184,6 +203,8 @@ def main():
     address = []
     server_tunnels = {}
     forwarder = None
+    reactor = utils.Reactor()
+    supervisor = utils.Supervisor(reactor)
     if config.client:
         add_tunnels(('re6stnet',))
     elif config.max_clients:
@@ -244,7 +265,7 @@ def main():
             logging.info('Attempting automatic configuration via UPnP...')
             try:
                 from re6st.upnpigd import Forwarder
-                forwarder = Forwarder('re6stnet openvpn server')
+                forwarder = Forwarder(reactor, 're6stnet openvpn server')
             except Exception as e:
                 if ipv4:
                     raise
@@ -266,11 +287,12 @@ def main():
     def call(cmd):
         logging.debug('%r', cmd)
         return subprocess.run(cmd, capture_output=True, check=True).stdout
-    def ip4(object: str, *args):
-        args = ['ip', '-4', object, 'add'] + list(args)
-        call(args)
-        args[3] = 'del'
-        cleanup.append(lambda: subprocess.call(args))
+    def route(*args, **kw):
+        netlink.route('add', *args, **kw)
+        cleanup.append(lambda: netlink.route('del', *args, **kw))
+    def address(*args):
+        netlink.address('add', *args)
+        cleanup.append(lambda: netlink.address('del', *args))
     def ip(object: str, *args):
         args = ['ip', '-6', object, 'add'] + list(args)
         call(args)
@@ -279,9 +301,9 @@ def main():
 
     try:
         subnet = network + cert.prefix
-        my_ip = utils.ipFromBin(subnet, '1')
-        my_subnet = '%s/%u' % (utils.ipFromBin(subnet), len(subnet))
-        my_network = "%s/%u" % (utils.ipFromBin(network), len(network))
+        my_ip = subnet.ip(1)
+        my_subnet = '%s/%u' % (subnet.ip(), len(subnet))
+        my_network = "%s/%u" % (network.ip(), len(network))
         os.environ['re6stnet_ip'] = my_ip
         os.environ['re6stnet_iface'] = config.main_interface
         os.environ['re6stnet_subnet'] = my_subnet
@@ -290,20 +312,30 @@ def main():
         # Init db and tunnels
         add_tunnels(server_tunnels)
         timeout = 4 * cache.hello
-        cleanup = [lambda: cache.cacheMinimize(config.client_count),
+        cleanup = [netlink.close,
+                   lambda: cache.cacheMinimize(config.client_count),
                    lambda: shutil.rmtree(config.run, True)]
         utils.makedirs(config.run, 0o700)
         control_socket = os.path.join(config.run, 'babeld.sock')
         if config.client_count and not config.client:
-            tunnel_manager = tunnel.TunnelManager(control_socket,
-                cache, cert, config.openvpn_args, timeout, config.client_count,
-                config.iface_list, config.country, address, ip_changed,
-                remote_gateway, config.disable_proto, config.neighbour)
-            add_tunnels(tunnel_manager.new_iface_list)
+            tunnel_manager = tunnel.TunnelManager(reactor,
+                control_socket, cache, cert, config.openvpn_args, timeout,
+                config.client_count, config.iface_list, config.country,
+                address, ip_changed, remote_gateway, config.disable_proto,
+                config.neighbour, config.iface_pool, config.tunnel_score)
+            add_tunnels(tunnel_manager.clientIfaceList())
         else:
-            tunnel_manager = tunnel.BaseTunnelManager(control_socket,
-                cache, cert, config.country, address)
+            tunnel_manager = tunnel.BaseTunnelManager(reactor,
+                control_socket, cache, cert, config.country, address)
         cleanup.append(tunnel_manager.sock.close)
+        tunnel_manager.onChange(None, *overridden)
+        if isinstance(tunnel_manager, tunnel.TunnelManager):
+            def hello_changed():
+                tunnel_manager.timeout = 4 * cache.hello
+            tunnel_manager.onChange(hello_changed, 'hello')
+            if 'client_count' not in overridden:
+                tunnel_manager.onChange(lambda: tunnel_manager.setClientCount(
+                    cache.client_count), 'client_count')
 
         try:
             exit.acquire()
@@ -313,7 +345,7 @@ def main():
                 serial = cert.subject_serial
                 if cache.ipv4_sublen <= 16 and serial < 1 << cache.ipv4_sublen:
                     dot4 = lambda x: socket.inet_ntoa(struct.pack('!I', x))
-                    ip4('route', 'unreachable', ipv4, 'proto', 'static')
+                    route(ipv4, 'unreachable', proto=rtnetlink.RTPROT_STATIC)
                     ipv4, n = ipv4.split('/')
                     ipv4, = struct.unpack('!I', socket.inet_aton(ipv4))
                     n = int(n) + cache.ipv4_sublen
@@ -322,10 +354,10 @@ def main():
                     config.openvpn_args += '--ifconfig', \
                         ipv4, dot4((1<<32) - (1<<32-n))
                     if not isinstance(tunnel_manager, tunnel.TunnelManager):
-                        ip4('addr', ipv4, 'dev', config.main_interface)
+                        address(ipv4, config.main_interface)
                         if config.main_interface == "lo":
-                            ip4('route', 'unreachable', "%s/%s" % (dot4(x), n),
-                                'proto', 'static')
+                            route("%s/%s" % (dot4(x), n), 'unreachable',
+                                  proto=rtnetlink.RTPROT_STATIC)
                     ipv4 = ipv4, n
                 else:
                     logging.warning(
@@ -340,52 +372,109 @@ def main():
                 ip('addrlabel', 'prefix', my_network, 'label', '99')
                 # No need to tell babeld not to set a preferred source IP in
                 # installed routes. The kernel will silently discard the option.
-            R = {}
             if config.client:
                 address_list = [x for x in utils.parse_address(config.client)
                                   if x[2] not in config.disable_proto]
                 if not address_list:
                     sys.exit("error: --disable_proto option disables"
                              " all addresses given by --client")
-                cleanup.append(plib.client('re6stnet',
+                supervisor.start('re6stnet', partial(plib.client, 're6stnet',
                     address_list, cache.encrypt, '--ping-restart',
-                    str(timeout), *config.openvpn_args).stop)
+                    str(timeout), *config.openvpn_args))
+                cleanup.append(partial(supervisor.stop, 're6stnet'))
             elif server_tunnels:
                 dh = config.dh
                 if not dh:
                     dh = os.path.join(config.state, "dh.pem")
                     cache.getDh(dh)
-                for iface, (port, proto) in server_tunnels.items():
+                servers = {}
+                def start_server(iface):
+                    r = servers.pop(iface, None)
+                    if r is not None:
+                        # Process the last client-disconnect events.
+                        tunnel_manager.handleServerEvent(r)
+                        reactor.unregister(r)
+                        r.close()
+                    port, proto = server_tunnels[iface]
                     r, x = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
                     utils.setCloexec(r)
-                    cleanup.append(plib.server(iface, config.max_clients,
-                        dh, x.fileno(), port, proto, cache.encrypt,
-                        '--ping-exit', str(timeout), *config.openvpn_args).stop)
-                    R[r] = partial(tunnel_manager.handleServerEvent, r)
+                    management = os.path.join(config.run,
+                                              iface + '.management')
+                    server = plib.server(iface,
+                        config.max_clients, dh, x.fileno(), port, proto,
+                        cache.encrypt, '--ping-exit', str(4 * cache.hello),
+                        *config.openvpn_args, management=management)
+                    servers[iface] = r
+                    tunnel_manager.addManagement(iface, management)
+                    reactor.addReader(r,
+                        partial(tunnel_manager.handleServerEvent, r))
                     x.close()
+                    return server
+                for iface in server_tunnels:
+                    supervisor.start(iface, partial(start_server, iface))
+                    cleanup.append(partial(supervisor.stop, iface))
+                # Restart servers one at a time, leaving time for their
+                # clients to reconnect before the next one.
+                restarting = deque()
+                def restart_servers():
+                    restarting.clear()
+                    restarting.extend(server_tunnels)
+                    reactor.schedule(time.time() + cache.delay_restart,
+                                     restart_server)
+                def restart_server():
+                    iface = restarting.popleft()
+                    logging.info("Restarting OpenVPN server on %s", iface)
+                    supervisor.restart(iface)
+                    if restarting:
+                        reactor.schedule(time.time() + 4 * cache.hello,
+                                         restart_server)
+                if 'max_clients' not in overridden:
+                    def max_clients_changed():
+                        config.max_clients = cache.max_clients
+                        restart_servers()
+                    tunnel_manager.onChange(max_clients_changed,
+                                            'max_clients')
+                tunnel_manager.onChange(restart_servers, 'encrypt', 'hello')
 
-            ip('addr', my_ip + '/%s' % len(subnet),
-               'dev', config.main_interface)
-            if_rt = ['ip', '-6', 'route', 'del',
-                     'fe80::/64', 'dev', config.main_interface]
+            with netlink.batch():
+                address(my_ip + '/%s' % len(subnet), config.main_interface)
+                route(my_network, 'unreachable')
             if config.main_interface == 'lo':
                 # WKRD: Removed this useless route now, since the kernel does
                 #       not even remove it on exit.
-                subprocess.call(if_rt)
-            if_rt[4] = my_subnet
-            cleanup.append(lambda: subprocess.call(if_rt))
-            ip('route', 'unreachable', my_network)
+                try:
+                    netlink.route('del', 'fe80::/64', dev='lo')
+                except OSError:
+                    pass
+            cleanup.append(lambda: netlink.route('del', my_subnet,
+                                                 dev=config.main_interface))
 
             config.babel_args += config.iface_list
-            cleanup.append(plib.router((my_ip, len(subnet)), ipv4,
-                (my_network, config.gateway, has_ipv6_subtrees),
-                cache.hello,
-                os.path.join(config.log, 'babeld.log'),
-                os.path.join(config.state, 'babeld.state'),
-                control_socket, cache.babel_default,
-                tuple(getattr(cache, k, None) for k in
-                      ('babel_hmac_sign', 'babel_hmac_accept')),
-                *config.babel_args).stop)
+            if not config.client:
+                def babel_changed():
+                    default = plib.babelDefault(cache.babel_default, tuple(
+                        getattr(cache, k, None) for k in
+                        ('babel_hmac_sign', 'babel_hmac_accept')))
+                    tunnel_manager.routing.configure('default ' + default,
+                        *('interface %s hello-interval %s %s'
+                          % (iface, cache.hello, default)
+                          for iface in config.iface_list))
+                tunnel_manager.onChange(babel_changed,
+                                        'babel_default', 'hello')
+            # Network parameters are read again when babeld is restarted.
+            def start_babeld():
+                return plib.router((my_ip, len(subnet)), ipv4,
+                    (my_network, config.gateway, has_ipv6_subtrees),
+                    cache.hello,
+                    os.path.join(config.log, 'babeld.log'),
+                    os.path.join(config.state, 'babeld.state'),
+                    control_socket, cache.babel_default,
+                    tuple(getattr(cache, k, None) for k in
+                          ('babel_hmac_sign', 'babel_hmac_accept')),
+                    *config.babel_args)
+            supervisor.start('babeld', start_babeld,
+                             tunnel_manager.resetRouting)
+            cleanup.append(partial(supervisor.stop, 'babeld'))
             if config.up:
                 exit.release()
                 r = os.system(config.up)
@@ -395,7 +484,9 @@ def main():
             # Keep babeld cleanup at the end, so that babeld is stopped first,
             # which gives a chance to send wildcard retractions.
             for cmd in config.daemon or ():
-                cleanup.insert(-1, utils.Popen(cmd, shell=True).stop)
+                supervisor.start(cmd, partial(utils.Popen, cmd, shell=True),
+                                 always=False)
+                cleanup.insert(-1, partial(supervisor.stop, cmd))
             cleanup.insert(-1, tunnel_manager.close)
             if config.console:
                 from re6st.debug import Console
@@ -406,24 +497,22 @@ def main():
                         frame.f_locals # main() locals
                     finally:
                         socket.close()
-                console = Console(config.console, console)
+                console = Console(reactor, config.console, console)
                 cleanup.append(console.close)
 
             # main loop
             exit.release()
-            select_list = [forwarder.select] if forwarder else []
-            if config.console:
-                select_list.append(console.select)
             if config.multicast:
                 from re6st.multicast import PimDm
-                pimdm = PimDm()
+                pimdm = PimDm(reactor)
                 cleanup.append(pimdm.run(config.iface_list, config.run).stop)
-                select_list.append(pimdm.select)
-            select_list += tunnel_manager.select, utils.select
             while True:
-                args = R.copy(), {}, []
-                for s in select_list:
-                    s(*args)
+                try:
+                    reactor.select()
+                except routing.ConnectionClosed as e:
+                    # babeld exited, and it will be restarted.
+                    logging.warning("%s", e)
+                    tunnel_manager.resetRouting()
         finally:
             # XXX: We have a possible race condition if a signal is handled at
             #      the beginning of this clause, just before the following line.
@@ -1,12 +1,11 @@
 #!/usr/bin/env python3
-import http.client, logging, os, socket, sys
+import io, logging, os, queue, re, socket, sys, threading, time
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler
-from socketserver import ThreadingTCPServer
 from urllib.parse import parse_qsl
 if 're6st' not in sys.modules:
     sys.path[0] = os.path.dirname(os.path.dirname(sys.path[0]))
-from re6st import registry, utils, version
+from re6st import metrics, registry, utils, version
 
 # To generate server ca and key with serial for 2001:db8:42::/48
 #  openssl req -nodes -new -x509 -key ca.key -set_serial 0x120010db80042 -days 3650 -out ca.crt
@@ -14,8 +13,49 @@ from re6st import registry, utils, version
 IPV6_V6ONLY = 26
 SOL_IPV6 = 41
 
+end_of_headers = re.compile(rb'\r?\n\r?\n').search
+
 
 class RequestHandler(BaseHTTPRequestHandler):
+    """Connection to the registry, whose requests are handled one by one
+
+    Unlike with socketserver, the constructor only sets the connection up.
+    Requests are received by HTTPFrontEnd, in 'buffer', and as they have
+    no body (only GET is implemented), a request is complete at the end of
+    its headers. For each one, HTTPFrontEnd calls nextRequest,
+    handle_one_request, which only parses it, and process.
+    """
+
+    # Keep-alive: all responses have a Content-Length or no body.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately: with Nagle's algorithm, the
+    # body would wait for the ACK of the headers, which is delayed.
+    disable_nagle_algorithm = True
+    # Maximum time to send a response.
+    timeout = 10
+    # Maximum size of the request line and headers.
+    max_request_size = 65536
+
+    buffer = b''
+    call = None
+
+    def __init__(self, request, client_address, server, frontend):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.frontend = frontend
+        self.setup()
+        self.rfile.close()
+
+    def nextRequest(self) -> bool:
+        """Move the first complete request of the buffer to rfile, if any"""
+        m = end_of_headers(self.buffer)
+        if m:
+            i = m.end()
+            self.rfile = io.BytesIO(self.buffer[:i])
+            self.buffer = self.buffer[i:]
+            return True
+        return False
 
     def do_GET(self):
         try:
@@ -29,28 +69,265 @@ class RequestHandler(BaseHTTPRequestHandler):
                                               strict_parsing=True))
             _, path = path.split('/')
             if not _:
-                return self.server.handle_request(self, path, query)
+                self.call = path, query
+                return
         except Exception:
             logging.info(self.requestline, exc_info=True)
         self.send_error(HTTPStatus.BAD_REQUEST)
 
+    def isBlocking(self) -> bool:
+        return hasattr(getattr(self.server, self.call[0], None), '_blocking')
+
+    def process(self):
+        path, query = self.call
+        del self.call
+        try:
+            self.server.handle_request(self, path, query)
+        except Exception:
+            logging.info(self.requestline, exc_info=True)
+            self.send_error(HTTPStatus.BAD_REQUEST)
+        self.wfile.flush()
+
     def log_error(*args):
         pass
 
 
-class HTTPServer4(ThreadingTCPServer):
+class HTTPFrontEnd:
+    """HTTP server with fixed pools of worker threads
+
+    Connections are accepted and watched by the reactor, which also receives
+    requests, so that slow clients don't hold workers. When a request is
+    complete, its connection is queued for a worker, which parses and
+    processes it. Blocking RPCs are forwarded to a separate pool, so that
+    cheap RPCs don't wait behind them. After the response, the connection
+    goes back to the reactor until the next request (keep-alive), or until
+    it is closed for being idle.
+
+    Requests that waited longer than 'deadline' in a queue are answered
+    with 503 (Service Unavailable) instead of being processed: the client
+    has probably given up anyway.
+    """
 
-    allow_reuse_address = True
-    daemon_threads = True
+    handler_class = RequestHandler
 
+    def __init__(self, reactor: utils.Reactor, server: registry.RegistryServer,
+                 workers=8, blocking_workers=4, deadline=30., backlog=128,
+                 idle_timeout=30):
+        self._reactor = reactor
+        self._server = server
+        self.deadline = deadline
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._listening = []
+        # Connections that wait for a request, with their last activity.
+        self._idle = {}
+        self._wakeup, self._notify = socket.socketpair()
+        self._wakeup.setblocking(False)
+        reactor.addReader(self._wakeup, self._rearm)
+        self._rearm_list = []
+        self._queue = queue.Queue()
+        self._blocking_queue = queue.Queue()
+        self._stats = dict.fromkeys((
+            'accepted', 'requests', 'blocking', 'late', 'wait'), 0)
+        self._max_depth = [0, 0]
+        self._thread_list = []
+        for q, n in (self._queue, workers), (self._blocking_queue,
+                                            blocking_workers):
+            for _ in range(n):
+                x = threading.Thread(target=self._work,
+                    args=(q, q is self._blocking_queue), daemon=True)
+                x.start()
+                self._thread_list.append((x, q))
+        reactor.schedule(time.time() + idle_timeout, self._closeIdle)
 
-class HTTPServer6(HTTPServer4):
+    def listen(self, address: str, port: int):
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            s.setsockopt(SOL_IPV6, IPV6_V6ONLY, 1)
+        s.bind((address, port))
+        s.listen(self.backlog)
+        s.setblocking(False)
+        self._listening.append(s)
+        self._reactor.addReader(s, lambda: self._accept(s))
+        return s.getsockname()
 
-    address_family = socket.AF_INET6
+    def wakeup(self):
+        """Interrupt the reactor, from another thread"""
+        self._notify.send(b'\0')
 
-    def server_bind(self):
-        self.socket.setsockopt(SOL_IPV6, IPV6_V6ONLY, 1)
-        HTTPServer4.server_bind(self)
+    def close(self):
+        # The reactor must not be running.
+        reactor = self._reactor
+        for s in self._listening:
+            reactor.unregister(s)
+            s.close()
+        reactor.cancel(self._closeIdle)
+        for handler in self._idle:
+            self._close(handler)
+        self._idle.clear()
+        for x, q in self._thread_list:
+            q.put(None)
+        for x, q in self._thread_list:
+            x.join()
+        reactor.unregister(self._wakeup)
+        self._wakeup.close()
+        self._notify.close()
+
+    def metrics(self) -> dict:
+        """Counters since startup, and current state"""
+        with self._lock:
+            x = dict(self._stats,
+                queue=self._queue.qsize(),
+                blocking_queue=self._blocking_queue.qsize(),
+                max_queue=self._max_depth[0],
+                max_blocking_queue=self._max_depth[1])
+        x['idle'] = len(self._idle)
+        return x
+
+    def metricList(self) -> list:
+        x = self.metrics
+        return [metrics.Gauge("re6st_registry_http_" + name, help,
+                              lambda key=key: x()[key], type)
+            for key, name, type, help in (
+                ('accepted', 'accepted_total', 'counter',
+                 "Accepted connections"),
+                ('requests', 'requests_total', 'counter', "Handled requests"),
+                ('blocking', 'blocking_total', 'counter',
+                 "Requests handled by blocking workers"),
+                ('late', 'late_total', 'counter',
+                 "Requests rejected because they waited too long"),
+                ('wait', 'wait_seconds_total', 'counter',
+                 "Time spent by requests in queues"),
+                ('queue', 'queue', 'gauge', "Requests waiting for a worker"),
+                ('blocking_queue', 'blocking_queue', 'gauge',
+                 "Requests waiting for a blocking worker"),
+                ('idle', 'idle', 'gauge',
+                 "Connections waiting for a request"),
+            )]
+
+    def _accept(self, s: socket.socket):
+        while True:
+            try:
+                conn, address = s.accept()
+            except BlockingIOError:
+                break
+            except OSError as e: # e.g. too many open files
+                logging.warning("accept: %s", e)
+                break
+            conn.setblocking(True)
+            with self._lock:
+                self._stats['accepted'] += 1
+            self._watch(self.handler_class(conn, address, self._server, self))
+
+    def _watch(self, handler: RequestHandler):
+        self._idle[handler] = time.time()
+        handler.connection.setblocking(False)
+        self._reactor.addReader(handler.connection,
+                                lambda: self._ready(handler))
+
+    def _ready(self, handler: RequestHandler):
+        try:
+            data = handler.connection.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            handler.buffer += data
+            if not handler.nextRequest():
+                if len(handler.buffer) < handler.max_request_size:
+                    return # incomplete
+                data = b''
+        self._reactor.removeReader(handler.connection)
+        del self._idle[handler]
+        if data:
+            handler.connection.settimeout(handler.timeout)
+            self._put(handler, False)
+        else:
+            self._close(handler)
+
+    def _put(self, handler: RequestHandler, blocking: bool):
+        handler.queued = time.monotonic()
+        q = self._blocking_queue if blocking else self._queue
+        q.put(handler)
+        with self._lock:
+            self._max_depth[blocking] = max(self._max_depth[blocking],
+                                            q.qsize())
+
+    def _rearm(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            rearm_list = self._rearm_list
+            self._rearm_list = []
+        for handler in rearm_list:
+            self._watch(handler)
+
+    def _closeIdle(self):
+        now = time.time()
+        idle = now - self.idle_timeout
+        for handler, x in list(self._idle.items()):
+            if x < idle:
+                self._reactor.unregister(handler.connection)
+                del self._idle[handler]
+                self._close(handler)
+        self._reactor.schedule(now + self.idle_timeout / 2, self._closeIdle)
+
+    def _close(self, handler: RequestHandler):
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        try:
+            handler.connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        handler.connection.close()
+
+    def _work(self, q: queue.Queue, blocking: bool):
+        while True:
+            handler = q.get()
+            if handler is None:
+                break
+            try:
+                if not blocking:
+                    handler.handle_one_request()
+                    if handler.call and handler.isBlocking():
+                        self._put(handler, True)
+                        continue
+                if handler.call:
+                    wait = time.monotonic() - handler.queued
+                    with self._lock:
+                        stats = self._stats
+                        stats['requests'] += 1
+                        stats['blocking'] += blocking
+                        stats['wait'] += wait
+                        if wait > self.deadline:
+                            stats['late'] += 1
+                    if wait > self.deadline:
+                        del handler.call
+                        handler.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+                        handler.wfile.flush()
+                    else:
+                        handler.process()
+            except Exception:
+                logging.info("Error while handling request from %s",
+                             handler.client_address, exc_info=True)
+                handler.close_connection = True
+            if handler.close_connection:
+                self._close(handler)
+            elif handler.nextRequest(): # pipelined
+                self._put(handler, False)
+            else:
+                with self._lock:
+                    self._rearm_list.append(handler)
+                self.wakeup()
 
 
 def main():
@@ -112,6 +389,17 @@ def main():
     _('--grace-period', default=8640000, type=int,
         help="Period in seconds during which a client can renew its"
              " certificate even if expired (default 100 days)")
+    _('--workers', default=8, type=int,
+        help="Number of threads processing requests.")
+    _('--blocking-workers', default=4, type=int,
+        help="Number of threads processing requests that may block for a"
+             " long time (e.g. getBootstrapPeer or requestCertificate), so"
+             " that they don't delay other requests.")
+    _('--deadline', default=30, type=float,
+        help="Requests that waited longer in a queue, because all workers"
+             " were busy, are rejected with 503 (Service Unavailable).")
+    _('--backlog', default=128, type=int,
+        help="Maximum number of connections waiting to be accepted.")
 
     _ = parser.add_argument_group('routing').add_argument
     _('--hello', type=int, default=15,
@@ -157,22 +445,19 @@ def main():
     if config.max_clients is None:
         config.max_clients = config.client_count * 2
 
-    server = registry.RegistryServer(config)
-    def requestHandler(request, client_address, _):
-        RequestHandler(request, client_address, server)
-
-    server_dict = {}
+    reactor = utils.Reactor()
+    server = registry.RegistryServer(config, reactor)
+    frontend = HTTPFrontEnd(reactor, server, config.workers,
+                            config.blocking_workers, config.deadline,
+                            config.backlog)
+    server.metric_list += frontend.metricList()
     if config.bind4:
-        r = HTTPServer4((config.bind4, config.port), requestHandler)
-        server_dict[r.fileno()] = r._handle_request_noblock
+        frontend.listen(config.bind4, config.port)
     if config.bind6:
-        r = HTTPServer6((config.bind6, config.port), requestHandler)
-        server_dict[r.fileno()] = r._handle_request_noblock
-    if server_dict:
+        frontend.listen(config.bind6, config.port)
+    if config.bind4 or config.bind6:
         while True:
-            args = server_dict.copy(), {}, []
-            server.select(*args)
-            utils.select(*args)
+            reactor.select()
 
 
 if __name__ == "__main__":
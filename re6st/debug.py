@@ -46,7 +46,8 @@ class Socket:
 
 class Console:
 
-    def __init__(self, path, pdb):
+    def __init__(self, reactor, path, pdb):
+        self._reactor = reactor
         self.path = path
         s = self._sock = socket.socket(socket.AF_UNIX,
             socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
@@ -61,11 +62,10 @@ class Console:
             t = threading.Thread(target=pdb, args=(Socket(s.accept()[0]),))
             t.daemon = True
             t.start()
-        def select(r, w, t):
-            r[s] = accept
-        self.select = select
+        reactor.addReader(s, accept)
 
     def close(self):
+        self._reactor.unregister(self._sock)
         self._removeSocket()
         self._sock.close()
 
@@ -0,0 +1,145 @@
+"""Metrics exported in the text format of Prometheus
+
+This is a minimal implementation, to avoid a dependency: counters,
+histograms and gauges computed on demand, with labels given as keyword
+arguments. All methods are thread-safe.
+"""
+import bisect, threading, time
+from collections.abc import Callable, Iterator
+
+
+def formatLabels(labels: tuple) -> str:
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\')
+                                                  .replace('"', r'\"'))
+                             for k, v in labels) if labels else ''
+
+
+class Metric:
+
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def text(self) -> Iterator[str]:
+        yield "# HELP %s %s" % (self.name, self.help)
+        yield "# TYPE %s %s" % (self.name, self.type)
+        for labels, value in self._items():
+            yield from self._text(labels, value)
+
+    def _items(self) -> list:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _text(self, labels: tuple, value) -> Iterator[str]:
+        yield "%s%s %r" % (self.name, formatLabels(labels), value)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        labels = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, **labels):
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        labels = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                x = self._values[labels]
+            except KeyError:
+                # Counts per bucket (not cumulative), sum.
+                x = self._values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            x[0][i] += 1
+            x[1] += value
+
+    def _text(self, labels: tuple, value) -> Iterator[str]:
+        counts, total = value
+        n = 0
+        for le, count in zip(self.buckets + ('+Inf',), counts):
+            n += count
+            yield "%s_bucket%s %u" % (self.name,
+                formatLabels(labels + (('le', le),)), n)
+        labels = formatLabels(labels)
+        yield "%s_sum%s %r" % (self.name, labels, total)
+        yield "%s_count%s %u" % (self.name, labels, n)
+
+
+class Gauge(Metric):
+    """Metric whose values are returned by a function
+
+    It returns a number, or a dict whose keys are tuples of
+    (label name, value) pairs. 'type' can also be 'counter', for a value
+    that is counted elsewhere.
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable,
+                 type='gauge'):
+        super().__init__(name, help)
+        self._callback = callback
+        self.type = type
+
+    def _items(self) -> list:
+        value = self._callback()
+        return sorted(value.items()) if type(value) is dict else [((), value)]
+
+
+class TimedLock:
+    """Lock whose waiting times are accounted
+
+    Acquiring a free lock is not timed.
+    """
+
+    def __init__(self, lock, wait: Counter, contended: Counter, /, **labels):
+        self._lock = lock
+        self._wait = wait
+        self._contended = contended
+        self._labels = labels
+
+    def acquire(self, blocking=True, timeout=-1) -> bool:
+        lock = self._lock
+        if lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        t = time.perf_counter()
+        try:
+            return lock.acquire(True, timeout)
+        finally:
+            self._wait.inc(time.perf_counter() - t, **self._labels)
+            self._contended.inc(**self._labels)
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, t, v, tb):
+        self._lock.release()
+
+
+def exposition(metric_list) -> str:
+    return ''.join(x + '\n' for metric in metric_list for x in metric.text())
@@ -57,7 +57,8 @@ class unpacker:
 
 class PimDm:
 
-    def __init__(self):
+    def __init__(self, reactor):
+        self._reactor = reactor
         s_netlink = socket(AF_NETLINK, SOCK_RAW, NETLINK_ROUTE)
         s_netlink.setblocking(False)
         s_netlink.bind((os.getpid(), RTMGRP_IPV6_IFINFO))
@@ -91,6 +92,8 @@ class PimDm:
                    and rta_data in interfaceUpSet():
                     self.addInterface(rta_data)
                     self.not_ready_iface_set.remove(rta_data)
+                    if not self.not_ready_iface_set:
+                        self._reactor.removeReader(self.s_netlink)
                 break
 
             unpack._offset += (rta_len - 1) & ~(4 - 1)
@@ -107,6 +110,8 @@ class PimDm:
         up_set = interfaceUpSet()
         self.not_ready_iface_set = iface_set - up_set
         iface_set &= up_set
+        if self.not_ready_iface_set:
+            self._reactor.addReader(self.s_netlink, self.addInterfaceWhenReady)
 
         enabled = (('enabled', True), ('state_refresh', True))
         conf = {
@@ -124,10 +129,6 @@ class PimDm:
 
         return utils.Popen(['pim-dm', '-config', conf_file_path])
 
-    def select(self, r, w, t):
-        if self.not_ready_iface_set:
-            r[self.s_netlink] = self.addInterfaceWhenReady
-
 def ifap_iter(ifa):
     '''Iterate over linked list of ifaddrs'''
     while ifa:
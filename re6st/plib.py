@@ -1,14 +1,16 @@
 import binascii
-import logging, errno, os
+import logging, errno, os, socket
+from collections import deque
 from typing import Optional
-from . import utils
+from . import routing, utils
 
 here = os.path.realpath(os.path.dirname(__file__))
 ovpn_server = os.path.join(here, 'ovpn-server')
 ovpn_client = os.path.join(here, 'ovpn-client')
 ovpn_log: Optional[str] = None
 
-def openvpn(iface: str, encrypt, *args, **kw) -> utils.Popen:
+def openvpn(iface: str, encrypt, *args, management: Optional[str] = None,
+            **kw) -> utils.Popen:
     args = ['openvpn',
         '--dev-type', 'tap',
         '--dev', iface,
@@ -19,6 +21,8 @@ def openvpn(iface: str, encrypt, *args, **kw) -> utils.Popen:
         '--setenv', 'PATH', os.environ['PATH'],
         #'--user', 'nobody', '--group', 'nogroup',
         ] + list(args)
+    if management:
+        args += '--management', management, 'unix'
     if ovpn_log:
         args += '--log-append', os.path.join(ovpn_log, '%s.log' % iface),
     if not encrypt:
@@ -69,6 +73,142 @@ def client(iface: str, address_list: list[tuple[str, int, str]],
     return openvpn(iface, encrypt, *remote, **kw)
 
 
+class ManagementError(Exception):
+    """Error response of OpenVPN to a management command"""
+
+
+class Management:
+    """Client of the management interface of an OpenVPN process
+
+    Commands are sent asynchronously and each callback is called from the
+    reactor with the response: the message of a single-line response, or
+    the lines of a multi-line one. If OpenVPN replies with an error, it is
+    called with a ManagementError instance, and with None if the connection
+    is lost. Real-time notifications are ignored.
+    """
+
+    _socket = None
+
+    def __init__(self, socket_path: str, reactor: utils.Reactor):
+        self.socket_path = socket_path
+        self._reactor = reactor
+        self._pending = deque()
+
+    def open(self) -> bool:
+        if self._socket is None:
+            s = socket.socket(socket.AF_UNIX,
+                socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+            try:
+                s.connect(self.socket_path)
+            except socket.error as e:
+                logging.debug("Can't connect to %r (%r)", self.socket_path, e)
+                s.close()
+                return False
+            s.setblocking(False)
+            self._socket = s
+            self._buffer = b''
+            self._lines = []
+            self._reactor.addReader(s, self._read)
+        return True
+
+    def close(self):
+        s = self._socket
+        if s is not None:
+            self._socket = None
+            self._reactor.unregister(s)
+            s.close()
+            pending = self._pending
+            while pending:
+                pending.popleft()[1](None)
+
+    def command(self, cmd: str, callback, multiline=False) -> bool:
+        """Send a command, return False if OpenVPN can't be reached"""
+        if not self.open():
+            return False
+        try:
+            self._socket.send(cmd.encode() + b'\n')
+        except socket.error as e:
+            logging.info("%r: %r", self.socket_path, e)
+            self.close()
+            return False
+        self._pending.append((multiline, callback))
+        return True
+
+    def kill(self, common_name: str, callback) -> bool:
+        """Disconnect all clients with the given common name"""
+        return self.command('kill ' + common_name, callback)
+
+    def clientList(self, callback) -> bool:
+        """Get the list of connected clients, in server mode
+
+        Each client is a dict of the CLIENT_LIST columns ('Common Name',
+        'Real Address', ...), with byte counters ('Bytes Received' and
+        'Bytes Sent') converted to int.
+        """
+        def status(lines):
+            if lines is None or isinstance(lines, ManagementError):
+                return callback(None)
+            header = None
+            client_list = []
+            for line in lines:
+                line = line.split('\t')
+                if line[:2] == ['HEADER', 'CLIENT_LIST']:
+                    header = line[2:]
+                elif line[0] == 'CLIENT_LIST' and header:
+                    client = dict(zip(header, line[1:]))
+                    for x in 'Bytes Received', 'Bytes Sent':
+                        client[x] = int(client[x])
+                    client_list.append(client)
+            callback(client_list)
+        return self.command('status 3', status, True)
+
+    def _read(self):
+        try:
+            d = self._socket.recv(65536)
+        except socket.error as e:
+            logging.info("%r: %r", self.socket_path, e)
+            d = None
+        if not d:
+            logging.info("Connection to %r closed", self.socket_path)
+            self.close()
+            return
+        lines = (self._buffer + d).split(b'\n')
+        self._buffer = lines.pop()
+        pending = self._pending
+        for line in lines:
+            line = line.rstrip(b'\r').decode()
+            if line.startswith('>') or not pending:
+                continue
+            multiline, callback = pending[0]
+            if multiline:
+                if line == 'END':
+                    response = self._lines
+                    self._lines = []
+                elif self._lines or not line.startswith('ERROR:'):
+                    self._lines.append(line)
+                    continue
+                else:
+                    response = ManagementError(line[6:].lstrip())
+            elif line.startswith('SUCCESS:'):
+                response = line[8:].lstrip()
+            else:
+                response = ManagementError(line[6:].lstrip()
+                    if line.startswith('ERROR:') else line)
+            if isinstance(response, ManagementError):
+                logging.info("%r: %s", self.socket_path, line)
+            pending.popleft()
+            callback(response)
+
+
+def babelDefault(default: str, hmac: tuple[bytes | None, bytes | None]) -> str:
+    """Return the interface defaults given to babeld"""
+    hmac_sign, hmac_accept = hmac
+    if hmac_sign:
+        default += ' key sign'
+        if hmac_accept is not None and not hmac_accept:
+            default += ' accept-bad-signatures true'
+    return default
+
 def router(ip: tuple[str, int], ip4, rt6: tuple[str, bool, bool],
            hello_interval: int, log_path: str, state_path: str,
            control_socket: str, default: str,
@@ -93,13 +233,9 @@ def router(ip: tuple[str, int], ip4, rt6: tuple[str, bool, bool],
             cmd += '-C', ('key type blake2s128 id %s value %s' %
                           (id, binascii.hexlify(value).decode()))
         key(cmd, 'sign', hmac_sign)
-        default += ' key sign'
-        if hmac_accept is not None:
-            if hmac_accept:
-                key(cmd, 'accept', hmac_accept)
-            else:
-                default += ' accept-bad-signatures true'
-    cmd += '-C', 'default ' + default
+        if hmac_accept:
+            key(cmd, 'accept', hmac_accept)
+    cmd += '-C', 'default ' + babelDefault(default, hmac)
     if ip4:
         cmd += '-C', 'redistribute ip %s/%s eq %s' % (ip4, n4, n4)
     if gateway:
@@ -136,7 +272,10 @@ def router(ip: tuple[str, int], ip4, rt6: tuple[str, bool, bool],
     if ip4:
         cmd += '-C', 'install pref-src ' + ip4
     if control_socket:
-        cmd += '-X', '%s' % control_socket
+        # Read-write, to reconfigure babeld without restarting it.
+        cmd += ('-X', '%s' % control_socket,
+                '-C', 'local-path-readwrite '
+                      + routing.localPath(control_socket))
     cmd += args
     logging.info('%r', cmd)
     return utils.Popen(cmd, **kw)
@@ -18,26 +18,56 @@ Authenticated communication:
   - the last one that was really used by the client (!hello)
   - the one of the last handshake (hello)
 """
-import base64, hmac, hashlib, http.client, inspect, json, logging
-import mailbox, os, platform, random, select, smtplib, socket, sqlite3
+import base64, heapq, hmac, hashlib, http.client, inspect, json, logging
+import mailbox, os, platform, queue, random, smtplib, socket, sqlite3
 import string, sys, threading, time, weakref, zlib
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 from collections.abc import Iterator
+from concurrent.futures import Future, TimeoutError
+from contextlib import contextmanager
 from datetime import datetime
 from http import HTTPStatus
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from email.mime.text import MIMEText
+from functools import partial
 from operator import itemgetter
 from typing import Tuple
 
 from OpenSSL import crypto
 from urllib.parse import urlparse, unquote, urlencode
 from . import routing, tunnel, utils, version, x509
+from .metrics import Counter, Gauge, Histogram, TimedLock, exposition
 
 HMAC_HEADER = "Re6stHMAC"
 RENEW_PERIOD = 30 * 86400
 BABEL_HMAC = 'babel_hmac0', 'babel_hmac1', 'babel_hmac2'
 NETCONF_TEMP = 3600
+CERT_COLUMNS = (
+    "prefix TEXT PRIMARY KEY NOT NULL",
+    "email TEXT",
+    "cert TEXT",
+    # The following columns are extracted from 'cert', for indexing.
+    "serial INTEGER",
+    "subject_serial INTEGER",
+    "not_after INTEGER")
+
+def certColumns(cert: crypto.X509) -> tuple[int, int | None, int]:
+    """Return the values of the indexed columns of a certificate"""
+    subject_serial = cert.get_subject().serialNumber
+    return (cert.get_serial_number(),
+            subject_serial and int(subject_serial),
+            x509.notAfter(cert))
+
+class TimedConnection(sqlite3.Connection):
+    """Connection to a database that accounts the time spent in execute"""
+
+    def execute(self, *args):
+        t = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            self.observe(time.perf_counter() - t)
+
 
 def rpc(f):
     argspec = inspect.getfullargspec(f)
@@ -53,26 +83,207 @@ def rpc_private(f):
     f._private = None
     return rpc(f)
 
+def blocking(f):
+    """Mark a RPC that may wait for a long time
+
+    e.g. for a node, the main lock or an SMTP server. The HTTP front-end
+    processes them in a separate pool of workers.
+    """
+    f._blocking = None
+    return f
+
 
 class HTTPError(Exception):
     pass
 
 
+class Entity(bytes):
+    """RPC result that clients can cache, identified by an entity tag
+
+    Clients send it back in If-None-Match and get an empty answer
+    (304 Not Modified) if the result has not changed.
+    """
+
+    def __new__(cls, data: bytes, etag: str | None=None):
+        self = bytes.__new__(cls, data)
+        self.etag = '"%s"' % (etag or hashlib.sha1(data).hexdigest())
+        return self
+
+
+class PrefixAllocator:
+    """Free prefixes of the 'cert' table, as a binary trie of buddies
+
+    Free prefixes (rows without certificate) are indexed by community (the
+    community that contains them, None if there's none) and by length, so
+    that allocating or freeing a prefix costs O(prefix length) instead of
+    scanning the table. All changes are written through to the database,
+    within the transaction of the caller: if the transaction is rolled
+    back, the allocator must be reloaded.
+    """
+
+    def __init__(self, community_list, max_len: int):
+        self._community_set = frozenset(community_list)
+        self.max_len = max_len
+
+    def load(self, db: sqlite3.Connection):
+        """(Re)build the free lists from the database, merging buddies"""
+        self._free = {}
+        # (community, length) -> heap of prefixes. Entries that are not in
+        # self._free anymore are removed lazily.
+        self._heap_dict = defaultdict(list)
+        self._count = defaultdict(int)
+        for prefix, in db.execute("SELECT prefix FROM cert WHERE cert IS NULL"
+                                  " ORDER BY length(prefix) DESC").fetchall():
+            self.free(db, prefix)
+        self.dirty = False
+
+    def community(self, prefix: str) -> str | None:
+        for n in range(len(prefix) + 1):
+            if prefix[:n] in self._community_set:
+                return prefix[:n]
+
+    def _add(self, prefix: str):
+        key = self._free[prefix] = self.community(prefix), len(prefix)
+        self._count[key] += 1
+        heap = self._heap_dict[key]
+        heapq.heappush(heap, prefix)
+        if len(heap) > 2 * self._count[key] + 8:
+            heap[:] = sorted(set(x for x in heap if x in self._free))
+
+    def _remove(self, prefix: str):
+        self._count[self._free.pop(prefix)] -= 1
+
+    def _pop(self, community: str | None, length: int) -> str | None:
+        heap = self._heap_dict.get((community, length))
+        while heap:
+            prefix = heapq.heappop(heap)
+            if prefix in self._free:
+                self._remove(prefix)
+                return prefix
+
+    def allocate(self, db: sqlite3.Connection, prefix_len: int,
+                 community: str) -> str:
+        community_len = len(community)
+        prefix_len += community_len
+        assert 0 < prefix_len <= self.max_len
+        q = db.execute
+        self.dirty = True
+        while True:
+            # Find longest free prefix whithin community.
+            for x in range(prefix_len, community_len - 1, -1):
+                prefix = self._pop(community, x)
+                if prefix is not None:
+                    break
+            else:
+                # Community not yet allocated?
+                # At most 1 free prefix is the beginning of community.
+                for x in range(community_len):
+                    prefix = community[:x]
+                    if prefix in self._free:
+                        self._remove(prefix)
+                        break
+                else:
+                    logging.error('No more free /%u prefix available',
+                                  prefix_len)
+                    raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+            # Split the tree until prefix has wanted length.
+            for x in range(len(prefix), prefix_len):
+                # Prefix starts with community, then we complete with 0.
+                x = community[x] if x < community_len else '0'
+                buddy = prefix + str(1-int(x))
+                q("UPDATE cert SET prefix = ? WHERE prefix = ?",
+                  (buddy, prefix))
+                self._add(buddy)
+                prefix += x
+                q("INSERT INTO cert (prefix) VALUES (?)", (prefix,))
+            if prefix_len < self.max_len or '1' in prefix[community_len:]:
+                return prefix
+            q("UPDATE cert SET cert = 'reserved' WHERE prefix = ?", (prefix,))
+
+    def free(self, db: sqlite3.Connection, prefix: str):
+        """Add a prefix whose row has just been cleared to the free lists"""
+        q = db.execute
+        self.dirty = True
+        while prefix:
+            buddy = prefix[:-1] + str(1-int(prefix[-1]))
+            if buddy not in self._free:
+                break
+            self._remove(buddy)
+            q("DELETE FROM cert WHERE prefix = ?", (buddy,))
+            q("UPDATE cert SET prefix = ? WHERE prefix = ?",
+              (prefix[:-1], prefix))
+            prefix = prefix[:-1]
+        self._add(prefix)
+
+    def stats(self) -> dict:
+        """Fragmentation of free space, per community
+
+        Space is counted in prefixes of maximum length, and fragmentation
+        is the ratio of free space outside the largest free prefix.
+        Free prefixes that are not in any community (e.g. because they
+        contain communities that are not allocated yet) are counted
+        with the None community.
+        """
+        stats = {}
+        for (community, length), count in self._count.items():
+            if count:
+                try:
+                    x = stats[community]
+                except KeyError:
+                    x = stats[community] = {
+                        'free': 0, 'space': 0, 'largest': 0, 'lengths': {}}
+                x['free'] += count
+                x['space'] += count << self.max_len - length
+                x['largest'] = max(x['largest'], 1 << self.max_len - length)
+                x['lengths'][length] = count
+        for x in stats.values():
+            x['fragmentation'] = 1 - x['largest'] / x['space']
+        return stats
+
+
 class RegistryServer:
 
     peers = 0, ()
     cert_duration = 365 * 86400
 
-    sessions: dict[str, list[tuple[bytes, int]]]
+    sessions: OrderedDict[str, list[tuple[bytes, int]]]
+    # Number of sessions kept in memory, the least recently used first.
+    session_cache_size = 10000
+    # Sessions unused for this period are deleted.
+    session_timeout = 30 * 86400
+    # Maximum number of network configurations cached for getNetworkConfig.
+    network_config_cache_size = 10000
 
     def _geoiplookup(self, ip):
         raise HTTPError(HTTPStatus.BAD_REQUEST)
 
-    def __init__(self, config):
+    _timeout = None
+    _ca = _dh = None
+    prefix_allocator = None
+    # Maximum delay to wait for a reply from a node.
+    reply_timeout = 3
+
+    def __init__(self, config, scheduler: utils.Scheduler):
         self.config = config
-        self.lock = threading.Lock()
-        self.sessions = {}
+        self._scheduler = scheduler
+        self._initMetrics()
+        # Serialize writers (the database and the network configuration).
+        # Readers don't lock: each thread has its own connection to the
+        # database, in WAL mode.
+        self.lock = self._timedLock(threading.RLock(), 'lock')
+        self.sessions_lock = self._timedLock(threading.Lock(), 'sessions_lock')
+        self._network_config_lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self._local = threading.local()
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        # Replies from nodes are read by a dedicated thread and dispatched
+        # without holding self.lock: to the future of a (prefix, code) query
+        # or to the queues of requests that collect all replies of a code.
+        self._reply_lock = threading.Lock()
+        self._reply_dict = {}
+        self._collector_dict = defaultdict(list)
+        self._receiver = threading.Thread(target=self._receive, daemon=True)
+        self._receiver.start()
 
         # Parse community file
         self.community_map = {}
@@ -91,26 +302,50 @@ class RegistryServer:
         # Database initializing
         db_dir = os.path.dirname(self.config.db)
         db_dir and utils.makedirs(db_dir)
-        self.db = sqlite3.connect(self.config.db, isolation_level=None,
-                                                  check_same_thread=False)
-        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
         utils.sqliteCreateTable(self.db, "config",
                 "name TEXT PRIMARY KEY NOT NULL",
                 "value")
         self.prefix = self.getConfig("prefix", None)
+        if self.prefix is not None:
+            self.prefix = utils.Prefix.fromBin(self.prefix)
         self.version = self.getConfig("version", b'\0')
+        # Sessions are saved in a separate database, so that they're updated
+        # without waiting for other writers. Without them, all nodes would
+        # have to say hello again after a restart.
+        x = os.path.splitext(self.config.db)
+        self._session_db = x = sqlite3.connect(x[0] + '-sessions' + x[1],
+            isolation_level=None, check_same_thread=False,
+            factory=TimedConnection)
+        x.observe = partial(self._sqlite_seconds.observe, db='sessions')
+        x.execute("PRAGMA journal_mode=WAL")
+        # Lost updates only force nodes to say hello again.
+        x.execute("PRAGMA synchronous=OFF")
+        utils.sqliteCreateTable(x, "session",
+                "prefix TEXT PRIMARY KEY NOT NULL",
+                "key0 BLOB",
+                "protocol0 INTEGER",
+                "key1 BLOB",
+                "protocol1 INTEGER",
+                "last_used INTEGER NOT NULL")
+        x.execute("CREATE INDEX IF NOT EXISTS session_last_used"
+                  " ON session(last_used)")
+        self._purgeSessions()
         utils.sqliteCreateTable(self.db, "token",
                 "token TEXT PRIMARY KEY NOT NULL",
                 "email TEXT NOT NULL",
                 "prefix_len INTEGER NOT NULL",
                 "date INTEGER NOT NULL")
-        utils.sqliteCreateTable(self.db, "cert",
-                "prefix TEXT PRIMARY KEY NOT NULL",
-                "email TEXT",
-                "cert TEXT")
+        with self.transaction() as db:
+            if 'serial' not in (x[1] for x in
+                                db.execute("PRAGMA table_info(cert)")):
+                self._migrateCertTable(db)
+            for x in 'email', 'serial', 'subject_serial', 'not_after':
+                db.execute("CREATE INDEX IF NOT EXISTS cert_%s ON cert(%s)"
+                           % (x, x))
         if not self.db.execute("SELECT 1 FROM cert LIMIT 1").fetchone():
             logging.debug("No existing certs found; creating an unallocated cert")
-            self.db.execute("INSERT INTO cert VALUES ('',null,null)")
+            self.db.execute("INSERT INTO cert (prefix) VALUES ('')")
 
         prev = '-'
         for community in sorted(self.community_map):
@@ -135,13 +370,18 @@ class RegistryServer:
         self.cert = x509.Cert(self.config.ca, self.config.key)
         # Get vpn network prefix
         self.network = self.cert.network
-        logging.info("Network: %s/%u", utils.ipFromBin(self.network),
-                                       len(self.network))
+        self.prefix_allocator = PrefixAllocator(self.community_map,
+                                                128 - len(self.network))
+        with self.transaction() as db:
+            self.prefix_allocator.load(db)
+        logging.info("Network: %s/%u", self.network.ip(), len(self.network))
         self.email = self.cert.ca.get_subject().emailAddress
 
-        self.peers_lock = threading.Lock()
+        self.peers_lock = self._timedLock(threading.Lock(), 'peers_lock')
+        # babeld is only queried by request_dump, in its own loop.
+        self._routing_reactor = utils.Reactor()
         self.routing = routing.Babel(os.path.join(config.run, 'babeld.sock'),
-            weakref.proxy(self), self.network)
+            weakref.proxy(self), self.network, self._routing_reactor)
 
         self.geoip_db = os.getenv('GEOIP2_MMDB')
         if self.geoip_db:
@@ -165,10 +405,124 @@ class RegistryServer:
         else:
             self.newHMAC(0)
 
+    @property
+    def db(self) -> sqlite3.Connection:
+        """Connection to the database for the current thread"""
+        try:
+            return self._local.db
+        except AttributeError:
+            # It is closed when the thread exits.
+            db = self._local.db = sqlite3.connect(self.config.db,
+                isolation_level=None, check_same_thread=False,
+                factory=TimedConnection)
+            db.text_factory = str
+            db.observe = partial(self._sqlite_seconds.observe, db='main')
+            return db
+
+    def _initMetrics(self):
+        self._request_seconds = Histogram("re6st_registry_request_seconds",
+            "Time to handle requests, by RPC and HTTP status",
+            (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+        self._lock_wait = Counter("re6st_registry_lock_wait_seconds_total",
+            "Time spent waiting for locks that were not free")
+        self._lock_contended = Counter("re6st_registry_lock_contended_total",
+            "Number of times a lock was not free")
+        self._sqlite_seconds = Histogram("re6st_registry_sqlite_seconds",
+            "Time spent executing SQLite statements",
+            (1e-5, 1e-4, .001, .01, .1, 1))
+        self._address_queries = Counter(
+            "re6st_registry_address_queries_total",
+            "Addresses queried to nodes (for getBootstrapPeer and"
+            " getIPv4Information), by result")
+        q = lambda sql: lambda: self.db.execute(sql).fetchone()[0]
+        self.metric_list = [
+            self._request_seconds,
+            self._lock_wait,
+            self._lock_contended,
+            self._sqlite_seconds,
+            self._address_queries,
+            Gauge("re6st_registry_sessions",
+                  "Sessions, in memory and in the database",
+                  self._sessionCount),
+            Gauge("re6st_registry_certificates", "Certificates",
+                  q("SELECT count(*) FROM cert WHERE serial IS NOT NULL")),
+            Gauge("re6st_registry_crl", "Revoked certificates",
+                  q("SELECT count(*) FROM crl")),
+            Gauge("re6st_registry_free_prefix_space",
+                  "Free space for prefixes of maximum length, by community",
+                  lambda: self._prefixStats('space')),
+            Gauge("re6st_registry_prefix_fragmentation",
+                  "Ratio of free space outside the largest free prefix",
+                  lambda: self._prefixStats('fragmentation')),
+        ]
+
+    def _timedLock(self, lock, name: str) -> TimedLock:
+        return TimedLock(lock, self._lock_wait, self._lock_contended,
+                         lock=name)
+
+    def _sessionCount(self) -> dict:
+        with self.sessions_lock:
+            return {(('where', 'memory'),): len(self.sessions),
+                    (('where', 'database'),): self._session_db.execute(
+                        "SELECT count(*) FROM session").fetchone()[0]}
+
+    def _prefixStats(self, key: str) -> dict:
+        with self.lock:
+            stats = self.prefix_allocator.stats()
+        return {(('community', '*' if k is None else k),): v[key]
+                for k, v in stats.items()}
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction, serialized with other writers"""
+        with self.lock:
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                with db:
+                    yield db
+            except BaseException:
+                allocator = self.prefix_allocator
+                if allocator and allocator.dirty:
+                    # Changes to the database have been rolled back.
+                    allocator.load(db)
+                raise
+            else:
+                if self.prefix_allocator:
+                    self.prefix_allocator.dirty = False
+
+    def _migrateCertTable(self, db: sqlite3.Connection):
+        exists = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='cert'"
+            ).fetchone()
+        if exists:
+            logging.info("Extracting certificate metadata to indexed columns")
+            db.execute("ALTER TABLE cert RENAME TO cert_old")
+        utils.sqliteCreateTable(db, "cert", *CERT_COLUMNS)
+        if exists:
+            for prefix, email, cert in db.execute("SELECT * FROM cert_old"):
+                try:
+                    columns = certColumns(crypto.load_certificate(
+                        crypto.FILETYPE_PEM, cert))
+                except (crypto.Error, TypeError): # free or reserved prefix
+                    columns = None, None, None
+                db.execute("INSERT INTO cert VALUES (?,?,?,?,?,?)",
+                           (prefix, email, cert) + columns)
+            db.execute("DROP TABLE cert_old")
+
     def close(self):
+        try:
+            # Wake up the receiver thread.
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError: # not connected, but still effective
+            pass
+        self._receiver.join()
         self.sock.close()
+        self._scheduler.cancel(self._purgeSessions)
+        self._session_db.close()
         self.db.close()
         self.routing.close()
+        self._routing_reactor.close()
 
     def getConfig(self, name, *default):
         r, = next(self.db.execute(
@@ -186,7 +540,7 @@ class RegistryServer:
             'crl': list(map(_it0, self.db.execute(
                 "SELECT serial FROM crl ORDER BY serial"))),
             'protocol': version.protocol,
-            'registry_prefix': self.prefix,
+            'registry_prefix': str(self.prefix),
         }
         if self.config.ipv4:
             kw['ipv4'], kw['ipv4_sublen'] = self.config.ipv4
@@ -213,38 +567,96 @@ class RegistryServer:
         x = utils.packInteger(1 + utils.unpackInteger(self.version)[0])
         self.version = x + self.cert.sign(x)
 
-    def sendto(self, prefix: str, code: int):
-        self.sock.sendto(prefix.encode() + bytes((0, code)),
+    def sendto(self, prefix: utils.Prefix, code: int):
+        self.sock.sendto(str(prefix).encode() + bytes((0, code)),
                          ('::1', tunnel.PORT))
 
-    def recv(self, code: int) -> tuple[str, str] | tuple[None, None]:
+    def decodeReply(self, data: bytes) \
+            -> tuple[utils.Prefix, int, str] | tuple[None, None, None]:
         try:
-            prefix, msg = self.sock.recv(1 << 16).split(b'\0', 1)
-            int(prefix, 2)
+            prefix, msg = data.split(b'\0', 1)
+            prefix = utils.Prefix.fromBin(prefix.decode())
         except ValueError:
             pass
         else:
-            if len(msg) >= 1 and msg[0] == code:
-                return prefix.decode(), msg[1:].decode()
-            logging.error("Invalid message or unexpected code: %r", msg)
-        return None, None
+            if msg:
+                return prefix, msg[0], msg[1:].decode()
+            logging.error("Invalid message: %r", data)
+        return None, None, None
 
-    def select(self, r, w, t):
-        if self.timeout:
-            t.append((self.timeout, self.onTimeout))
+    def _receive(self):
+        sock = self.sock
+        while True:
+            try:
+                data = sock.recv(1 << 16)
+            except OSError:
+                break
+            if not data:
+                break # closed
+            self.dispatch(*self.decodeReply(data))
+
+    def dispatch(self, prefix: utils.Prefix, code: int, msg: str):
+        if prefix is None:
+            return
+        with self._reply_lock:
+            future = self._reply_dict.pop((prefix, code), None)
+            collectors = self._collector_dict.get(code, ())
+            for q in collectors:
+                q.put((prefix, msg))
+        if future is not None:
+            future.set_result(msg)
+        elif not collectors:
+            logging.info("Unexpected reply from %s (code %u): %r",
+                         prefix.subnet, code, msg)
+
+    def query(self, prefix: utils.Prefix, code: int) -> str | None:
+        """Send a request to a node and wait for its reply
+
+        Concurrent queries with the same prefix and code share the same
+        request.
+        """
+        key = prefix, code
+        with self._reply_lock:
+            future = self._reply_dict.get(key)
+            send = future is None
+            if send:
+                future = self._reply_dict[key] = Future()
+        if send:
+            self.sendto(prefix, code)
+        try:
+            return future.result(self.reply_timeout)
+        except TimeoutError:
+            with self._reply_lock:
+                if self._reply_dict.get(key) is future:
+                    del self._reply_dict[key]
+
+    @contextmanager
+    def collect(self, code: int):
+        """Queue all replies of the given code, as (prefix, msg) tuples"""
+        q = queue.SimpleQueue()
+        with self._reply_lock:
+            self._collector_dict[code].append(q)
+        try:
+            yield q
+        finally:
+            with self._reply_lock:
+                collectors = self._collector_dict[code]
+                collectors.remove(q)
+                if not collectors:
+                    del self._collector_dict[code]
 
     def request_dump(self):
         assert self.peers_lock.locked()
         def abort():
             raise routing.BabelException
         self._wait_dump = True
+        reactor = self._routing_reactor
         for _ in 0, 1:
             self.routing.request_dump()
             try:
                 while self._wait_dump:
-                    args = {}, {}, ((time.time() + 5, abort),)
-                    self.routing.select(*args)
-                    utils.select(*args)
+                    reactor.schedule(time.time() + 5, abort)
+                    reactor.select()
                 break
             except routing.BabelException:
                 self.routing.reset()
@@ -252,15 +664,25 @@ class RegistryServer:
     def babel_dump(self):
         self._wait_dump = False
 
-    def iterCert(self) -> Iterator[Tuple[crypto.X509, str, str]]:
+    def iterCert(self) -> Iterator[Tuple[crypto.X509, utils.Prefix, str]]:
         for prefix, email, cert in self.db.execute(
-                "SELECT * FROM cert WHERE cert IS NOT NULL"):
+                "SELECT prefix, email, cert FROM cert"
+                " WHERE cert IS NOT NULL"):
             try:
                 yield (crypto.load_certificate(crypto.FILETYPE_PEM, cert),
-                       prefix, email)
+                       utils.Prefix.fromBin(prefix), email)
             except crypto.Error:
                 pass
 
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self._scheduler.schedule(value or None, self.onTimeout)
+
     def onTimeout(self):
         # XXX: Because we use threads to process requests, the statements
         #      'self.timeout = 1' below have no effect as long as the
@@ -268,51 +690,66 @@ class RegistryServer:
         logging.info("Checking if there's any old entry in the database ...")
         not_after = None
         old = time.time() - self.config.grace_period
-        q =  self.db.execute
-        with self.lock, self.db:
-            q("BEGIN")
+        with self.transaction() as db:
+            q = db.execute
             for token, x in q("SELECT token, date FROM token"):
                 if x <= old:
                     q("DELETE FROM token WHERE token=?", (token,))
                 elif not_after is None or x < not_after:
                     not_after = x
-            for cert, prefix, email in self.iterCert():
-                x = x509.notAfter(cert)
-                if x <= old:
-                    if prefix == self.prefix:
-                        logging.critical(
-                            "Refuse to delete certificate of main node:"
-                            " wrong clock ? Alternatively, the database"
-                            " might be in an inconsistent state.")
-                        sys.exit(1)
-                    logging.info("Delete %s: %s (invalid since %s)",
-                        "certificate requested by '%s'" % email
-                        if email else "anonymous certificate",
-                        ", ".join("%s=%s" % x for x in
-                                  cert.get_subject().get_components()),
-                        datetime.utcfromtimestamp(x).isoformat())
-                    q("UPDATE cert SET email=null, cert=null WHERE prefix=?",
-                      (prefix,))
-                elif not_after is None or x < not_after:
-                    not_after = x
-            self.mergePrefixes()
+            for prefix, email, cert, x in q(
+                    "SELECT prefix, email, cert, not_after FROM cert"
+                    " WHERE not_after <= ?", (old,)).fetchall():
+                if prefix == str(self.prefix):
+                    logging.critical(
+                        "Refuse to delete certificate of main node:"
+                        " wrong clock ? Alternatively, the database"
+                        " might be in an inconsistent state.")
+                    sys.exit(1)
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+                logging.info("Delete %s: %s (invalid since %s)",
+                    "certificate requested by '%s'" % email
+                    if email else "anonymous certificate",
+                    ", ".join("%s=%s" % x for x in
+                              cert.get_subject().get_components()),
+                    datetime.utcfromtimestamp(x).isoformat())
+                q("UPDATE cert SET email=null, cert=null, serial=null,"
+                  " subject_serial=null, not_after=null WHERE prefix=?",
+                  (prefix,))
+                self.prefix_allocator.free(db, prefix)
+                self._dropNode(prefix)
+            x, = q("SELECT min(not_after) FROM cert").fetchone()
+            if x is not None and (not_after is None or x < not_after):
+                not_after = x
             self.timeout = not_after and not_after + self.config.grace_period
 
     def handle_request(self, request, method, kw):
         m = getattr(self, method)
+        m.getcallargs # reject non-RPC methods
+        t = time.perf_counter()
+        status = HTTPStatus.BAD_REQUEST
+        try:
+            status = self._handleRequest(request, m, method, kw)
+        finally:
+            self._request_seconds.observe(time.perf_counter() - t,
+                                          method=method, status=int(status))
+
+    def _handleRequest(self, request, m, method: str, kw) -> HTTPStatus:
         if hasattr(m, '_private'):
             authorized_origin =  self.config.authorized_origin
             x_forwarded_for = request.headers.get('X-Forwarded-For')
             if request.client_address[0] not in authorized_origin or \
                x_forwarded_for and x_forwarded_for not in authorized_origin:
-                return request.send_error(HTTPStatus.FORBIDDEN)
-        key = m.getcallargs(**kw).get('cn')
+                request.send_error(HTTPStatus.FORBIDDEN)
+                return HTTPStatus.FORBIDDEN
+        cn = key = m.getcallargs(**kw).get('cn')
         if key:
             h = base64.b64decode(request.headers[HMAC_HEADER])
-            with self.lock:
-                session = self.sessions.get(key)
-                if session is None: # common after a restart on the registry
-                    return request.send_error(HTTPStatus.UNAUTHORIZED)
+            with self.sessions_lock:
+                session = self._getSession(cn)
+                if session is None: # the node left or was idle for too long
+                    request.send_error(HTTPStatus.UNAUTHORIZED)
+                    return HTTPStatus.UNAUTHORIZED
                 for key, protocol in session:
                     if h == hmac.HMAC(key, request.path.encode(), hashlib.sha1
                                       ).digest():
@@ -321,12 +758,12 @@ class RegistryServer:
                     raise Exception("Wrong HMAC")
                 key = hashlib.sha1(key).digest()
                 session[:] = (hashlib.sha1(key).digest(), protocol),
+                self._saveSession(cn, session)
         else:
             logging.info("%s%s: %s, %s",
                 method,
-                '(' + utils.ipFromBin(x509.networkFromCa(self.cert.ca)
-                                      + kw["client_prefix"])
-                + ')' if method == 'hello' else '',
+                '(%s)' % (self.network + utils.Prefix.fromBin(
+                    kw["client_prefix"])).ip() if method == 'hello' else '',
                 request.headers.get("X-Forwarded-For") or
                 request.headers.get("host"),
                 request.headers.get("user-agent"))
@@ -336,41 +773,103 @@ class RegistryServer:
         try:
             result = m(**kw)
         except HTTPError as e:
-            return request.send_error(*e.args)
+            request.send_error(*e.args)
+            return e.args[0]
         except:
             logging.warning(request.requestline, exc_info=True)
-            return request.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
-        if result:
+            request.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+            return HTTPStatus.INTERNAL_SERVER_ERROR
+        etag = getattr(result, 'etag', None)
+        if etag and etag == request.headers.get("If-None-Match"):
+            result = b''
+            status = HTTPStatus.NOT_MODIFIED
+        elif result:
             if type(result) is str:
                 result = result.encode("utf-8")
-            request.send_response(HTTPStatus.OK)
-            request.send_header("Content-Length", str(len(result)))
+            status = HTTPStatus.OK
         else:
-            request.send_response(HTTPStatus.NO_CONTENT)
+            status = HTTPStatus.NO_CONTENT
+        request.send_response(status)
+        if status == HTTPStatus.OK:
+            request.send_header("Content-Length", str(len(result)))
+        if etag:
+            request.send_header("ETag", etag)
         if key:
             request.send_header(HMAC_HEADER, base64.b64encode(
                 hmac.HMAC(key, result, hashlib.sha1).digest()).decode("ascii"))
         request.end_headers()
         if result:
             request.wfile.write(result)
+        return status
+
+    def _getSession(self, prefix: str, default: list | None=None
+                    ) -> list[tuple[bytes, int]] | None:
+        # sessions_lock must be held.
+        sessions = self.sessions
+        try:
+            sessions.move_to_end(prefix)
+            return sessions[prefix]
+        except KeyError:
+            pass
+        x = self._session_db.execute(
+            "SELECT key0, protocol0, key1, protocol1 FROM session"
+            " WHERE prefix=?", (prefix,)).fetchone()
+        if x:
+            default = [x[i:i+2] for i in (0, 2) if x[i] is not None]
+        elif default is None:
+            return
+        sessions[prefix] = default
+        if len(sessions) > self.session_cache_size:
+            sessions.popitem(False)
+        return default
+
+    def _saveSession(self, prefix: str, session: list[tuple[bytes, int]]):
+        # sessions_lock must be held.
+        x = [None] * 4
+        for i, y in enumerate(session):
+            if y:
+                x[2*i:2*i+2] = y
+        self._session_db.execute(
+            "INSERT OR REPLACE INTO session VALUES (?,?,?,?,?,?)",
+            (prefix, *x, int(time.time())))
+
+    def _dropNode(self, prefix: str):
+        with self.sessions_lock:
+            self.sessions.pop(prefix, None)
+            self._session_db.execute("DELETE FROM session WHERE prefix=?",
+                                     (prefix,))
+        with self._network_config_lock:
+            self._network_config_dict.pop(prefix, None)
+
+    def _purgeSessions(self):
+        old = time.time() - self.session_timeout
+        with self.sessions_lock:
+            q = self._session_db.execute
+            for prefix, in q("SELECT prefix FROM session WHERE last_used < ?",
+                             (old,)).fetchall():
+                self.sessions.pop(prefix, None)
+            q("DELETE FROM session WHERE last_used < ?", (old,))
+        self._scheduler.schedule(time.time() + 3600, self._purgeSessions)
 
     def getPeerProtocol(self, cn: str) -> int:
-        session, = self.sessions[cn]
+        with self.sessions_lock:
+            session, = self._getSession(cn)
         return session[1]
 
     @rpc
     def hello(self, client_prefix: str, protocol='1') -> bytes:
-        with self.lock:
-            cert = self.getCert(client_prefix)
-            key = utils.newHmacSecret()
-            self.sessions.setdefault(client_prefix, [])[1:] = (key, int(protocol)),
+        cert = self.getCert(client_prefix)
+        key = utils.newHmacSecret()
+        with self.sessions_lock:
+            session = self._getSession(client_prefix, [])
+            session[1:] = (key, int(protocol)),
+            self._saveSession(client_prefix, session)
         key = x509.encrypt(x509.load_pem_x509_certificate(cert), key)
         sign = self.cert.sign(key)
         assert len(key) == len(sign)
         return key + sign
 
     def getCert(self, client_prefix: str) -> bytes:
-        assert self.lock.locked()
         cert = self.db.execute("SELECT cert FROM cert"
                                " WHERE prefix=? AND cert IS NOT NULL",
                                (client_prefix,)).fetchone()
@@ -381,10 +880,9 @@ class RegistryServer:
 
     @rpc_private
     def isToken(self, token: str):
-        with self.lock:
-            if self.db.execute("SELECT 1 FROM token WHERE token = ?",
-                               (token,)).fetchone():
-                return b"1"
+        if self.db.execute("SELECT 1 FROM token WHERE token = ?",
+                           (token,)).fetchone():
+            return b"1"
 
     @rpc_private
     def deleteToken(self, token: str):
@@ -414,6 +912,7 @@ class RegistryServer:
         if request:
             return token
 
+    @blocking
     @rpc
     def requestToken(self, email):
         if not self.config.mailhost:
@@ -457,119 +956,59 @@ class RegistryServer:
                 default = prefix
         return default
 
-    def mergePrefixes(self):
-        logging.debug("Merging prefixes")
-        q = self.db.execute
-        prev_prefix = None
-        max_len = 128,
-        while True:
-            max_len = q("SELECT max(length(prefix)) FROM cert"
-                        " WHERE cert is null AND length(prefix) < ?",
-                        max_len).fetchone()
-            if not max_len[0]:
-                break
-            for prefix, in q("SELECT prefix FROM cert"
-                             " WHERE cert is null AND length(prefix) = ?"
-                             " ORDER BY prefix",
-                             max_len):
-                if prev_prefix and prefix[:-1] == prev_prefix[:-1]:
-                    q("UPDATE cert SET prefix = ? WHERE prefix = ?",
-                      (prefix[:-1], prev_prefix))
-                    q("DELETE FROM cert WHERE prefix = ?", (prefix,))
-                    prev_prefix = None
-                else:
-                    prev_prefix = prefix
-
-    def newPrefix(self, prefix_len, community):
+    def newPrefix(self, prefix_len: int, community: str) -> str:
         logging.info("Allocating /%u prefix for %s", prefix_len, community)
-        community_len = len(community)
-        prefix_len += community_len
-        max_len = 128 - len(self.network)
-        assert 0 < prefix_len <= max_len
-        q = self.db.execute
-        while True:
-            try:
-                # Find longest free prefix whithin community.
-                prefix, = next(q(
-                    "SELECT prefix FROM cert"
-                    " WHERE prefix LIKE ?"
-                    "   AND length(prefix) <= ? AND cert is null"
-                    " ORDER BY length(prefix) DESC",
-                    (community + '%', prefix_len)))
-            except StopIteration:
-                # Community not yet allocated?
-                # There should be exactly 1 row whose
-                # prefix is the beginning of community.
-                prefix, x = next(q("SELECT prefix, cert FROM cert"
-                              " WHERE substr(?,1,length(prefix)) = prefix",
-                              (community,)))
-                if x is not None:
-                    logging.error('No more free /%u prefix available',
-                                  prefix_len)
-                    raise
-            # Split the tree until prefix has wanted length.
-            for x in range(len(prefix), prefix_len):
-                # Prefix starts with community, then we complete with 0.
-                x = community[x] if x < community_len else '0'
-                q("UPDATE cert SET prefix = ? WHERE prefix = ?",
-                  (prefix + str(1-int(x)), prefix))
-                prefix += x
-                q("INSERT INTO cert VALUES (?,null,null)", (prefix,))
-            if len(prefix) < max_len or '1' in prefix[community_len:]:
-                return prefix
-            q("UPDATE cert SET cert = 'reserved' WHERE prefix = ?", (prefix,))
+        return self.prefix_allocator.allocate(self.db, prefix_len, community)
 
+    @blocking
     @rpc
     def requestCertificate(self, token: str | None, req: bytes,
                            location: str='', ip: str=''):
         logging.debug("Requesting certificate with token %s", token)
         req = crypto.load_certificate_request(crypto.FILETYPE_PEM, req)
-        with self.lock:
-            with self.db:
-                if token:
-                    if not self.config.prefix_length:
-                        raise HTTPError(HTTPStatus.FORBIDDEN)
-                    try:
-                        token, email, prefix_len, _ = next(self.db.execute(
-                            "SELECT * FROM token WHERE token = ?",
-                            (token,)))
-                    except StopIteration:
-                        return
-                    self.db.execute("DELETE FROM token WHERE token = ?",
-                                    (token,))
-                else:
-                    prefix_len = self.config.anonymous_prefix_length
-                    if not prefix_len:
-                        raise HTTPError(HTTPStatus.FORBIDDEN)
-                    email = None
-                country, continent = '*', '*'
-                if self.geoip_db:
-                    country, continent = location.split(',') if location else self._geoiplookup(ip)
-                    if continent != '*':
-                        continent = '@' + continent
-                prefix = self.newPrefix(prefix_len, self.getCommunity(country, continent))
-                self.db.execute("UPDATE cert SET email = ? WHERE prefix = ?",
-                                (email, prefix))
-                if self.prefix is None:
-                    self.prefix = prefix
-                    self.setConfig('prefix', prefix)
-                    self.updateNetworkConfig()
-                subject = req.get_subject()
-                subject.serialNumber = str(self.getSubjectSerial())
-                return self.createCertificate(prefix, subject, req.get_pubkey())
+        if not (self.config.prefix_length if token else
+                self.config.anonymous_prefix_length):
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+        country, continent = '*', '*'
+        if self.geoip_db:
+            country, continent = location.split(',') if location else self._geoiplookup(ip)
+            if continent != '*':
+                continent = '@' + continent
+        community = self.getCommunity(country, continent)
+        # Keep the transaction as short as possible.
+        with self.transaction() as db:
+            if token:
+                try:
+                    token, email, prefix_len, _ = next(db.execute(
+                        "SELECT * FROM token WHERE token = ?", (token,)))
+                except StopIteration:
+                    return
+                db.execute("DELETE FROM token WHERE token = ?", (token,))
+            else:
+                prefix_len = self.config.anonymous_prefix_length
+                email = None
+            prefix = self.newPrefix(prefix_len, community)
+            db.execute("UPDATE cert SET email = ? WHERE prefix = ?",
+                       (email, prefix))
+            if self.prefix is None:
+                self.prefix = utils.Prefix.fromBin(prefix)
+                self.setConfig('prefix', prefix)
+                self.updateNetworkConfig()
+            subject = req.get_subject()
+            subject.serialNumber = str(self.getSubjectSerial())
+            return self.createCertificate(prefix, subject, req.get_pubkey())
 
     def getSubjectSerial(self):
         # Smallest unique number, for IPv4 support.
-        serials = []
-        for x in self.iterCert():
-            serial = x[0].get_subject().serialNumber
-            if serial:
-                serials.append(int(serial))
-        serials.sort()
-        for serial, x in enumerate(serials):
-            if serial != x:
-                return serial
-        return len(serials)
+        q = self.db.execute
+        if not q("SELECT 1 FROM cert WHERE subject_serial=0").fetchone():
+            return 0
+        # Walk the index until the first gap.
+        serial, = q("SELECT subject_serial+1 FROM cert AS x"
+                    " WHERE subject_serial >= 0 AND NOT EXISTS (SELECT 1"
+                    "  FROM cert WHERE subject_serial=x.subject_serial+1)"
+                    " ORDER BY subject_serial LIMIT 1").fetchone()
+        return serial
 
     def createCertificate(self, client_prefix, subject, pubkey, not_after=None):
         cert = crypto.X509()
@@ -588,71 +1027,126 @@ class RegistryServer:
         self.setConfig('serial', serial)
         cert.set_serial_number(serial)
         cert.sign(self.cert.key, 'sha512')
+        columns = certColumns(cert)
         cert = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-        self.db.execute("UPDATE cert SET cert = ? WHERE prefix = ?",
-                        (cert.decode(), client_prefix))
+        self.db.execute("UPDATE cert SET cert=?, serial=?, subject_serial=?,"
+                        " not_after=? WHERE prefix=?",
+                        (cert.decode(),) + columns + (client_prefix,))
         self.timeout = 1
         return cert
 
+    @blocking
     @rpc
     def renewCertificate(self, cn: str) -> bytes:
-        with self.lock:
-            with self.db as db:
-                pem = self.getCert(cn)
-                cert = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
-                if x509.notAfter(cert) - RENEW_PERIOD < time.time():
-                    not_after = None
-                elif db.execute("SELECT count(*) FROM crl WHERE serial=?",
-                                (cert.get_serial_number(),)).fetchone()[0]:
-                    not_after = cert.get_notAfter()
-                else:
-                    return pem
-                return self.createCertificate(cn,
-                    cert.get_subject(), cert.get_pubkey(), not_after)
+        pem = self.getCert(cn)
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+        if x509.notAfter(cert) - RENEW_PERIOD < time.time():
+            not_after = None
+        elif self.db.execute("SELECT count(*) FROM crl WHERE serial=?",
+                             (cert.get_serial_number(),)).fetchone()[0]:
+            not_after = cert.get_notAfter()
+        else:
+            return pem
+        with self.transaction():
+            # It may have been renewed meanwhile.
+            x = self.getCert(cn)
+            if x != pem:
+                return x
+            return self.createCertificate(cn,
+                cert.get_subject(), cert.get_pubkey(), not_after)
 
     @rpc
     def getCa(self) -> bytes:
-        return crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert.ca)
+        ca = self._ca
+        if ca is None:
+            ca = self._ca = Entity(
+                crypto.dump_certificate(crypto.FILETYPE_PEM, self.cert.ca))
+        return ca
 
     @rpc
     def getDh(self, cn: str) -> bytes:
-        with open(self.config.dh, "rb") as f:
-            return f.read()
+        st = os.stat(self.config.dh)
+        key = st.st_ino, st.st_size, st.st_mtime_ns
+        dh = self._dh
+        if dh is None or dh[0] != key:
+            with open(self.config.dh, "rb") as f:
+                dh = self._dh = key, Entity(f.read())
+        return dh[1]
+
+    @property
+    def network_config(self) -> dict:
+        return self._network_config[0]
+
+    @network_config.setter
+    def network_config(self, config: dict):
+        # Published with the HMAC keys, and the compressed JSON of all
+        # other values. getNetworkConfig only has to complete the zlib
+        # stream with the keys encrypted for the node.
+        hmac = dict(self.db.execute(
+            "SELECT name, value FROM config WHERE name IN (?,?,?)",
+            BABEL_HMAC))
+        hmac = [hmac[k] for k in BABEL_HMAC if k in hmac]
+        z = zlib.compressobj()
+        data = json.dumps(config)
+        assert data[-1] == '}', data
+        data = z.compress(data[:-1].encode()) + z.flush(zlib.Z_SYNC_FLUSH)
+        self._network_config = config, hmac, z, data
+        with self._network_config_lock:
+            self._network_config_dict = OrderedDict()
 
     @rpc
     def getNetworkConfig(self, cn: str) -> bytes:
-        with self.lock:
-            cert = self.getCert(cn)
-            config = self.network_config.copy()
-            hmac = [self.getConfig(k, None) for k in BABEL_HMAC]
-            for i, v in enumerate(v for v in hmac if v is not None):
-                config[('babel_hmac_sign', 'babel_hmac_accept')[i]] = \
-                    v and base64.b64encode(x509.encrypt(
-                        x509.load_pem_x509_certificate(cert), v)).decode()
-        return zlib.compress(json.dumps(config).encode("utf-8"))
-
-    def _queryAddress(self, peer: str) -> str:
-        logging.info("Querying address for %s/%s %r",
-                     int(peer, 2), len(peer), peer)
-        self.sendto(peer, 1)
-        s = self.sock,
-        timeout = 3
-        end = timeout + time.time()
-        # Loop because there may be answers from previous requests.
-        while select.select(s, (), (), timeout)[0]:
-            prefix, msg = self.recv(1)
-            logging.info("* received: %r - %r", prefix, msg)
-            if prefix == peer:
-                return msg
-            timeout = max(0, end - time.time())
-        logging.info("Timeout while querying address for %s/%s",
-                     int(peer, 2), len(peer))
+        cert = self.getCert(cn)
+        network_config = self._network_config
+        with self._network_config_lock:
+            try:
+                x, pem, result = self._network_config_dict[cn]
+            except KeyError:
+                pass
+            else:
+                if x is network_config and pem == cert:
+                    self._network_config_dict.move_to_end(cn)
+                    return result
+        config, hmac, z, data = network_config
+        data = [data]
+        z = z.copy()
+        x = x509.load_pem_x509_certificate(cert)
+        for k, v in zip(('babel_hmac_sign', 'babel_hmac_accept'), hmac):
+            if v:
+                v = base64.b64encode(x509.encrypt(x, v)).decode()
+            elif v is not None:
+                v = ''
+            data.append(z.compress(
+                (', "%s": %s' % (k, json.dumps(v))).encode()))
+        data.append(z.compress(b'}'))
+        data.append(z.flush())
+        result = Entity(b''.join(data), hashlib.sha1(
+            config['version'].encode() + cert).hexdigest())
+        # Encrypted keys are reused until the network configuration
+        # or the certificate of the node changes.
+        with self._network_config_lock:
+            d = self._network_config_dict
+            if self._network_config is network_config: # not replaced
+                d[cn] = network_config, cert, result
+                d.move_to_end(cn)
+                if len(d) > self.network_config_cache_size:
+                    d.popitem(False)
+        return result
+
+    def _queryAddress(self, peer: utils.Prefix) -> str | None:
+        logging.info("Querying address for %s %s", peer.subnet, peer)
+        msg = self.query(peer, 1)
+        if msg is None:
+            logging.info("Timeout while querying address for %s", peer.subnet)
+        self._address_queries.inc(result='ok' if msg else 'timeout')
+        return msg
 
     @rpc
     def getCountry(self, cn: str, address: str) -> str | None:
         country = self._geoiplookup(address)[0]
         return None if country == '*' else country
 
+    @blocking
     @rpc
     def getBootstrapPeer(self, cn: str) -> bytes | None:
         logging.info("Answering bootstrap peer for %s", cn)
@@ -669,43 +1163,46 @@ class RegistryServer:
                 self.peers = time.time() + 60, peers
             logging.debug("peers: %r", peers)
             peer = peers.pop()
-            if peer == cn:
+            if str(peer) == cn:
                 # Very unlikely (e.g. peer restarted with empty cache),
                 # so don't bother looping over above code
                 # (in case 'peers' is empty).
                 peer = self.prefix
-        with self.lock:
-            msg = self._queryAddress(peer)
-            if msg is None:
-                logging.info("No address for %s, returning None", peer)
-                return
-            # Remove country for old nodes
-            if self.getPeerProtocol(cn) < 7:
-                msg = ';'.join(','.join(a.split(',')[:3])
-                               for a in msg.split(';'))
-            cert = self.getCert(cn)
+        # Do not hold the lock while waiting for the reply.
+        msg = self._queryAddress(peer)
+        if msg is None:
+            logging.info("No address for %s, returning None", peer)
+            return
+        # Remove country for old nodes
+        if self.getPeerProtocol(cn) < 7:
+            msg = ';'.join(','.join(a.split(',')[:3])
+                           for a in msg.split(';'))
+        cert = self.getCert(cn)
         msg = "%s %s" % (peer, msg)
         logging.info("Sending bootstrap peer: %s", msg)
         return x509.encrypt(x509.load_pem_x509_certificate(cert), msg.encode())
 
+    @blocking
     @rpc_private
     def revoke(self, cn_or_serial: int | str):
-        with self.lock, self.db:
-            q = self.db.execute
+        with self.transaction() as db:
+            q = db.execute
             try:
                 serial = int(cn_or_serial)
             except ValueError:
-                prefix = utils.binFromSubnet(cn_or_serial)
-                cert = self.getCert(prefix)
-                q("UPDATE cert SET email=null, cert=null WHERE prefix=?",
+                prefix = str(utils.Prefix.fromSubnet(cn_or_serial))
+                self.getCert(prefix) # check that it exists
+                serial, not_after = q(
+                    "SELECT serial, not_after FROM cert WHERE prefix=?",
+                    (prefix,)).fetchone()
+                q("UPDATE cert SET email=null, cert=null, serial=null,"
+                  " subject_serial=null, not_after=null WHERE prefix=?",
                   (prefix,))
-                cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
-                serial = cert.get_serial_number()
-                self.sessions.pop(prefix, None)
+                self.prefix_allocator.free(db, prefix)
+                self._dropNode(prefix)
             else:
-                cert, = (cert for cert, prefix, email in self.iterCert()
-                              if cert.get_serial_number() == serial)
-            not_after = x509.notAfter(cert)
+                (not_after,), = q("SELECT not_after FROM cert WHERE serial=?",
+                                  (serial,))
             if time.time() < not_after:
                 q("INSERT INTO crl VALUES (?,?)", (serial, not_after))
                 self.updateNetworkConfig()
@@ -715,47 +1212,48 @@ class RegistryServer:
           key = os.urandom(16)
        self.setConfig(BABEL_HMAC[i], key)
 
+    @blocking
     @rpc_private
     def updateHMAC(self):
-        with self.lock, self.db:
-            hmac = [self.getConfig(x, None) for x in BABEL_HMAC]
-            valid_until = None
-            if hmac[0]:
-                if hmac[1]:
-                    self.newHMAC(2, hmac[0])
-                    self.setConfig(BABEL_HMAC[0])
+        with self.lock:
+            config = self.network_config.copy()
+            with self.transaction():
+                hmac = [self.getConfig(x, None) for x in BABEL_HMAC]
+                valid_until = None
+                if hmac[0]:
+                    if hmac[1]:
+                        self.newHMAC(2, hmac[0])
+                        self.setConfig(BABEL_HMAC[0])
+                    else:
+                        self.newHMAC(1)
+                        valid_until = time.time() + NETCONF_TEMP
+                elif hmac[1]:
+                    self.newHMAC(0, hmac[1])
+                    self.setConfig(BABEL_HMAC[1])
+                    self.setConfig(BABEL_HMAC[2])
                 else:
+                    # Initialization of HMAC on the network
                     self.newHMAC(1)
-                    valid_until = time.time() + NETCONF_TEMP
-            elif hmac[1]:
-                self.newHMAC(0, hmac[1])
-                self.setConfig(BABEL_HMAC[1])
-                self.setConfig(BABEL_HMAC[2])
-            else:
-                # Initialization of HMAC on the network
-                self.newHMAC(1)
-                self.newHMAC(2, b'')
-            if valid_until is None:
-                self.network_config.pop('valid_until', None)
-                self.setConfig('valid_until')
-            else:
-                self.network_config['valid_until'] = valid_until
-                self.setConfig('valid_until', valid_until)
-            self.increaseVersion()
-            self.setConfig('version', self.version)
-            self.network_config['version'] = \
-                base64.b64encode(self.version).decode()
+                    self.newHMAC(2, b'')
+                if valid_until is None:
+                    config.pop('valid_until', None)
+                    self.setConfig('valid_until')
+                else:
+                    config['valid_until'] = valid_until
+                    self.setConfig('valid_until', valid_until)
+                self.increaseVersion()
+                self.setConfig('version', self.version)
+                config['version'] = base64.b64encode(self.version).decode()
+            self.network_config = config
         self.sendto(self.prefix, 0)
 
     @rpc_private
     def getNodePrefix(self, email: str) -> str | None:
-        with self.lock, self.db:
-            try:
-                cert, = next(
-                    self.db.execute("SELECT cert FROM cert WHERE email = ?",
-                                        (email,)))
-            except StopIteration:
-                return
+        try:
+            cert, = next(self.db.execute(
+                "SELECT cert FROM cert WHERE email = ?", (email,)))
+        except StopIteration:
+            return
         certificate = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
         return x509.subnetFromCert(certificate)
 
@@ -763,15 +1261,14 @@ class RegistryServer:
     def getIPv6Address(self, email: str) -> str:
         cn = self.getNodePrefix(email)
         if cn:
-            return utils.ipFromBin(
-                x509.networkFromCa(self.cert.ca)
-                + utils.binFromSubnet(cn))
+            return (self.network + utils.Prefix.fromSubnet(cn)).ip()
 
+    @blocking
     @rpc_private
     def getIPv4Information(self, email: str) -> str | None:
         peer = self.getNodePrefix(email)
         if peer:
-            peer = utils.binFromSubnet(peer)
+            peer = utils.Prefix.fromSubnet(peer)
             with self.peers_lock:
                 self.request_dump()
                 for neigh_routes in self.routing.neighbours.values():
@@ -781,11 +1278,23 @@ class RegistryServer:
                 else:
                     return
             logging.info("%s %s", email, peer)
-            with self.lock:
-                msg = self._queryAddress(peer).decode()
+            msg = self._queryAddress(peer)
             if msg:
                 return msg.split(',')[0]
 
+    @rpc_private
+    def metrics(self) -> str:
+        """Metrics in the text format of Prometheus"""
+        return exposition(self.metric_list)
+
+    @rpc_private
+    def prefixStats(self) -> str:
+        with self.lock:
+            stats = self.prefix_allocator.stats()
+        return json.dumps({'*' if k is None else k: v
+                           for k, v in stats.items()})
+
+    @blocking
     @rpc_private
     def versions(self) -> str:
         with self.peers_lock:
@@ -795,55 +1304,47 @@ class RegistryServer:
                 for prefix in neigh_routes[1]
                 if prefix}
         peers.add(self.prefix)
-        peer_dict = {}
-        s = self.sock,
-        with self.lock:
+        peer_dict = dict.fromkeys(peers)
+        with self.collect(4) as replies:
+            for prefix in peers:
+                self.sendto(prefix, 4)
             while True:
-                r, w, _ = select.select(s, s if peers else (), (), 3)
-                if r:
-                    prefix, ver = self.recv(4)
-                    if prefix:
-                        peer_dict[prefix] = ver
-                if w:
-                    prefix = peers.pop()
-                    peer_dict[prefix] = None
-                    self.sendto(prefix, 4)
-                elif not r:
+                try:
+                    prefix, ver = replies.get(timeout=self.reply_timeout)
+                except queue.Empty:
                     break
-        return json.dumps(peer_dict)
+                peer_dict[prefix] = ver
+        return json.dumps({str(k): v for k, v in peer_dict.items()})
 
+    @blocking
     @rpc_private
     def topology(self) -> str:
-        p = lambda p: '%s/%s' % (int(p, 2), len(p))
-        peers = deque((p(self.prefix),))
+        peers = deque((self.prefix.subnet,))
         graph = defaultdict(set)
-        s = self.sock,
-        with self.lock:
+        with self.collect(5) as replies:
             while True:
-                r, w, _ = select.select(s, s if peers else (), (), 3)
-                if r:
-                    prefix, x = self.recv(5)
-                    logging.debug("Received %s %s", prefix, x)
-                    if prefix:
-                        prefix = p(prefix)
-                        x = x.split()
-                        try:
-                            n = int(x.pop(0))
-                        except ValueError:
-                            continue
-                        if n <= len(x) and prefix not in x:
-                            graph[prefix].update(x[:n])
-                            peers += set(x).difference(graph)
-                            for x in x[n:]:
-                                graph[x].add(prefix)
-                            graph[''].add(prefix)
-                if w:
+                while peers:
                     first = peers.popleft()
                     logging.debug("Sending %s", first)
-                    self.sendto(utils.binFromSubnet(first), 5)
-                elif not r:
-                    logging.debug("No more sockets, stopping")
+                    self.sendto(utils.Prefix.fromSubnet(first), 5)
+                try:
+                    prefix, x = replies.get(timeout=self.reply_timeout)
+                except queue.Empty:
+                    logging.debug("No more replies, stopping")
                     break
+                logging.debug("Received %s %s", prefix, x)
+                prefix = prefix.subnet
+                x = x.split()
+                try:
+                    n = int(x.pop(0))
+                except ValueError:
+                    continue
+                if n <= len(x) and prefix not in x:
+                    graph[prefix].update(x[:n])
+                    peers += set(x).difference(graph)
+                    for x in x[n:]:
+                        graph[x].add(prefix)
+                    graph[''].add(prefix)
         return json.dumps({k: list(v) for k, v in graph.items()})
 
 
@@ -853,12 +1354,19 @@ class RegistryClient:
 
     Method calls are forwarded to the registry server.
     String results are always returned as bytes.
+
+    The HTTP connection is kept open between calls, unless 'auto_close' is
+    true, and reopened if the registry closed it meanwhile.
     """
 
     _hmac = None
+    _idle_until = None
+    # Do not reuse a connection that has been idle for longer,
+    # the registry would probably have closed it.
+    idle_timeout = 10
     user_agent = "re6stnet/%s, %s" % (version.version, platform.platform())
 
-    def __init__(self, url: str, cert: x509.Cert=None, auto_close=True):
+    def __init__(self, url: str, cert: x509.Cert=None, auto_close=False):
         self.cert = cert
         self.auto_close = auto_close
         url_parsed = urlparse(url)
@@ -869,11 +1377,46 @@ class RegistryClient:
                           https=http.client.HTTPSConnection,
                           )[scheme](unquote(host), timeout=60)
         self._path = path.rstrip('/')
+        # url -> (ETag, body) of cacheable results
+        self._entity_dict = {}
+
+    def close(self):
+        self._idle_until = None
+        self._conn.close()
+
+    def _getResponse(self, url: str, headers: list
+                     ) -> tuple[http.client.HTTPResponse, bytes]:
+        conn = self._conn
+        reuse = self._idle_until
+        if reuse and reuse < time.time():
+            self.close()
+            reuse = None
+        while True:
+            try:
+                conn.putrequest('GET', url, skip_accept_encoding=1)
+                for header in headers:
+                    conn.putheader(*header)
+                conn.endheaders()
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except ConnectionError:
+                self.close()
+                if not reuse:
+                    raise
+                # Idle connection closed by the registry.
+                reuse = None
+        # The connection is closed if the response says so.
+        self._idle_until = conn.sock and time.time() + self.idle_timeout
+        return response, body
 
     def __getattr__(self, name: str):
         getcallargs = getattr(RegistryServer, name).getcallargs
         def rpc(*args, **kw) -> bytes | None:
             kw = getcallargs(*args, **kw)
+            for k, v in kw.items():
+                if isinstance(v, utils.Prefix):
+                    kw[k] = str(v)
             query = '/' + name
             if kw:
                 if any(not isinstance(v, (str, bytes)) for v in kw.values()):
@@ -900,20 +1443,29 @@ class RegistryClient:
                         self._hmac = hashlib.sha1(key).digest()
                     else:
                         retry = False
-                    self._conn.putrequest('GET', url, skip_accept_encoding=1)
-                    self._conn.putheader('User-Agent', self.user_agent)
+                    headers = [('User-Agent', self.user_agent)]
                     if client_prefix:
-                        self._conn.putheader(HMAC_HEADER, base64.b64encode(h))
-                    self._conn.endheaders()
-                    response = self._conn.getresponse()
-                    body = response.read()
+                        headers.append((HMAC_HEADER, base64.b64encode(h)))
+                    entity = self._entity_dict.get(url)
+                    if entity:
+                        headers.append(('If-None-Match', entity[0]))
+                    response, body = self._getResponse(url, headers)
                     if response.status in (HTTPStatus.OK,
-                                           HTTPStatus.NO_CONTENT):
+                                           HTTPStatus.NO_CONTENT,
+                                           HTTPStatus.NOT_MODIFIED):
                         if (not client_prefix or
                                 hmac.HMAC(key, body, hashlib.sha1).digest() ==
                                 base64.b64decode(response.msg[HMAC_HEADER])):
+                            if response.status == HTTPStatus.NOT_MODIFIED:
+                                body = entity[1]
+                            else:
+                                etag = response.msg.get('ETag')
+                                if etag:
+                                    self._entity_dict[url] = etag, body
+                                else:
+                                    self._entity_dict.pop(url, None)
                             if self.auto_close and name != 'hello':
-                                self._conn.close()
+                                self.close()
                             return body
                     elif response.status == HTTPStatus.FORBIDDEN:
                         # XXX: We should improve error handling, while making
@@ -930,6 +1482,6 @@ class RegistryClient:
             else:
                 logging.info('%s\nUnexpected response %s %s',
                              url, response.status, response.reason)
-            self._conn.close()
+            self.close()
         setattr(self, name, rpc)
         return rpc
@@ -1,17 +1,22 @@
-import logging, socket, struct
-from collections import namedtuple
+import logging, socket, struct, time
+from collections import deque, namedtuple
 from . import utils
 
+# Maximum delay before the handler is notified of a change of routes.
+CHANGE_DELAY = 1
+
 uint16 = struct.Struct("!H")
 header = struct.Struct("!HI")
 
 class Struct:
 
+    struct = None
+
     def __init__(self, format, *args):
         if args:
-            t = namedtuple(*args)
+            self.type = t = namedtuple(*args)
         if isinstance(format, str):
-            s = struct.Struct("!" + format)
+            self.struct = s = struct.Struct("!" + format)
             def encode(buffer, value):
                 buffer += s.pack(*value)
             def decode(buffer, offset=0):
@@ -41,14 +46,49 @@ class Array:
             encode(buffer, value)
 
     def decode(self, buffer: bytes, offset=0) -> tuple[int, list]:
-        r = []
+        n, = uint16.unpack_from(buffer, offset)
         o = offset + 2
-        decode = self._item.decode
-        for i in range(*uint16.unpack_from(buffer, offset)):
+        item = self._item
+        if item.struct:
+            r = Records(item, buffer, o, n)
+            return o + n * item.struct.size, r
+        r = []
+        decode = item.decode
+        for i in range(n):
             o, x = decode(buffer, o)
             r.append(x)
         return o, r
 
+class Records:
+    """Array of fixed-size items, decoded on access
+
+    The buffer is referenced and must not be modified.
+    """
+
+    def __init__(self, item: Struct, buffer: bytes, offset: int, count: int):
+        self._struct = s = item.struct
+        self._type = item.type
+        self._view = memoryview(buffer)[offset:offset+count*s.size]
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i: int):
+        s = self._struct
+        return self._type._make(s.unpack_from(self._view,
+            range(self._count)[i] * s.size))
+
+    def __iter__(self):
+        return map(self._type._make, self.unpack())
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def unpack(self):
+        # Plain tuples, which is much faster than building namedtuples.
+        return self._struct.iter_unpack(self._view)
+
 class String:
 
     @staticmethod
@@ -100,8 +140,18 @@ class Buffer:
         return value
 
     def decode(self, decode):
-        r, value = decode(self._buf, self._r)
-        self._seek(r)
+        # The decoded value may reference the buffer (see Records), which is
+        # therefore given away, unless it contains more than this packet.
+        buf = self._buf
+        r = self._r
+        w = self._w
+        if w < len(buf):
+            value = decode(buf[r:w])[1]
+            self._seek(w)
+        else:
+            self._buf = bytearray()
+            self._r = self._w = 0
+            value = decode(buf, r)[1]
         return value
 
     # writing
@@ -167,57 +217,295 @@ class ConnectionClosed(BabelException):
         return "connection to babeld closed (%s)" % self.args
 
 
+def localPath(control_socket: str) -> str:
+    """Path of the local interface of babeld, next to its control socket"""
+    return control_socket + '.local'
+
+
+class Monitor:
+    """Live table of installed routes, from the local interface of babeld
+
+    The 'monitor' command dumps the current state and then reports changes
+    as they happen. 'routes' is None until the initial dump is complete.
+    """
+
+    routes = None
+    reconnect_delay = 1
+    _socket = None
+
+    def __init__(self, socket_path: str, reactor: utils.Reactor, callback):
+        self.socket_path = socket_path
+        self._reactor = reactor
+        self._callback = callback
+
+    def open(self):
+        self._reactor.cancel(self.open)
+        s = socket.socket(socket.AF_UNIX,
+            socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        try:
+            s.connect(self.socket_path)
+        except socket.error as e:
+            logging.debug("Can't connect to %r (%r)", self.socket_path, e)
+            s.close()
+            return
+        s.send(b'monitor\n')
+        s.setblocking(False)
+        self._socket = s
+        self._buffer = b''
+        self._routes = {}
+        self._reactor.addReader(s, self._read)
+
+    def close(self):
+        self._reactor.cancel(self.open)
+        s = self._socket
+        if s is not None:
+            self._socket = self.routes = None
+            self._reactor.unregister(s)
+            s.close()
+
+    @property
+    def closed(self):
+        return self._socket is None
+
+    def _read(self):
+        try:
+            d = self._socket.recv(65536)
+        except OSError as e:
+            logging.info("Connection to %r lost (%r)", self.socket_path, e)
+        else:
+            if d:
+                lines = (self._buffer + d).split(b'\n')
+                self._buffer = lines.pop()
+                changed = False
+                for line in lines:
+                    changed |= self._parse(line.decode().split())
+                if changed and self.routes is not None:
+                    self._callback()
+                return
+            logging.info("Connection to %r closed", self.socket_path)
+        self.close()
+        # Most likely, babeld is restarting. Until we're subscribed again,
+        # full dumps are requested, and they also retry to reconnect.
+        self._reactor.schedule(time.time() + self.reconnect_delay, self.open)
+
+    def _parse(self, line: list[str]) -> bool:
+        # <add|change|flush> <neighbour|route|...> <id> [<key> <value>]...
+        if line == ['done']:
+            self.routes = self._routes
+            return True
+        try:
+            event, kind, id = line[:3]
+        except ValueError:
+            return False
+        if kind == 'neighbour':
+            return True
+        if kind != 'route':
+            return False
+        x = dict(zip(line[3::2], line[4::2]))
+        routes = self._routes
+        route = routes.pop(id, None)
+        if event != 'flush' and x.get('installed') == 'yes':
+            prefix, plen = x['prefix'].split('/')
+            if ':' not in prefix:
+                return route is not None # IPv4
+            try:
+                ifindex = socket.if_nametoindex(x['if'])
+            except OSError:
+                return route is not None
+            via = socket.inet_pton(socket.AF_INET6, x['via'])
+            # Same layout as routes of Dump (see Records.unpack),
+            # with None for unknown values.
+            routes[id] = (socket.inet_pton(socket.AF_INET6, prefix),
+                int(plen), int(x['metric']), None, int(x['refmetric']),
+                x['id'], None, None, ifindex, via, via, 1)
+            return True
+        return route is not None
+
+
+class Configure:
+    """Send configuration statements to the local interface of babeld
+
+    'errback' is called with an error message if babeld can't be reached,
+    does not answer in time, or rejects a statement.
+    """
+
+    timeout = 5
+
+    def __init__(self, socket_path: str, reactor: utils.Reactor,
+                 lines: tuple[str, ...], errback):
+        self.socket_path = socket_path
+        self._reactor = reactor
+        self._lines = deque(lines)
+        self._errback = errback
+        self._socket = None
+        if not lines:
+            return
+        s = socket.socket(socket.AF_UNIX,
+            socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        s.setblocking(False)
+        try:
+            s.connect(socket_path)
+        except OSError as e:
+            s.close()
+            errback("can't connect to %r (%r)" % (socket_path, e))
+            return
+        self._socket = s
+        self._banner = True
+        self._read_buffer = b''
+        self._write_buffer = b''.join(line.encode() + b'\n'
+                                      for line in lines)
+        reactor.addReader(s, self._read)
+        reactor.addWriter(s, self._write)
+        reactor.schedule(time.time() + self.timeout, self._timeout)
+
+    def _close(self, error=None):
+        s = self._socket
+        if s is not None:
+            self._socket = None
+            self._reactor.unregister(s)
+            self._reactor.cancel(self._timeout)
+            s.close()
+            if error:
+                self._errback(error)
+
+    def _timeout(self):
+        self._close("no answer from %r" % self.socket_path)
+
+    def _write(self):
+        if self._socket is None:
+            return
+        try:
+            n = self._socket.send(self._write_buffer)
+        except OSError as e:
+            return self._close("%r: %r" % (self.socket_path, e))
+        self._write_buffer = b = self._write_buffer[n:]
+        if not b:
+            self._reactor.removeWriter(self._socket)
+
+    def _read(self):
+        try:
+            d = self._socket.recv(65536)
+        except OSError as e:
+            return self._close("%r: %r" % (self.socket_path, e))
+        if not d:
+            return self._close("connection to %r closed" % self.socket_path)
+        lines = (self._read_buffer + d).split(b'\n')
+        self._read_buffer = lines.pop()
+        for r in lines:
+            r = r.rstrip().decode()
+            if self._banner:
+                # Skip the banner.
+                self._banner = r != 'ok'
+                continue
+            line = self._lines.popleft()
+            logging.debug('babeld: %s -> %s', line, r)
+            if r != 'ok':
+                return self._close('%r: %r' % (line, r))
+            if not self._lines:
+                return self._close()
+
+
 class Babel:
 
     _decode = None
+    _socket = None
+    monitor = None
 
-    def __init__(self, socket_path: str, handler, network: str):
+    def __init__(self, socket_path: str, handler, network: utils.Prefix,
+                 reactor: utils.Reactor, monitor=False):
         self.socket_path = socket_path
         self.handler = handler
         self.network = network
+        self._reactor = reactor
         self.locked = set()
+        if monitor:
+            # Routes are then not dumped, and the handler is notified
+            # (babel_changed) when routes or neighbours change.
+            self.monitor = Monitor(localPath(socket_path), reactor,
+                                   self._changed)
         self.reset()
 
     def reset(self):
-        try:
-            del self.socket, self.request_dump
-        except AttributeError:
-            pass
+        self.close()
         self.write_buffer = Buffer()
         self.read_buffer = Buffer()
         self.read_buffer.want(header.size)
-        s = socket.socket(socket.AF_UNIX,
+        self._dumping = deque()
+        self._socket = socket.socket(socket.AF_UNIX,
             socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
-        def select(*args):
-            try:
-                s.connect(self.socket_path)
-            except socket.error as e:
-                logging.debug("Can't connect to %r (%r)", self.socket_path, e)
-                return e
-            s.send(b'\1')
-            s.setblocking(False)
-            del self.select
-            self.socket = s
-            return self.select(*args)
-        self.select = select
-        self.close = s.close
+
+    def close(self):
+        if self.monitor:
+            self.monitor.close()
+            self._reactor.cancel(self._notify)
+        try:
+            s = self.socket
+        except AttributeError:
+            s = self._socket
+            if s is None:
+                return
+        else:
+            del self.socket, self.request_dump
+            self._reactor.unregister(s)
+        s.close()
+
+    def _connect(self):
+        s = self._socket
+        try:
+            s.connect(self.socket_path)
+        except socket.error as e:
+            logging.debug("Can't connect to %r (%r)", self.socket_path, e)
+            return e
+        s.send(b'\1')
+        s.setblocking(False)
+        self.socket = s
+        self._reactor.addReader(s, self._read)
+        if self.write_buffer:
+            self._reactor.addWriter(s, self._write)
+
+    def configure(self, *lines: str):
+        """Apply configuration statements to the running babeld
+
+        This uses the local interface, which must be read-write. Statements
+        are sent from the reactor, and the handler is notified if they can't
+        be applied (babel_configure_failed).
+        """
+        Configure(localPath(self.socket_path), self._reactor, lines,
+                  self.handler.babel_configure_failed)
 
     def request_dump(self):
-        if self.select({}, {}, ()):
+        if self._connect():
             self.handle_dump((), (), (), ())
         else:
-            # interfaces + neighbours + installed routes
-            self.request_dump = lambda: self.send(Dump(11))
+            self.request_dump = self._requestDump
             self.request_dump()
 
-    def send(self, packet):
-        packet.write(self.write_buffer)
+    def _requestDump(self):
+        monitor = self.monitor
+        if monitor and monitor.closed:
+            monitor.open()
+        monitored = monitor is not None and monitor.routes is not None
+        self._dumping.append(monitored)
+        # interfaces + neighbours (+ installed routes)
+        self.send(Dump(3 if monitored else 11))
 
-    def select(self, r, w, t):
-        s = self.socket
-        r[s] = self._read
-        if self.write_buffer:
-            w[s] = self._write
+    def _changed(self):
+        # Coalesce bursts of changes.
+        self._reactor.schedule(time.time() + CHANGE_DELAY, self._notify, False)
+
+    def _notify(self):
+        self.handler.babel_changed()
+
+    def send(self, packet):
+        b = self.write_buffer
+        if not b:
+            try:
+                s = self.socket
+            except AttributeError:
+                pass
+            else:
+                self._reactor.addWriter(s, self._write)
+        packet.write(b)
 
     def _read(self):
         d = self.socket.recv(65536)
@@ -244,28 +532,53 @@ class Babel:
 
     def _write(self):
         self.write_buffer.send(self.socket)
+        if not self.write_buffer:
+            self._reactor.removeWriter(self.socket)
 
     def handle_dump(self, interfaces, neighbours, xroutes, routes):
+        n = {(n.address, n.ifindex): (n, {}) for n in neighbours}
+        if self._dumping and self._dumping.popleft():
+            routes = self.monitor.routes
+            if routes is None:
+                # The monitor was lost in the meantime.
+                return self._requestDump()
+            routes = routes.values()
+            if any((route[9], route[8]) not in n for route in routes):
+                # Routes and neighbours are not from the same snapshot:
+                # a neighbour appeared or disappeared in the meantime.
+                logging.debug("Route via unknown neighbour, doing full dump")
+                self._dumping.append(False)
+                return self.send(Dump(11))
+        elif routes:
+            routes = routes.unpack()
         self.interfaces = {i.index: name for i, name in interfaces}
         # neighbours = {neigh_prefix: (neighbour, {dst_prefix: route})}
-        n = {(n.address, n.ifindex): (n, {}) for n in neighbours}
+        # where routes are plain tuples (see Records.unpack)
         unidentified = set(n)
         self.neighbours = neighbours = {}
         a = len(self.network)
-        logging.trace("Routes: %r", routes)
+        network = self.network.bits
+        trace = logging.getLogger().isEnabledFor(5)
+        if trace:
+            logging.trace("Routes: %r", routes)
         for route in routes:
-            assert route.flags & 1, route # installed
-            if route.prefix.startswith(b'\0\0\0\0\0\0\0\0\0\0\xff\xff'):
+            (ip, plen, _, _, refmetric, _, _, _,
+             ifindex, neigh_address, nexthop, flags) = route
+            assert flags & 1, route # installed
+            if ip.startswith(b'\0\0\0\0\0\0\0\0\0\0\xff\xff'):
                 logging.warning("Ignoring IPv4 route: %r", route)
                 continue
-            assert route.neigh_address == route.nexthop, route
-            address = route.neigh_address, route.ifindex
+            assert neigh_address == nexthop, route
+            address = neigh_address, ifindex
             neigh_routes = n[address]
-            ip = utils.binFromRawIp(route.prefix)
-            if ip[:a] == self.network:
-                logging.trace("Route is on the network: %r", route)
-                prefix = ip[a:route.plen]
-                if prefix and not route.refmetric:
+            ip = int.from_bytes(ip, 'big')
+            if ip >> 128 - a == network:
+                if trace:
+                    logging.trace("Route is on the network: %r", route)
+                l = plen - a
+                prefix = utils.Prefix(ip >> 128 - plen & (1 << l) - 1, l
+                    ) if l > 0 else utils.Prefix()
+                if prefix and not refmetric:
                     neighbours[prefix] = neigh_routes
                     try:
                         unidentified.remove(address)
@@ -275,12 +588,15 @@ class Babel:
                             " (one of them is %s/%s).",
                             socket.inet_ntop(socket.AF_INET6, address[0]),
                             self.interfaces[address[1]],
-                            socket.inet_ntop(socket.AF_INET6, route.prefix),
-                            route.plen)
+                            socket.inet_ntop(socket.AF_INET6,
+                                             route[0]),
+                            plen)
             else:
-                logging.trace("Route is not on the network: %r", route)
+                if trace:
+                    logging.trace("Route is not on the network: %r", route)
                 prefix = None
-            logging.trace("Adding route %r to %r", route, neigh_routes)
+            if trace:
+                logging.trace("Adding route %r to %r", route, neigh_routes)
             neigh_routes[1][prefix] = route
         self.locked.clear()
         if unidentified:
@@ -304,14 +620,15 @@ class iterRoutes:
 
     _waiting = True
 
-    def __new__(cls, control_socket: str, network: str):
+    def __new__(cls, control_socket: str, network: utils.Prefix):
         self = object.__new__(cls)
-        c = Babel(control_socket, self, network)
+        reactor = utils.Reactor()
+        c = Babel(control_socket, self, network, reactor)
         c.request_dump()
         while self._waiting:
-            args = {}, {}, ()
-            c.select(*args)
-            utils.select(*args)
+            reactor.select()
+        c.close()
+        reactor.close()
         return (prefix
             for neigh_routes in c.neighbours.values()
             for prefix in neigh_routes[1]
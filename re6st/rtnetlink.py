@@ -0,0 +1,180 @@
+"""Minimal rtnetlink client, to manage routes, addresses and tap devices
+
+This avoids forking 'ip' or 'openvpn --mktun' for each change.
+"""
+import fcntl, logging, os, socket, struct
+from contextlib import contextmanager
+
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+RTA_DST = 1
+RTA_SRC = 2
+RTA_OIF = 4
+RTA_GATEWAY = 5
+
+RT_TABLE_MAIN = 254
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+
+RTPROT_BOOT = 3
+RTPROT_STATIC = 4
+
+route_type_dict = {'unicast': 1, 'unreachable': 7}
+
+nlmsghdr = struct.Struct("=IHHII")
+nlmsgerr = struct.Struct("=i")
+rtmsg = struct.Struct("=BBBBBBBBI")
+ifaddrmsg = struct.Struct("=BBBBI")
+rtattr = struct.Struct("=HH")
+
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+
+def _attr(type: int, data: bytes) -> bytes:
+    n = rtattr.size + len(data)
+    return rtattr.pack(n, type) + data + bytes(-n % 4)
+
+def _parse(address: str) -> tuple[int, bytes, int]:
+    """Return family, packed address and prefix length of 'address[/len]'"""
+    address, _, n = address.partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    address = socket.inet_pton(family, address)
+    return family, address, int(n) if n else 8 * len(address)
+
+
+class Netlink:
+    """Socket to send rtnetlink requests
+
+    Each request waits for the acknowledgement of the kernel and raises
+    OSError on failure, unless it is done within a batch.
+    """
+
+    _batch = None
+
+    def __init__(self):
+        self._socket = s = socket.socket(socket.AF_NETLINK,
+            socket.SOCK_RAW | socket.SOCK_CLOEXEC, socket.NETLINK_ROUTE)
+        s.bind((0, 0))
+        self._seq = 0
+
+    def close(self):
+        self._socket.close()
+
+    @contextmanager
+    def batch(self):
+        """Send all requests of the with block in a single datagram
+
+        Acknowledgements are only checked at the end of the block,
+        and the first error is raised.
+        """
+        assert self._batch is None
+        self._batch = batch = []
+        try:
+            yield
+        finally:
+            del self._batch
+        if batch:
+            self._send(batch)
+
+    def _request(self, type: int, flags: int, body: bytes):
+        self._seq = seq = self._seq + 1 & 0xffffffff
+        msg = nlmsghdr.pack(nlmsghdr.size + len(body), type,
+                            NLM_F_REQUEST | NLM_F_ACK | flags, seq, 0) + body
+        if self._batch is None:
+            self._send([msg])
+        else:
+            self._batch.append(msg)
+
+    def _send(self, msg_list: list[bytes]):
+        s = self._socket
+        s.send(b''.join(msg_list))
+        error = None
+        pending = len(msg_list)
+        while pending:
+            data = s.recv(65536)
+            offset = 0
+            while offset < len(data):
+                size, type, _, _, _ = nlmsghdr.unpack_from(data, offset)
+                if type == NLMSG_ERROR:
+                    pending -= 1
+                    e, = nlmsgerr.unpack_from(data, offset + nlmsghdr.size)
+                    if e and not error:
+                        error = OSError(-e, os.strerror(-e))
+                offset += size + (-size % 4)
+        if error:
+            raise error
+
+    def route(self, cmd: str, dst: str, type='unicast', via=None, dev=None,
+              src=None, proto=None):
+        """Add ('add') or delete ('del') a route, like 'ip route'"""
+        family, dst, dst_len = _parse(dst)
+        attrs = [_attr(RTA_DST, dst)] if dst_len else []
+        src_len = 0
+        if src:
+            _, src, src_len = _parse(src)
+            if src_len:
+                attrs.append(_attr(RTA_SRC, src))
+        if via:
+            attrs.append(_attr(RTA_GATEWAY, _parse(via)[1]))
+        if dev:
+            attrs.append(_attr(RTA_OIF,
+                struct.pack("=i", socket.if_nametoindex(dev))))
+        if cmd == 'add':
+            msg_type = RTM_NEWROUTE
+            flags = NLM_F_CREATE | NLM_F_EXCL
+            scope = (RT_SCOPE_LINK if type == 'unicast' and not via
+                     and family == socket.AF_INET else RT_SCOPE_UNIVERSE)
+            proto = RTPROT_BOOT if proto is None else proto
+        else:
+            msg_type = RTM_DELROUTE
+            flags = 0
+            scope = RT_SCOPE_NOWHERE
+            proto = proto or 0
+        logging.trace('route %s %s/%u type=%s via=%s dev=%s src=%s', cmd,
+            socket.inet_ntop(family, dst), dst_len, type, via, dev, src)
+        self._request(msg_type, flags, rtmsg.pack(family, dst_len, src_len,
+            0, RT_TABLE_MAIN, proto, scope, route_type_dict[type], 0)
+            + b''.join(attrs))
+
+    def address(self, cmd: str, address: str, dev: str):
+        """Add ('add') or delete ('del') an address, like 'ip address'"""
+        family, address, n = _parse(address)
+        logging.trace('address %s %s/%u dev %s', cmd,
+                      socket.inet_ntop(family, address), n, dev)
+        if cmd == 'add':
+            msg_type = RTM_NEWADDR
+            flags = NLM_F_CREATE | NLM_F_EXCL
+        else:
+            msg_type = RTM_DELADDR
+            flags = 0
+        self._request(msg_type, flags, ifaddrmsg.pack(family, n, 0,
+            RT_SCOPE_UNIVERSE, socket.if_nametoindex(dev))
+            + _attr(IFA_LOCAL, address) + _attr(IFA_ADDRESS, address))
+
+
+def tuntap(cmd: str, iface: str):
+    """Create ('add') or delete ('del') a persistent tap device
+
+    This is what 'openvpn --mktun/--rmtun --dev-type tap' does.
+    """
+    logging.debug('tuntap %s %s', cmd, iface)
+    with open('/dev/net/tun', 'r+b', buffering=0) as f:
+        fcntl.ioctl(f, TUNSETIFF,
+            struct.pack("16sH22x", iface.encode(), IFF_TAP | IFF_NO_PI))
+        fcntl.ioctl(f, TUNSETPERSIST, cmd == 'add')
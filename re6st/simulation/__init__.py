@@ -0,0 +1,251 @@
+"""Simulation of the tunnel topology of a re6st network
+
+Unlike the programs in simulation/, which reimplement the algorithm, this
+drives the decision code of re6st.tunnel.TunnelManager: each virtual node
+is a TunnelManager whose tunnels, routing daemon and cache are replaced by
+in-process fakes. Babel is modelled as a distance-vector protocol that has
+converged at the beginning of each round: every node sees, through each of
+its neighbours, the routes that this neighbour had at that time, with a
+metric of 256 per hop. Destinations are then routed through the neighbour
+with the lowest metric, which is what TunnelScore counts.
+
+A round corresponds to a tunnel refresh: each node, in random order,
+removes a tunnel if it has enough of them and makes new ones, as
+TunnelManager.babel_dump does. Tunnel killers are not simulated: chosen
+tunnels are closed immediately.
+
+Shortest paths between all pairs of nodes are computed with NumPy, so that
+networks of thousands of nodes can be simulated in a single process.
+"""
+import random
+from collections import namedtuple
+import numpy as np
+
+from .. import tunnel, utils
+
+# Hop count of unreachable nodes.
+UNREACHABLE = np.iinfo(np.int16).max
+
+Neighbour = namedtuple("Neighbour", "address ifindex cost_multiplier rtt")
+
+
+class Babel:
+    """Routing table of a node, as dumped by babeld"""
+
+    def __init__(self, network: "Network", node: int):
+        self._network = network
+        self._node = node
+        self.locked = set()
+        self.reset()
+
+    def reset(self):
+        self._neighbours = None
+
+    @property
+    def neighbours(self):
+        if self._neighbours is None:
+            self._neighbours = self._network.neighbours(self._node)
+        return self._neighbours
+
+    def send(self, packet):
+        pass
+
+
+class Cache:
+    """Cache of a node, whose registry is the Network object"""
+
+    same_country = False
+
+    def __init__(self, network: "Network"):
+        self._network = network
+        self.registry_prefix = network.prefix_list[0]
+        self._peers = {}
+
+    def getAddress(self, prefix):
+        return self._network.address
+
+    def getPeerList(self, failed=False):
+        if failed:
+            return []
+        peers = list(self._peers.items())
+        random.shuffle(peers)
+        return peers
+
+    def getBootstrapPeer(self):
+        peer = self._network.getBootstrapPeer(self)
+        if peer:
+            self._peers[peer[0]] = peer[1]
+            return peer
+
+    def connecting(self, prefix, connecting):
+        pass
+
+
+class Node(tunnel.TunnelManager):
+    """Tunnel decisions of a TunnelManager, without tunnels nor sockets"""
+
+    _gateway_manager = None
+    timeout = 0
+
+    def __init__(self, network: "Network", index: int, client_count: int,
+                 tunnel_score: str):
+        self._network = network
+        self.index = index
+        self._prefix = network.prefix_list[index]
+        self.cache = Cache(network)
+        self.routing = Babel(network, index)
+        self._client_count = client_count
+        self._neighbour_set = set()
+        self._score = tunnel.tunnel_score_dict[tunnel_score](
+            self._neighbour_set)
+        self.reset()
+
+    def reset(self):
+        """Forget all tunnels, like a restarted node"""
+        self._resetTunnels()
+
+    def sendto(self, prefix, msg):
+        pass
+
+    def _makeTunnel(self, prefix, address):
+        if prefix in self._served or prefix in self._connection_dict:
+            return False
+        # Like a tunnel whose server is full, a refused connection counts
+        # as a new tunnel until it is detected dead.
+        self._network.connect(self, self._network.node_dict[prefix])
+        return True
+
+    def _kill(self, prefix):
+        self._killing.pop(prefix, None)
+        self._network.disconnect(self, self._connection_dict[prefix])
+
+    def refresh(self):
+        self._removeSomeTunnels()
+        for prefix in list(self._killing):
+            self._kill(prefix)
+        self._makeNewTunnels(True)
+
+
+class Network:
+    """Virtual nodes and the tunnels between them
+
+    It also plays the role of the registry, which gives random nodes to
+    bootstrap.
+    """
+
+    address = '0.0.0.0,1194,udp'
+
+    def __init__(self, size: int, client_count: int, max_clients: int,
+                 tunnel_score='routes'):
+        assert 1 < size < UNREACHABLE, size
+        self.size = size
+        self.max_clients = max_clients
+        self.prefix_list = [utils.Prefix(i, 16) for i in range(size)]
+        self.node_dict = {}
+        self.node_list = []
+        for i, prefix in enumerate(self.prefix_list):
+            self.node_dict[prefix] = node = Node(self, i, client_count,
+                                                 tunnel_score)
+            self.node_list.append(node)
+        self.adjacency = [set() for _ in range(size)]
+        self.route_list = [(None, 128, 256 * i) for i in range(size + 1)]
+        self.distance = np.zeros((size, size), np.int16)
+        self.update()
+
+    def connect(self, client: Node, server: Node):
+        if len(server._served) < self.max_clients:
+            client._connection_dict[server._prefix] = server
+            server._served[client._prefix][None] = None
+            self.adjacency[client.index].add(server.index)
+            self.adjacency[server.index].add(client.index)
+            client.routing.reset()
+            server.routing.reset()
+
+    def disconnect(self, client: Node, server: Node):
+        del client._connection_dict[server._prefix]
+        del server._served[client._prefix]
+        self.adjacency[client.index].discard(server.index)
+        self.adjacency[server.index].discard(client.index)
+        client.routing.reset()
+        server.routing.reset()
+
+    def restart(self, node: Node):
+        for server in list(node._connection_dict.values()):
+            self.disconnect(node, server)
+        for prefix in list(node._served):
+            self.disconnect(self.node_dict[prefix], node)
+        node.reset()
+
+    def getBootstrapPeer(self, cache: Cache):
+        node = random.choice(self.node_list)
+        if node.cache is not cache:
+            return node._prefix, self.address
+
+    def update(self):
+        """Compute the hop counts between all pairs of nodes
+
+        This is a breadth-first search from all nodes at the same time,
+        with a matrix product per hop.
+        """
+        size = self.size
+        adjacency = np.zeros((size, size), np.float32)
+        for a, x in enumerate(self.adjacency):
+            adjacency[a, list(x)] = 1
+        distance = self.distance
+        distance.fill(UNREACHABLE)
+        np.fill_diagonal(distance, 0)
+        reached = np.eye(size, dtype=bool)
+        frontier = reached.astype(np.float32)
+        hops = 0
+        while True:
+            hops += 1
+            x = (frontier @ adjacency > 0) & ~reached
+            if not x.any():
+                break
+            distance[x] = hops
+            reached |= x
+            frontier = x.astype(np.float32)
+        for node in self.node_list:
+            node.routing.reset()
+
+    def neighbours(self, node: int) -> dict:
+        """Return what babeld would dump for 'node'"""
+        index = sorted(self.adjacency[node])
+        if not index:
+            return {}
+        via = self.distance[index].astype(np.int32) + 1
+        best = via.argmin(0)
+        metric = via[best, np.arange(self.size)]
+        routes = [{} for _ in index]
+        prefix_list = self.prefix_list
+        route_list = self.route_list
+        for dst in np.flatnonzero(metric <= self.size):
+            if dst != node:
+                routes[best[dst]][prefix_list[dst]] = route_list[metric[dst]]
+        return {prefix_list[i]: (Neighbour(None, 0, 256, 0), routes[j])
+                for j, i in enumerate(index)}
+
+    def refresh(self, churn=0.):
+        """Simulate a tunnel refresh of all nodes
+
+        'churn' is the ratio of nodes that are restarted beforehand.
+        """
+        node_list = self.node_list[:]
+        for node in random.sample(node_list, int(churn * self.size)):
+            self.restart(node)
+        random.shuffle(node_list)
+        for node in node_list:
+            node.refresh()
+        self.update()
+
+    def stats(self) -> dict:
+        distance = self.distance
+        reachable = distance < UNREACHABLE
+        n = reachable.sum() - self.size
+        pairs = self.size * (self.size - 1)
+        return {
+            'distance': distance[reachable].sum() / n if n else 0.,
+            'diameter': int(distance[reachable].max()),
+            'unreachable': (pairs - n) / pairs,
+            'degree': np.bincount(list(map(len, self.adjacency))),
+        }
@@ -0,0 +1,79 @@
+"""Simulate the evolution of the tunnel topology of a re6st network
+
+All nodes start at the same time without any tunnel, and bootstrap from
+random nodes given by the registry (the first node). After each round, i.e.
+a tunnel refresh of all nodes, the average distance (in hops) between
+nodes, the diameter of the network and the degrees of the nodes are
+reported. The convergence time is the number of rounds after which all
+nodes are reachable and the average distance stays within the given
+tolerance of its final value.
+"""
+import argparse, random, sys, time
+from re6st import tunnel, utils
+from . import Network
+
+
+def formatDegrees(degree) -> str:
+    return " ".join("%u:%u" % x for x in enumerate(degree) if x[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--nodes', type=int, default=1000,
+        help="Number of nodes.")
+    parser.add_argument('-r', '--rounds', type=int, default=30,
+        help="Number of tunnel refreshes.")
+    parser.add_argument('--client-count', type=int, default=10,
+        help="Number of client tunnels per node.")
+    parser.add_argument('--max-clients', type=int, default=20,
+        help="Maximum number of tunnels served by each node.")
+    parser.add_argument('--tunnel-score', default='routes',
+        choices=tunnel.tunnel_score_dict,
+        help="Policy to choose tunnels to remove and peers to connect to.")
+    parser.add_argument('--churn', type=float, default=0.,
+        help="Ratio of nodes that are restarted at each round.")
+    parser.add_argument('--tolerance', type=float, default=.01,
+        help="Relative variation of the average distance below which the"
+             " network is considered to have converged.")
+    parser.add_argument('-d', '--degrees', action='store_true',
+        help="Print the degree distribution at each round,"
+             " instead of only at the end.")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help="Seed of the random generator.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    network = Network(args.nodes, args.client_count, args.max_clients,
+                      args.tunnel_score)
+    print("round distance diameter unreachable degree(min/avg/max) time(s)")
+    history = []
+    for i in range(1, args.rounds + 1):
+        t = time.perf_counter()
+        network.refresh(args.churn)
+        t = time.perf_counter() - t
+        stats = network.stats()
+        history.append(stats)
+        degree = stats['degree']
+        print("%5u %8.3f %8u %10.2f%% %6u %6.2f %4u %7.2f" % (
+            i, stats['distance'], stats['diameter'],
+            stats['unreachable'] * 100, degree.nonzero()[0][0],
+            degree @ range(len(degree)) / args.nodes, len(degree) - 1, t))
+        if args.degrees:
+            print(" ", formatDegrees(degree))
+    final = history[-1]['distance']
+    converged = None
+    for i, stats in reversed(list(enumerate(history, 1))):
+        if stats['unreachable'] or \
+           abs(stats['distance'] - final) > args.tolerance * final:
+            break
+        converged = i
+    if converged:
+        print("Converged after %u rounds" % converged)
+    else:
+        print("Not converged")
+    if not args.degrees:
+        print("Degree distribution:", formatDegrees(history[-1]['degree']))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Measure how long it takes to process a babeld dump
+
+Synthetic dumps (interfaces, neighbours and installed routes, as requested
+by routing.Babel.request_dump) are received and decoded by routing.Babel
+from a fake control socket, until the handler is notified.
+"""
+import argparse, random, socket, struct, sys, time
+from mock import Mock
+
+from re6st import routing, utils
+
+neighbour = struct.Struct("!16sIHHHHHiHH")
+route = struct.Struct("!16sBHHH8siiI16s16sB")
+
+
+def dump(network: utils.Prefix, routes: int, neighbours: int,
+         prefix_len: int) -> bytes:
+    b = bytearray()
+    b += routing.uint16.pack(1)
+    b += struct.pack("!I", 1) + b're6stnet0\0'
+    b += routing.uint16.pack(neighbours)
+    address_list = []
+    for i in range(neighbours):
+        address = b'\xfe\x80' + bytes(12) + struct.pack("!H", i + 1)
+        address_list.append(address)
+        b += neighbour.pack(address, 1, 0xffff, 256, 256, 0, 0, -2, 1, 1)
+    b += routing.uint16.pack(0)
+    b += routing.uint16.pack(routes)
+    n = prefix_len - len(network)
+    for i in range(routes):
+        address = address_list[i % neighbours]
+        prefix = (network + utils.Prefix(random.getrandbits(n), n)).ip()
+        b += route.pack(socket.inet_pton(socket.AF_INET6, prefix),
+                        prefix_len, 256, 256, 256 if i >= neighbours else 0,
+                        bytes(8), i, 0, 1, address, address, 1)
+    return bytes(routing.header.pack(1, len(b)) + b)
+
+
+def run(data: bytes, network: utils.Prefix, count: int) -> list[float]:
+    chunks = [data[i:i+65536] for i in range(0, len(data), 65536)]
+    handler = Mock()
+    babel = routing.Babel("babeld.sock", handler, network,
+                          Mock(utils.Reactor))
+    babel._socket.close()
+    babel.socket = Mock()
+    result = []
+    for _ in range(count):
+        babel.socket.recv.side_effect = chunks
+        t = time.perf_counter()
+        for _ in chunks:
+            babel._read()
+        result.append(time.perf_counter() - t)
+    assert handler.babel_dump.call_count == count
+    assert babel.neighbours
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('routes', type=int, nargs='*',
+        default=(1000, 10000, 50000),
+        help="Number of routes of each dump.")
+    parser.add_argument('-n', '--count', type=int, default=20,
+        help="Number of times each dump is processed.")
+    parser.add_argument('--neighbours', type=int, default=10,
+        help="Number of neighbours.")
+    parser.add_argument('--network', default='2001:db8:42::/48',
+        help="re6st network.")
+    parser.add_argument('--prefix-len', type=int, default=64,
+        help="Length of node prefixes.")
+    parser.add_argument('-v', '--verbose', default=2, type=int,
+        help="Log level, as for re6stnet.")
+    args = parser.parse_args()
+    utils.setupLog(args.verbose)
+    ip, n = args.network.split('/')
+    network = utils.Prefix.fromIp(ip)[:int(n)]
+    for routes in args.routes:
+        data = dump(network, routes, args.neighbours, args.prefix_len)
+        result = sorted(run(data, network, args.count))
+        print("%6u routes: median %8.2f ms, best %8.2f ms (%.2f µs/route)"
+              % (routes, result[len(result)//2] * 1e3, result[0] * 1e3,
+                 result[len(result)//2] * 1e6 / routes))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Measure how many forged hello0 packets per second a node can absorb
+
+Forged packets carry certificates that are not signed by the network CA,
+from random source addresses, which is the most expensive case for the
+receiving node. They are processed without and with cookie challenges
+(i.e. with a network 'min_protocol' below and above COOKIE_PROTOCOL).
+The remaining CPU is what the node still has for everything else.
+"""
+import argparse, os, random, sys, tempfile, time
+from mock import MagicMock, Mock, patch
+from OpenSSL import crypto
+
+from re6st import tunnel, utils, x509
+from re6st.tests import tools
+
+
+def forgedPackets(cert: x509.Cert, count: int, distinct: int):
+    with tempfile.TemporaryDirectory() as d:
+        ca_key, ca = tools.create_ca_file(os.path.join(d, "ca.key"),
+                                          os.path.join(d, "ca.cert"))
+    forged = []
+    for serial in range(distinct):
+        _, csr = tools.generate_csr()
+        forged.append(crypto.dump_certificate(crypto.FILETYPE_ASN1,
+            crypto.load_certificate(crypto.FILETYPE_PEM,
+                tools.generate_cert(ca, ca_key, csr,
+                                    tools.serial2prefix(serial), serial))))
+    network = cert.network
+    host_len = 128 - len(network)
+    for i in range(count):
+        ip = network.ip(random.getrandbits(host_len))
+        yield (b'\0\0\0\0' + forged[i % distinct],
+               (ip, tunnel.PORT, 0, 0))
+
+
+def run(cert: x509.Cert, min_protocol: int, count: int, distinct: int):
+    cache = Mock()
+    cache.same_country = False
+    cache.valid_until = None
+    cache.my_address = None
+    cache.min_protocol = min_protocol
+    cache.next_renew = time.time() + 86400
+    with patch("socket.socket"):
+        tm = tunnel.BaseTunnelManager(MagicMock(utils.Reactor),
+                                      "babeld.sock", cache, cert, None)
+    packets = list(forgedPackets(cert, count, distinct))
+    tm.sock.recvfrom.side_effect = packets
+    tm.sock.sendto.return_value = 1
+    worst = 0
+    start = time.perf_counter()
+    for _ in packets:
+        t = time.perf_counter()
+        tm.handlePeerEvent()
+        worst = max(worst, time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    tm.close()
+    return count / elapsed, worst, tm.sock.sendto.call_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=2000,
+        help="Number of forged hello0 packets.")
+    parser.add_argument('--distinct', type=int, default=20,
+        help="Number of distinct forged certificates.")
+    parser.add_argument('--load', type=float, default=.5,
+        help="Maximum fraction of CPU that can be spent on forged packets"
+             " for the node to be considered responsive.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        path = lambda name: os.path.join(d, name)
+        ca_key, ca = tools.create_ca_file(path("ca.key"), path("ca.cert"))
+        tools.create_cert_file(path("node.key"), path("node.cert"),
+                               ca, ca_key, "00000001", 1)
+        cert = x509.Cert(path("ca.cert"), path("node.key"), path("node.cert"))
+    for name, min_protocol in (("without cookie", x509.COOKIE_PROTOCOL - 1),
+                               ("with cookie", x509.COOKIE_PROTOCOL)):
+        rate, worst, replies = run(cert, min_protocol,
+                                   args.count, args.distinct)
+        print("%-15s %9.0f packets/s, worst %.3f ms, %u replies,"
+              " %.0f packets/s absorbed at %u%% CPU" % (
+              name, rate, worst * 1e3, replies,
+              rate * args.load, args.load * 100))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Measure the memory used by routes, depending on how prefixes are stored
+
+Routes are kept like routing.Babel.neighbours: a dict mapping the node
+prefix of each route to its neighbour. Prefixes are either text ('0101...',
+as before) or utils.Prefix. Results are given per 100k routes.
+"""
+import argparse, random, sys, tracemalloc
+
+from re6st import utils
+
+
+def routes(count: int, network: utils.Prefix, prefix_len: int):
+    n = prefix_len - len(network)
+    for _ in range(count):
+        yield network + utils.Prefix(random.getrandbits(n), n)
+
+
+def measure(build) -> tuple[int, object]:
+    tracemalloc.start()
+    try:
+        x = build()
+        return tracemalloc.get_traced_memory()[0], x
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--count', type=int, default=100000,
+        help="Number of routes.")
+    parser.add_argument('--network', default='2001:db8:42::/48',
+        help="Network in which node prefixes are allocated.")
+    parser.add_argument('--prefix-len', type=int, default=64,
+        help="Length of node prefixes.")
+    args = parser.parse_args()
+    ip, n = args.network.split('/')
+    network = utils.Prefix.fromIp(ip)[:int(n)]
+    prefix_list = list(routes(args.count, network, args.prefix_len))
+    neighbour = 'fe80::1', 'tun0'
+    # Keys are built inside the measure, so that their memory is counted.
+    for name, build in (
+            ("text", lambda: {str(x): neighbour for x in prefix_list}),
+            ("Prefix", lambda: {utils.Prefix(x.bits, x.len): neighbour
+                                for x in prefix_list}),
+            ):
+        size, _ = measure(build)
+        print("%-7s %6.2f MiB per 100k routes" % (
+              name, size * 1e5 / args.count / (1 << 20)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
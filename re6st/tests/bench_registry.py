@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Load the registry with simulated nodes and report latencies per RPC
+
+A registry is started on the loopback interface, with a temporary database
+and CA, and the same HTTP front end as re6st-registry. Concurrent clients
+then simulate new nodes with RegistryClient: requestCertificate (with a
+token), hello, getNetworkConfig, renewCertificate and getBootstrapPeer.
+
+There is no re6stnet or babeld on the registry side: the babel dump
+returns all registered nodes, and a stub answers address queries
+immediately, on UDP. All nodes share the same private key, to save the
+time of generating them.
+
+Clients run in the same process as the registry, and RSA operations of both
+sides compete for the CPU: results are meant to be compared between
+versions, on the same machine.
+"""
+import argparse, os, socket, sys, tempfile, threading, time
+from argparse import Namespace
+from collections import defaultdict
+
+from re6st import registry, utils, x509
+from re6st.cli.registry import HTTPFrontEnd, RequestHandler
+from re6st.tests import DEMO_PATH, tools
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(*args):
+        pass
+
+
+class Responder:
+    """Answer address queries of the registry, for any node"""
+
+    address = b"10.0.0.1,1194,udp,FR"
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.bind(('::1', 0))
+        self.sockname = self.sock.getsockname()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        sock = self.sock
+        while True:
+            try:
+                data, addr = sock.recvfrom(1 << 16)
+            except OSError:
+                break
+            if not data:
+                break # closed
+            if data.endswith(b'\0\1'):
+                sock.sendto(data + self.address, addr)
+
+    def close(self):
+        self.sock.sendto(b'', self.sockname)
+        self._thread.join()
+        self.sock.close()
+
+
+class Registry(registry.RegistryServer):
+
+    responder = None
+
+    def sendto(self, prefix: utils.Prefix, code: int):
+        if self.responder:
+            self.sock.sendto(str(prefix).encode() + bytes((0, code)),
+                             self.responder.sockname)
+
+    def request_dump(self):
+        self.routing.neighbours = {None: (None, [
+            utils.Prefix.fromBin(prefix) for prefix, in self.db.execute(
+                "SELECT prefix FROM cert WHERE cert IS NOT NULL")])}
+
+
+class Node:
+
+    def __init__(self, url: str, path: str, key_path: str, csr: bytes,
+                 token: str, stats: defaultdict):
+        self.url = url
+        self.path = path
+        self.key_path = key_path
+        self.csr = csr
+        self.token = token
+        self.stats = stats
+
+    def call(self, client: registry.RegistryClient, name: str, *args):
+        self._hello = 0
+        t = time.perf_counter()
+        result = getattr(client, name)(*args)
+        self.stats[name].append(time.perf_counter() - t - self._hello)
+        return result
+
+    def hello(self, *args):
+        t = time.perf_counter()
+        result = self._client_hello(*args)
+        self._hello = t = time.perf_counter() - t
+        self.stats['hello'].append(t)
+        return result
+
+    def run(self, ca: str):
+        client = registry.RegistryClient(self.url)
+        cert = self.call(client, 'requestCertificate', self.token, self.csr)
+        client.close()
+        assert cert, "requestCertificate failed"
+        cert_path = os.path.join(self.path, self.token + ".cert")
+        with open(cert_path, "wb") as f:
+            f.write(cert)
+        cert = x509.Cert(ca, self.key_path, cert_path)
+        prefix = cert.prefix
+        client = registry.RegistryClient(self.url, cert)
+        # Time the hello, done by the first authenticated RPC, separately.
+        self._client_hello = client.hello
+        client.hello = self.hello
+        try:
+            for name in ('getNetworkConfig', 'renewCertificate',
+                         'getBootstrapPeer'):
+                assert self.call(client, name, prefix), name + " failed"
+        finally:
+            client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--nodes', type=int, default=1000,
+        help="Number of simulated nodes.")
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+        help="Number of nodes that run at the same time.")
+    parser.add_argument('--workers', type=int, default=8,
+        help="Number of registry threads for cheap requests.")
+    parser.add_argument('--blocking-workers', type=int, default=4,
+        help="Number of registry threads for requests that may block.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        config = Namespace(
+            anonymous_prefix_length=None, authorized_origin=(),
+            ca=os.path.join(path, "ca.cert"), client_count=10,
+            community=None, db=os.path.join(path, "registry.db"),
+            dh=DEMO_PATH / "dh2048.pem", encrypt=False,
+            grace_period=8640000, hello=15, ipv4=None,
+            key=os.path.join(path, "ca.key"), max_clients=None,
+            min_protocol=1, prefix_length=16, run=path,
+            same_country=None, tunnel_refresh=300)
+        tools.create_ca_file(config.key, config.ca)
+        key, csr = tools.generate_csr()
+        key_path = os.path.join(path, "node.key")
+        with open(key_path, "wb") as f:
+            f.write(key)
+        responder = Responder()
+        server = Registry(config, utils.Scheduler())
+        server.responder = responder
+        # The first node gets the prefix of the registry.
+        server.requestCertificate(server.addToken("registry@example.com",
+                                                  None), csr)
+        server.updateHMAC()
+        token_list = [server.addToken("node%u@example.com" % i, None)
+                      for i in range(args.nodes)]
+        reactor = utils.Reactor()
+        frontend = HTTPFrontEnd(reactor, server, args.workers,
+                                args.blocking_workers)
+        frontend.handler_class = QuietRequestHandler
+        url = "http://127.0.0.1:%u/" % frontend.listen("127.0.0.1", 0)[1]
+        stop = False
+        def loop():
+            while not stop:
+                reactor.select()
+        thread = threading.Thread(target=loop)
+        thread.start()
+        stats = defaultdict(list)
+        errors = []
+        lock = threading.Lock()
+        def client():
+            while True:
+                with lock:
+                    if not token_list:
+                        break
+                    token = token_list.pop()
+                try:
+                    Node(url, path, key_path, csr, token, stats).run(config.ca)
+                except Exception as e:
+                    errors.append(e)
+        try:
+            t = time.perf_counter()
+            client_list = [threading.Thread(target=client)
+                           for _ in range(args.concurrency)]
+            for x in client_list:
+                x.start()
+            for x in client_list:
+                x.join()
+            t = time.perf_counter() - t
+        finally:
+            stop = True
+            frontend.wakeup()
+            thread.join()
+            frontend.close()
+            server.close()
+            responder.close()
+    n = sum(map(len, stats.values()))
+    print("%u nodes, %u at a time: %.2f s, %.1f nodes/s, %.1f RPC/s"
+          % (args.nodes, args.concurrency, t, args.nodes / t, n / t))
+    if errors:
+        print("%u nodes failed, e.g.: %r" % (len(errors), errors[0]))
+    print("%-20s %7s %10s %10s %10s" % ("RPC", "count", "p50 (ms)",
+                                         "p99 (ms)", "max (ms)"))
+    for name in ('requestCertificate', 'hello', 'getNetworkConfig',
+                 'renewCertificate', 'getBootstrapPeer'):
+        x = sorted(stats[name])
+        if x:
+            print("%-20s %7u %10.2f %10.2f %10.2f" % (name, len(x),
+                1e3 * x[len(x) // 2], 1e3 * x[len(x) * 99 // 100],
+                1e3 * x[-1]))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Measure registry operations that depend on the number of certificates
+
+The database is filled with copies of the same certificate, with distinct
+metadata columns. Parsing all certificates, which is what getSubjectSerial,
+onTimeout and revoke (by serial) used to do, is compared to the indexed
+queries, and to the one-time migration of a database without these columns.
+"""
+import argparse, os, sqlite3, sys, tempfile, time
+from argparse import Namespace
+
+from re6st import registry, utils
+from re6st.tests import DEMO_PATH, tools
+
+
+def fill(db: sqlite3.Connection, pem: bytes, count: int, columns=True):
+    not_after = int(time.time()) + 86400
+    with db:
+        db.executemany("INSERT INTO cert VALUES (?,?,?%s)"
+                       % (",?,?,?" if columns else ""),
+            ((format(i, '020b'), None, pem.decode())
+             + ((i, i - 1, not_after + i) if columns else ())
+             for i in range(1, count + 1)))
+
+
+def timeit(f, *args) -> float:
+    t = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--certificates', type=int, default=100000,
+        help="Number of certificates.")
+    args = parser.parse_args()
+    n = args.certificates
+    with tempfile.TemporaryDirectory() as path:
+        config = Namespace(
+            anonymous_prefix_length=None, authorized_origin=(),
+            ca=os.path.join(path, "ca.cert"), client_count=10,
+            community=None, db=os.path.join(path, "registry.db"),
+            dh=DEMO_PATH / "dh2048.pem", encrypt=False,
+            grace_period=8640000, hello=15, ipv4=None,
+            key=os.path.join(path, "ca.key"), max_clients=None,
+            min_protocol=1, prefix_length=20, run=path, same_country=None,
+            tunnel_refresh=300)
+        ca_key, ca = tools.create_ca_file(config.key, config.ca)
+        _, csr = tools.generate_csr()
+        pem = tools.generate_cert(ca, ca_key, csr, None, 1)
+        server = registry.RegistryServer(config, utils.Scheduler())
+        try:
+            fill(server.db, pem, n)
+            print("%u certificates" % n)
+            print("parse all certificates: %9.2f ms" % (1e3 * timeit(
+                lambda: [x[0].get_subject().serialNumber
+                         for x in server.iterCert()])))
+            print("getSubjectSerial:       %9.2f ms" % (1e3 * timeit(
+                server.getSubjectSerial)))
+            server.db.execute("UPDATE cert SET subject_serial=null"
+                              " WHERE subject_serial=?", (n // 2,))
+            print("  with a gap in middle: %9.2f ms" % (1e3 * timeit(
+                server.getSubjectSerial)))
+            print("onTimeout:              %9.2f ms" % (1e3 * timeit(
+                server.onTimeout)))
+            print("revoke (by serial):     %9.2f ms" % (1e3 * timeit(
+                server.revoke, n // 3)))
+        finally:
+            server.close()
+        db = sqlite3.connect(os.path.join(path, "legacy.db"),
+                             isolation_level=None)
+        utils.sqliteCreateTable(db, "cert", *registry.CERT_COLUMNS[:3])
+        fill(db, pem, n, False)
+        db.execute("BEGIN")
+        with db:
+            print("migration:              %9.2f ms" % (1e3 * timeit(
+                server._migrateCertTable, db)))
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Measure the time for a node to get its configuration from the registry
+
+A registry is started on the loopback interface, with the same HTTP request
+handler as re6st-registry, and a node is registered. Then each run creates
+a new RegistryClient and calls what a starting node needs: getCa,
+getNetworkConfig, renewCertificate and getDh (the first authenticated call
+also does a hello). With --auto-close, the connection is closed after
+each call, as RegistryClient used to do.
+
+On the loopback interface, a new connection costs little: the difference
+is larger with a real round-trip time, and with TLS.
+"""
+import argparse, os, sys, tempfile, threading, time
+from argparse import Namespace
+
+from re6st import registry, utils, x509
+from re6st.cli.registry import HTTPFrontEnd, RequestHandler
+from re6st.tests import DEMO_PATH, tools
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(*args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-n', '--runs', type=int, default=100,
+        help="Number of node startups.")
+    parser.add_argument('--auto-close', action='store_true',
+        help="Close the connection after each call.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        config = Namespace(
+            anonymous_prefix_length=None, authorized_origin=(),
+            ca=os.path.join(path, "ca.cert"), client_count=10,
+            community=None, db=os.path.join(path, "registry.db"),
+            dh=DEMO_PATH / "dh2048.pem", encrypt=False,
+            grace_period=8640000, hello=15, ipv4=None,
+            key=os.path.join(path, "ca.key"), max_clients=None,
+            min_protocol=1, prefix_length=16, run=path, same_country=None,
+            tunnel_refresh=300)
+        tools.create_ca_file(config.key, config.ca)
+        server = registry.RegistryServer(config, utils.Scheduler())
+        key, csr = tools.generate_csr()
+        cert = server.requestCertificate(server.addToken("node@example.com",
+                                                         None), csr)
+        server.updateHMAC()
+        key_path = os.path.join(path, "node.key")
+        cert_path = os.path.join(path, "node.cert")
+        with open(key_path, "wb") as f:
+            f.write(key)
+        with open(cert_path, "wb") as f:
+            f.write(cert)
+        cert = x509.Cert(config.ca, key_path, cert_path)
+        prefix = cert.prefix
+        reactor = utils.Reactor()
+        frontend = HTTPFrontEnd(reactor, server)
+        frontend.handler_class = QuietRequestHandler
+        url = "http://127.0.0.1:%u/" % frontend.listen("127.0.0.1", 0)[1]
+        stop = False
+        def loop():
+            while not stop:
+                reactor.select()
+        thread = threading.Thread(target=loop)
+        thread.start()
+        try:
+            t = time.perf_counter()
+            for _ in range(args.runs):
+                client = registry.RegistryClient(url, cert, args.auto_close)
+                assert client.getCa()
+                assert client.getNetworkConfig(prefix)
+                assert client.renewCertificate(prefix)
+                assert client.getDh(prefix)
+                client.close()
+            t = time.perf_counter() - t
+            print("%.2f ms per node startup" % (1e3 * t / args.runs))
+        finally:
+            stop = True
+            frontend.wakeup()
+            thread.join()
+            frontend.close()
+            server.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
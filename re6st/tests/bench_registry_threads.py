@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Measure the throughput of read-mostly registry RPCs with several threads
+
+RPCs are called directly on a RegistryServer (without HTTP), from a
+variable number of threads, with a mix of hello, getCa, getNetworkConfig,
+isToken and getNodePrefix. With --serialize, each call holds the main lock
+of the registry, as all RPCs used to do.
+"""
+import argparse, os, random, sys, tempfile, threading, time
+from argparse import Namespace
+
+from re6st import registry, utils
+from re6st.tests import DEMO_PATH, tools
+
+
+def newServer(path: str, nodes: int) -> tuple[registry.RegistryServer, list]:
+    config = Namespace(
+        anonymous_prefix_length=None, authorized_origin=(),
+        ca=os.path.join(path, "ca.cert"), client_count=10, community=None,
+        db=os.path.join(path, "registry.db"), dh=DEMO_PATH / "dh2048.pem",
+        encrypt=False, grace_period=8640000, hello=15, ipv4=None,
+        key=os.path.join(path, "ca.key"), max_clients=None, min_protocol=1,
+        prefix_length=16, run=path, same_country=None, tunnel_refresh=300)
+    tools.create_ca_file(config.key, config.ca)
+    server = registry.RegistryServer(config, utils.Scheduler())
+    _, csr = tools.generate_csr()
+    node_list = []
+    for i in range(nodes):
+        email = "node%u@example.com" % i
+        token = server.addToken(email, None)
+        server.requestCertificate(token, csr)
+        node_list.append((server.getNodePrefix(email), email, token))
+    server.updateHMAC()
+    return server, node_list
+
+
+def run(server: registry.RegistryServer, node_list: list, threads: int,
+        duration: float, serialize: bool) -> int:
+    def hello(cn, email, token):
+        server.hello(str(utils.Prefix.fromSubnet(cn)))
+    def getCa(cn, email, token):
+        server.getCa()
+    def getNetworkConfig(cn, email, token):
+        server.getNetworkConfig(str(utils.Prefix.fromSubnet(cn)))
+    def isToken(cn, email, token):
+        server.isToken(token)
+    def getNodePrefix(cn, email, token):
+        server.getNodePrefix(email)
+    rpc_list = hello, getCa, getNetworkConfig, isToken, getNodePrefix
+    count = []
+    end = time.perf_counter() + duration
+    def worker():
+        n = 0
+        while time.perf_counter() < end:
+            rpc = random.choice(rpc_list)
+            node = random.choice(node_list)
+            if serialize:
+                with server.lock:
+                    rpc(*node)
+            else:
+                rpc(*node)
+            n += 1
+        count.append(n)
+    thread_list = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in thread_list:
+        t.start()
+    for t in thread_list:
+        t.join()
+    return sum(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('threads', type=int, nargs='*', default=(1, 2, 4, 8),
+        help="Numbers of threads.")
+    parser.add_argument('-n', '--nodes', type=int, default=100,
+        help="Number of registered nodes.")
+    parser.add_argument('-d', '--duration', type=float, default=3,
+        help="Duration of each measurement, in seconds.")
+    parser.add_argument('--serialize', action='store_true',
+        help="Hold the main lock during each call.")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as path:
+        server, node_list = newServer(path, args.nodes)
+        try:
+            for threads in args.threads:
+                n = run(server, node_list, threads, args.duration,
+                        args.serialize)
+                print("%3u threads: %8.1f RPC/s" % (threads,
+                                                    n / args.duration))
+        finally:
+            server.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
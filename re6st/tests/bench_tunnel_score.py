@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Compare tunnel scoring policies on a simulated network
+
+Like the simulations in simulation/, each node makes a fixed number of
+tunnels and, at each round, replaces one of them: the tunnel policies of
+re6st.tunnel choose the one to remove and the peer to connect to. Routes
+follow babeld metrics, with the RTT penalty configured by the registry
+('max-rtt-penalty 5000 rtt-max 500'), and the reported distance is the
+average latency of routes between all pairs of nodes.
+
+Latencies can be read from a file in the format used by
+simulation/realistic_dataset ('<node> <node> <latency in µs>' per line,
+with nodes numbered from 1). Otherwise, nodes are placed randomly on a
+plane.
+"""
+import argparse, heapq, math, random, sys, time
+from collections import namedtuple
+
+from re6st import tunnel, utils
+
+Neighbour = namedtuple("Neighbour", "rtt")
+
+# Babel link cost, with the RTT penalty of the default network config.
+RXCOST = 256
+MIN_RTT = 10000
+MAX_RTT = 500000
+MAX_RTT_PENALTY = 5000
+
+def linkCost(rtt: int) -> int:
+    return RXCOST + MAX_RTT_PENALTY * min(max(rtt - MIN_RTT, 0),
+                                          MAX_RTT - MIN_RTT) // (MAX_RTT - MIN_RTT)
+
+
+def readLatency(path: str, size: int) -> list[list[int]]:
+    latency = [[0] * size for _ in range(size)]
+    with open(path) as f:
+        for line in f:
+            a, b, x = line.split()
+            a = int(a) - 1
+            b = int(b) - 1
+            if a < size and b < size:
+                x = float(x)
+                # As in simulation/realistic_dataset/latency.cpp
+                latency[a][b] = latency[b][a] = int(x) if x >= 100 else 0
+    return latency
+
+def randomLatency(size: int) -> list[list[int]]:
+    xy = [(random.random(), random.random()) for _ in range(size)]
+    return [[int(5000 + 200000 * math.dist(a, b)) if a is not b else 0
+             for b in xy] for a in xy]
+
+
+class Network:
+
+    def __init__(self, latency: list[list[int]], k: int, max_peers: int):
+        self.latency = latency
+        self.size = size = len(latency)
+        self.k = k
+        self.max_peers = max_peers
+        self.adjacency = [set() for _ in range(size)]
+        self.generated = [set() for _ in range(size)]
+        for node in range(size):
+            for _ in range(50):
+                if len(self.generated[node]) >= k:
+                    break
+                self.addEdge(node, random.randrange(size))
+
+    def addEdge(self, a: int, b: int) -> bool:
+        if (a != b and self.latency[a][b] and b not in self.adjacency[a]
+            and len(self.adjacency[b]) + self.k
+                < self.max_peers + len(self.generated[b])):
+            self.generated[a].add(b)
+            self.adjacency[a].add(b)
+            self.adjacency[b].add(a)
+            return True
+        return False
+
+    def removeEdge(self, a: int, b: int):
+        self.generated[a].discard(b)
+        self.adjacency[a].discard(b)
+        self.adjacency[b].discard(a)
+
+    def routes(self, node: int):
+        """Return metric, latency and first hop of routes from 'node'"""
+        latency = self.latency[node]
+        metric = [None] * self.size
+        distance = [0] * self.size
+        hop = [None] * self.size
+        metric[node] = 0
+        heap = [(0, node)]
+        while heap:
+            m, a = heapq.heappop(heap)
+            if m != metric[a]:
+                continue
+            latency = self.latency[a]
+            for b in self.adjacency[a]:
+                x = m + linkCost(latency[b])
+                if metric[b] is None or x < metric[b]:
+                    metric[b] = x
+                    distance[b] = distance[a] + latency[b]
+                    hop[b] = b if a == node else hop[a]
+                    heapq.heappush(heap, (x, b))
+        return metric, distance, hop
+
+    def round(self, score: tunnel.TunnelScore) -> tuple[float, float]:
+        """Replace 1 tunnel of each node, return average distance (ms)
+        and the ratio of unreachable pairs, before the changes"""
+        routes = list(map(self.routes, range(self.size)))
+        total = unreachable = 0
+        for node, (metric, distance, hop) in enumerate(routes):
+            total += sum(distance)
+            unreachable += metric.count(None)
+            # Remove a tunnel.
+            generated = self.generated[node]
+            if generated:
+                routed = {b: {} for b in self.adjacency[node]}
+                for dst, b in enumerate(hop):
+                    # Tunnels made by other nodes during this round are
+                    # not routed yet.
+                    if b in routed:
+                        routed[b][dst + 1] = None
+                latency = self.latency[node]
+                self.removeEdge(node, min(generated, key=lambda b:
+                    score.tunnel(b, Neighbour(latency[b]), routed[b])))
+            # Make a new one.
+            candidates = [(score.newTunnel(b, (b, 128, m)), b)
+                          for b, m in enumerate(metric)
+                          if m and b not in self.adjacency[node]]
+            candidates.sort(reverse=True)
+            for _, b in candidates:
+                if self.addEdge(node, b):
+                    break
+        pairs = self.size * (self.size - 1)
+        return total / (pairs - unreachable) / 1e3, unreachable / pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=utils.HelpFormatter)
+    parser.add_argument('-p', '--policy', action='append',
+        choices=tunnel.tunnel_score_dict,
+        help="Tunnel scoring policy to compare (default: all).")
+    parser.add_argument('-l', '--latency', metavar='PATH',
+        help="File of latencies between nodes.")
+    parser.add_argument('-n', '--nodes', type=int, default=200,
+        help="Number of nodes.")
+    parser.add_argument('-r', '--rounds', type=int, default=30,
+        help="Number of tunnel refreshes.")
+    parser.add_argument('-k', '--client-count', type=int, default=10,
+        help="Number of client tunnels per node.")
+    parser.add_argument('-m', '--max-peers', type=int, default=30,
+        help="Maximum number of tunnels per node.")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+        help="Seed of the random generator.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    latency = (readLatency(args.latency, args.nodes) if args.latency else
+               randomLatency(args.nodes))
+    for policy in args.policy or tunnel.tunnel_score_dict:
+        random.seed(args.seed)
+        network = Network(latency, args.client_count, args.max_peers)
+        score = tunnel.tunnel_score_dict[policy](set())
+        t = time.perf_counter()
+        result = [network.round(score) for _ in range(args.rounds + 1)]
+        t = time.perf_counter() - t
+        print("%-8s distance: %7.2f ms -> %7.2f ms, unreachable: %.2f%%"
+              " (%.1f s)" % (policy, result[0][0], result[-1][0],
+                             result[-1][1] * 100, t))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
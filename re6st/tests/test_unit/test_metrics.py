@@ -0,0 +1,49 @@
+import threading
+import unittest
+
+from re6st import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        h = metrics.Histogram("h", "a histogram", (1, 2))
+        for x in .5, 1, 1.5, 3:
+            h.observe(x, method='a"b')
+        self.assertEqual(list(h.text()), [
+            '# HELP h a histogram',
+            '# TYPE h histogram',
+            'h_bucket{method="a\\"b",le="1"} 2',
+            'h_bucket{method="a\\"b",le="2"} 3',
+            'h_bucket{method="a\\"b",le="+Inf"} 4',
+            'h_sum{method="a\\"b"} 6.0',
+            'h_count{method="a\\"b"} 4',
+        ])
+
+    def test_gauge(self):
+        g = metrics.Gauge("g", "a gauge",
+                          lambda: {(('x', 'b'),): 2, (('x', 'a'),): 1})
+        c = metrics.Counter("c", "a counter")
+        c.inc(3)
+        self.assertEqual(metrics.exposition((c, g)),
+            '# HELP c a counter\n# TYPE c counter\nc 3\n'
+            '# HELP g a gauge\n# TYPE g gauge\ng{x="a"} 1\ng{x="b"} 2\n')
+
+    def test_timed_lock(self):
+        wait = metrics.Counter("wait", "")
+        contended = metrics.Counter("contended", "")
+        lock = metrics.TimedLock(threading.Lock(), wait, contended, lock="l")
+        with lock:
+            self.assertTrue(lock.locked())
+            self.assertFalse(lock.acquire(False))
+            t = threading.Timer(.01, lock.release)
+            t.start()
+            self.assertTrue(lock.acquire())
+            t.join()
+        self.assertFalse(lock.locked())
+        self.assertEqual(contended.get(lock="l"), 1)
+        self.assertGreater(wait.get(lock="l"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
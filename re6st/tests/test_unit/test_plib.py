@@ -0,0 +1,71 @@
+import os
+import socket
+import tempfile
+import unittest
+from mock import Mock
+
+from re6st import plib, utils
+
+
+class TestManagement(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "re6stnet-tcp.management")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.listen(1)
+        self.reactor = utils.Reactor()
+        self.addCleanup(self.reactor.close)
+        self.management = plib.Management(path, self.reactor)
+        self.addCleanup(self.management.close)
+        self.assertTrue(self.management.open())
+        self.openvpn = server.accept()[0]
+        self.addCleanup(self.openvpn.close)
+
+    def send(self, *lines):
+        self.openvpn.sendall("".join(x + "\r\n" for x in lines).encode())
+        self.reactor.select()
+
+    def test_kill(self):
+        callback = Mock()
+        self.assertTrue(self.management.kill("1/16", callback))
+        self.assertTrue(self.management.kill("2/16", callback))
+        self.assertEqual(self.openvpn.recv(100), b"kill 1/16\nkill 2/16\n")
+        self.send(">INFO:OpenVPN Management Interface Version 5",
+                  "SUCCESS: common name '1/16' found, 1 client(s) killed",
+                  "ERROR: common name '2/16' not found")
+        self.assertEqual(callback.call_args_list[0][0],
+                         ("common name '1/16' found, 1 client(s) killed",))
+        error, = callback.call_args[0]
+        self.assertIsInstance(error, plib.ManagementError)
+        self.assertEqual(str(error), "common name '2/16' not found")
+        self.assertTrue(self.management.kill("3/16", callback))
+        self.openvpn.close()
+        self.reactor.select()
+        callback.assert_called_with(None)
+
+    def test_clientList(self):
+        callback = Mock()
+        self.assertTrue(self.management.clientList(callback))
+        self.assertEqual(self.openvpn.recv(100), b"status 3\n")
+        self.send("TITLE\tOpenVPN 2.6.3",
+                  "HEADER\tCLIENT_LIST\tCommon Name\tReal Address"
+                  "\tBytes Received\tBytes Sent",
+                  "CLIENT_LIST\t1/16\t10.0.0.2:1194\t1234\t5678",
+                  ">BYTECOUNT_CLI:0,1,2")
+        callback.assert_not_called()
+        self.send("GLOBAL_STATS\tMax bcast/mcast queue length\t0", "END")
+        callback.assert_called_once_with([{"Common Name": "1/16",
+            "Real Address": "10.0.0.2:1194",
+            "Bytes Received": 1234, "Bytes Sent": 5678}])
+        self.assertTrue(self.management.clientList(callback))
+        self.openvpn.close()
+        self.reactor.select()
+        callback.assert_called_with(None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,15 +9,18 @@ import hmac
 import hashlib
 import time
 import tempfile
+import threading
+import zlib
 from argparse import Namespace
 from http import HTTPStatus
+import sqlite3
 from sqlite3 import Cursor
 
 from OpenSSL import crypto
 from mock import Mock, patch
 from pathlib import Path
 
-from re6st import registry, x509
+from re6st import registry, utils, x509
 from re6st.tests.tools import *
 from re6st.tests import DEMO_PATH
 
@@ -50,8 +53,9 @@ def insert_cert(cur: Cursor, ca: x509.Cert, prefix: str,
                 not_after=None, email=None):
     key, csr = generate_csr()
     cert = generate_cert(ca.ca, ca.key, csr, prefix, insert_cert.serial, not_after)
-    cur.execute("INSERT INTO cert VALUES (?,?,?)",
-                (prefix, email, cert.decode()))
+    cur.execute("INSERT INTO cert VALUES (?,?,?,?,?,?)",
+                (prefix, email, cert.decode()) + registry.certColumns(
+                    crypto.load_certificate(crypto.FILETYPE_PEM, cert)))
     insert_cert.serial += 1
     return key, cert
 
@@ -71,13 +75,14 @@ class TestRegistryServer(unittest.TestCase):
     def setUpClass(cls):
         # instance a server
         cls.config = load_config()
-        cls.server = registry.RegistryServer(cls.config)
+        cls.server = registry.RegistryServer(cls.config, utils.Scheduler())
 
     @classmethod
     def tearDownClass(cls):
         cls.server.close()
         # remove database
-        for file in [cls.config.db, cls.config.ca, cls.config.key]:
+        for file in [cls.config.db, cls.config.ca, cls.config.key,
+                     "registry-sessions.db"]:
             try:
                 os.unlink(file)
             except Exception:
@@ -87,39 +92,13 @@ class TestRegistryServer(unittest.TestCase):
         self.email = ''.join(random.sample(string.ascii_lowercase, 4)) \
             + "@mail.com"
 
-    def test_recv(self):
-        side_effect = iter([
-            "0001001001001a_msg",
-            "0001001001002\0001dqdq",
-            "0001001001001\000a_msg",
-            "0001001001001\000\4a_msg",
-            "0000000000000\0" # ERROR, IndexError: msg is null
-        ])
-
-        class SocketProxy:
-            def __init__(self, wrappee):
-                self.wrappee = wrappee
-                self.recv = lambda _: next(side_effect)
-
-            def __getattr__(self, attr):
-                return getattr(self.wrappee, attr)
-
-        self.server.sock = SocketProxy(self.server.sock)
-
-        try:
-            res1 = self.server.recv(4)
-            res2 = self.server.recv(4)
-            res3 = self.server.recv(4)
-            res4 = self.server.recv(4)
-
-            self.assertEqual(res1, (None, None)) # not contain \0
-            self.assertEqual(res2, (None, None)) # binary to digital failed
-            self.assertEqual(res3, (None, None)) # code don't match
-            self.assertEqual(res4, ("0001001001001", "a_msg"))
-        except:
-            pass
-        finally:
-            del self.server.sock.recv
+    def test_decodeReply(self):
+        decode = self.server.decodeReply
+        self.assertEqual(decode(b"0001001001001a_msg"), (None,) * 3)
+        self.assertEqual(decode(b"0001001001002\0\1dqdq"), (None,) * 3)
+        self.assertEqual(decode(b"0000000000000\0"), (None,) * 3)
+        self.assertEqual(decode(b"0001001001001\0\4a_msg"),
+                         (utils.Prefix.fromBin("0001001001001"), 4, "a_msg"))
 
     def test_onTimeout(self):
         # old token, cert, not old token, cert
@@ -210,6 +189,91 @@ class TestRegistryServer(unittest.TestCase):
         request_bad.send_error.assert_called_once_with(HTTPStatus.FORBIDDEN)
         request_good.send_response.assert_called_once_with(HTTPStatus.NO_CONTENT)
 
+    @patch("re6st.registry.RegistryServer.func", create=True)
+    def test_handle_request_etag(self, func):
+        method = "func"
+        func.getcallargs.return_value = {}
+        del func._private
+        func.return_value = result = registry.Entity(b"a_result")
+        request = Mock()
+        request.headers = {"If-None-Match": result.etag}
+        self.server.handle_request(request, method, {})
+        request.send_response.assert_called_once_with(HTTPStatus.NOT_MODIFIED)
+        request.send_header.assert_called_once_with("ETag", result.etag)
+        request.wfile.write.assert_not_called()
+        request.headers = {"If-None-Match": '"old"'}
+        request.send_response.reset_mock()
+        request.send_header.reset_mock()
+        self.server.handle_request(request, method, {})
+        request.send_response.assert_called_once_with(HTTPStatus.OK)
+        request.send_header.assert_any_call("ETag", result.etag)
+        request.wfile.write.assert_called_once_with(result)
+
+    @patch("re6st.registry.RegistryServer.metricsFunc", create=True)
+    def test_metrics(self, func):
+        method = "metricsFunc"
+        func.getcallargs.return_value = {}
+        func.return_value = None
+        request = Mock()
+        request.client_address = ["wrong_address"]
+        self.server.handle_request(request, method, {})
+        del func._private
+        request.headers = {}
+        self.server.handle_request(request, method, {})
+        func.side_effect = registry.HTTPError(HTTPStatus.NOT_FOUND)
+        self.server.handle_request(request, method, {})
+        func.side_effect = ValueError
+        self.server.handle_request(request, method, {})
+        func.getcallargs.side_effect = TypeError
+        self.assertRaises(TypeError,
+                          self.server.handle_request, request, method, {})
+        lines = self.server.metrics().splitlines()
+        for status in 204, 400, 403, 404, 500:
+            self.assertIn('re6st_registry_request_seconds_count'
+                '{method="metricsFunc",status="%s"} 1' % status, lines)
+        self.assertIn('re6st_registry_lock_wait_seconds_total', str(lines))
+        self.assertIn('re6st_registry_sqlite_seconds_count{db="main"}',
+                      str(lines))
+        self.assertIn('re6st_registry_sessions{where="memory"} %u'
+                      % len(self.server.sessions), lines)
+        self.assertIn('re6st_registry_crl %u' % self.server.db.execute(
+            "SELECT count(*) FROM crl").fetchone()[0], lines)
+        self.assertIn('re6st_registry_prefix_fragmentation{community=""}',
+                      str(lines))
+
+    def test_getNetworkConfig(self):
+        prefix = "0000000110"
+        insert_cert(self.server.db, self.server.cert, prefix)
+        self.addCleanup(delete_cert, self.server.db, prefix)
+        with self.server.lock:
+            self.server.setConfig(registry.BABEL_HMAC[0], b'a_key')
+            self.server.setConfig(registry.BABEL_HMAC[1], b'')
+            self.server.network_config = {'version': 'AQ==', 'crl': [1]}
+        result = self.server.getNetworkConfig(prefix)
+        config = json.loads(zlib.decompress(result))
+        self.assertEqual(config.pop('babel_hmac_accept'), '')
+        self.assertTrue(config.pop('babel_hmac_sign'))
+        self.assertEqual(config, {'version': 'AQ==', 'crl': [1]})
+        # Keys are encrypted once per version.
+        self.assertIs(self.server.getNetworkConfig(prefix), result)
+        with self.server.lock:
+            self.server.network_config = {'version': 'Ag=='}
+        x = self.server.getNetworkConfig(prefix)
+        self.assertNotEqual(x.etag, result.etag)
+        self.assertIn('babel_hmac_sign', json.loads(zlib.decompress(x)))
+        # The cache is bounded, and nodes that leave are dropped from it.
+        with patch.object(self.server, "network_config_cache_size", 1):
+            other = "0000000111"
+            insert_cert(self.server.db, self.server.cert, other)
+            self.addCleanup(delete_cert, self.server.db, other)
+            self.server.getNetworkConfig(other)
+            self.assertEqual(list(self.server._network_config_dict), [other])
+        self.server._dropNode(other)
+        self.assertFalse(self.server._network_config_dict)
+        self.assertIs(self.server.getCa(), self.server.getCa())
+        self.assertEqual(self.server.getDh(prefix).etag,
+                         self.server.getDh(prefix).etag)
+
     # will cause valueError, if a node send hello twice to a registry
     def test_getPeerProtocol(self):
         prefix = "0000000011111110"
@@ -241,6 +305,32 @@ class TestRegistryServer(unittest.TestCase):
         self.server.sessions[prefix][-1] = None
         delete_cert(cur, prefix)
 
+    def test_sessions(self):
+        server = self.server
+        prefix_list = "0000000011110001", "0000000011110010"
+        for prefix in prefix_list:
+            insert_cert(server.db, server.cert, prefix)
+            self.addCleanup(delete_cert, server.db, prefix)
+            server.hello(prefix, protocol=7)
+        # Sessions survive a restart.
+        server.sessions.clear()
+        self.assertEqual(server.getPeerProtocol(prefix_list[0]), 7)
+        # Least recently used sessions are only kept in the database.
+        with patch.object(server, "session_cache_size", 1):
+            self.assertEqual(server.getPeerProtocol(prefix_list[1]), 7)
+        self.assertEqual(list(server.sessions), [prefix_list[1]])
+        # Idle sessions are deleted.
+        server._session_db.execute("UPDATE session SET last_used=0"
+                                   " WHERE prefix=?", (prefix_list[0],))
+        server._purgeSessions()
+        with server.sessions_lock:
+            self.assertIsNone(server._getSession(prefix_list[0]))
+            self.assertIsNotNone(server._getSession(prefix_list[1]))
+        server._dropNode(prefix_list[1])
+        self.assertFalse(server._session_db.execute(
+            "SELECT 1 FROM session WHERE prefix=?", (prefix_list[1],)
+            ).fetchone())
+
     def test_addToken(self):
         # generate random token
         token_spec = "aaaabbbb"
@@ -256,16 +346,40 @@ class TestRegistryServer(unittest.TestCase):
         self.server.deleteToken(token)
         self.server.deleteToken(token_spec)
 
-    @unittest.skip("newPrefix api change")
     def test_newPrefix(self):
-        length = 16
-
-        res = self.server.newPrefix(length)
-
-        self.assertEqual(len(res), length)
-        self.assertLessEqual(set(res), {'0', '1'}, "%s is not a binary" % res)
-
-        # TODO test too many prefix
+        db = sqlite3.connect(":memory:", isolation_level=None)
+        utils.sqliteCreateTable(db, "cert", *registry.CERT_COLUMNS)
+        db.execute("INSERT INTO cert (prefix) VALUES ('')")
+        allocator = registry.PrefixAllocator(('01', '1'), 4)
+        allocator.load(db)
+        prefixes = lambda: dict(db.execute("SELECT prefix, cert FROM cert"))
+        # 1000 is reserved.
+        self.assertEqual(allocator.allocate(db, 3, '1'), '1001')
+        self.assertEqual(prefixes(), {'0': None, '11': None, '101': None,
+                                      '1000': 'reserved', '1001': None})
+        self.assertEqual(allocator.allocate(db, 1, '1'), '11')
+        self.assertEqual(allocator.allocate(db, 1, '01'), '010')
+        db.execute("UPDATE cert SET cert='x' WHERE cert IS NULL"
+                   " AND prefix IN ('1001', '11', '010')")
+        stats = allocator.stats()
+        self.assertEqual(stats['1'], {'free': 1, 'space': 2, 'largest': 2,
+                                      'lengths': {3: 1}, 'fragmentation': 0})
+        self.assertEqual(stats['01'], stats['1'])
+        self.assertEqual(stats[None]['space'], 4)
+        self.assertRaises(registry.HTTPError, allocator.allocate, db, 0, '01')
+        # Free prefixes are merged with their buddies.
+        for prefix in '010', '11':
+            db.execute("UPDATE cert SET cert=null WHERE prefix=?", (prefix,))
+            allocator.free(db, prefix)
+        self.assertEqual(prefixes(), {'0': None, '11': None, '101': None,
+                                      '1000': 'reserved', '1001': 'x'})
+        stats = allocator.stats()
+        self.assertEqual(set(stats), {None, '1'})
+        self.assertAlmostEqual(stats['1']['fragmentation'], 1/3)
+        # Same state after reloading from the database.
+        free = allocator._free
+        allocator.load(db)
+        self.assertEqual(allocator._free, free)
 
     @patch("re6st.registry.RegistryServer.sendto", Mock())
     @patch("re6st.registry.RegistryServer.createCertificate")
@@ -310,7 +424,7 @@ class TestRegistryServer(unittest.TestCase):
         prefix = "00011111101001110"
         subject = req.get_subject()
         subject.serialNumber = str(self.server.getSubjectSerial())
-        self.server.db.execute("INSERT INTO cert VALUES (?,null,null)", (prefix,))
+        self.server.db.execute("INSERT INTO cert (prefix) VALUES (?)", (prefix,))
 
         cert = self.server.createCertificate(prefix, subject, req.get_pubkey())
 
@@ -345,17 +459,74 @@ class TestRegistryServer(unittest.TestCase):
         delete_cert(cur, prefix_new)
         cur.close()
 
-    @patch("re6st.registry.RegistryServer.sendto", Mock())
-    @patch("re6st.registry.RegistryServer.recv")
-    @patch("select.select", Mock(return_value=[1]))
-    def test_queryAddress(self, recv):
-        prefix = "000100100010001"
+    @patch("re6st.registry.RegistryServer.sendto")
+    def test_queryAddress(self, sendto):
+        prefix = utils.Prefix.fromBin("000100100010001")
         # one bad, one correct prefix
-        recv.side_effect = [("0", "a msg"), (prefix, "other msg")]
+        def reply(*args):
+            self.server.dispatch(utils.Prefix.fromBin("0"), 1, "a msg")
+            self.server.dispatch(prefix, 1, "other msg")
+        sendto.side_effect = reply
 
         res = self.server._queryAddress(prefix)
 
         self.assertEqual(res, "other msg")
+        sendto.assert_called_once_with(prefix, 1)
+        self.assertEqual(self.server._reply_dict, {})
+
+    @patch("re6st.registry.RegistryServer.reply_timeout", 5)
+    @patch("re6st.registry.RegistryServer.sendto")
+    def test_concurrent_query(self, sendto):
+        prefix = utils.Prefix.fromBin("000100100010010")
+        result = []
+        def query():
+            result.append(self.server.query(prefix, 1))
+        # Queries wait for the reply without holding the main lock,
+        # and the same request is shared.
+        with self.server.lock:
+            thread_list = [threading.Thread(target=query) for _ in range(2)]
+            for t in thread_list:
+                t.start()
+            while (prefix, 1) not in self.server._reply_dict:
+                time.sleep(.01)
+            condition = self.server._reply_dict[prefix, 1]._condition
+            while len(condition._waiters) < 2:
+                time.sleep(.01)
+            self.server.dispatch(prefix, 1, "address")
+            for t in thread_list:
+                t.join()
+        self.assertEqual(result, ["address", "address"])
+        sendto.assert_called_once_with(prefix, 1)
+        with patch.object(self.server, "reply_timeout", 0):
+            self.assertIsNone(self.server.query(prefix, 1))
+        self.assertEqual(self.server._reply_dict, {})
+
+    def test_migrateCertTable(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        config = Namespace(**vars(self.config))
+        config.db = os.path.join(tmpdir.name, "registry.db")
+        db = sqlite3.connect(config.db)
+        utils.sqliteCreateTable(db, "cert", "prefix TEXT PRIMARY KEY NOT NULL",
+                                "email TEXT", "cert TEXT")
+        _, csr = generate_csr()
+        cert = generate_cert(self.server.cert.ca, self.server.cert.key, csr,
+                             "01", 1000)
+        db.executemany("INSERT INTO cert VALUES (?,?,?)", (
+            ("00", None, None), ("01", "a@b.c", cert.decode()),
+            ("1", None, "reserved")))
+        db.commit()
+        db.close()
+        server = registry.RegistryServer(config, utils.Scheduler())
+        self.addCleanup(server.close)
+        cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+        self.assertEqual(server.db.execute(
+            "SELECT * FROM cert ORDER BY prefix").fetchall(), [
+            ("00", None, None, None, None, None),
+            ("01", "a@b.c", crypto.dump_certificate(crypto.FILETYPE_PEM,
+             cert).decode()) + registry.certColumns(cert),
+            ("1", None, "reserved", None, None, None)])
+        self.assertEqual(server.getSubjectSerial(), 0)
 
     @patch('re6st.registry.RegistryServer.updateNetworkConfig')
     def test_revoke(self, mock_func):
@@ -434,11 +605,10 @@ class TestRegistryServer(unittest.TestCase):
 
         self.assertEqual(res, prefix2cn(prefix))
 
-    @patch("select.select")
-    @patch("re6st.registry.RegistryServer.recv")
-    @patch("re6st.registry.RegistryServer.sendto", Mock())
+    @patch("re6st.registry.RegistryServer.reply_timeout", .1)
+    @patch("re6st.registry.RegistryServer.sendto")
     # use case which recored form demo
-    def test_topology(self, recv, select):
+    def test_topology(self, sendto):
         recv_case = [
             ('0000000000000000', '2 6/16 7/16 1/16 3/16 36893488147419103232/80 4/16'),
             ('00000000000000100000000000000000000000000000000000000000000000000000000000000000', '2 0/16 7/16'),
@@ -447,15 +617,11 @@ class TestRegistryServer(unittest.TestCase):
             ('0000000000000111', '2 4/16 6/16 0/16 3/16 36893488147419103232/80'),
             ('0000000000000001', '2 0/16 6/16')
         ]
-        recv.side_effect = recv_case
-
-        def side_effct(rlist, wlist, elist, timeout):
-            # rlist is true until the len(recv_case)th call
-            side_effct.i -= side_effct.i > 0
-            return [side_effct.i, wlist, None]
-
-        side_effct.i = len(recv_case) + 1
-        select.side_effect = side_effct
+        def reply(*args):
+            if sendto.call_count == 1:
+                for prefix, x in recv_case:
+                    self.server.dispatch(utils.Prefix.fromBin(prefix), 5, x)
+        sendto.side_effect = reply
 
         res = self.server.topology()
 
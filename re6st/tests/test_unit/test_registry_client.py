@@ -5,6 +5,7 @@ import hmac
 import http.client
 import base64
 import hashlib
+import time
 from http import HTTPStatus
 from mock import Mock, patch
 
@@ -70,9 +71,54 @@ class TestRegistryClient(unittest.TestCase):
         self.assertEqual(self.client._hmac, hashlib.sha1(key).digest())
         conn = self.client._conn
         conn.putheader.assert_called_with("Re6stHMAC", base64.b64encode(h))
-        conn.close.assert_called_once()
+        # The connection is kept open.
+        conn.close.assert_not_called()
         self.assertEqual(res, body)
 
+    def test_auto_close(self):
+        client = registry.RegistryClient("http://10.0.0.2/", auto_close=True)
+        client._conn = conn = Mock()
+        conn.getresponse.return_value = fakeResponse(b"a_cert", HTTPStatus.OK)
+        client.getCa()
+        conn.close.assert_called_once()
+
+    def test_reconnect(self):
+        client = registry.RegistryClient("http://10.0.0.2/")
+        client._conn = conn = Mock()
+        response = fakeResponse(b"a_cert", HTTPStatus.OK)
+        conn.getresponse.return_value = response
+        self.assertEqual(client.getCa(), b"a_cert")
+        # The registry closed the idle connection.
+        conn.getresponse.side_effect = http.client.RemoteDisconnected, response
+        self.assertEqual(client.getCa(), b"a_cert")
+        conn.close.assert_called_once()
+        self.assertEqual(conn.putrequest.call_count, 3)
+        # A new connection is not retried.
+        conn.getresponse.side_effect = http.client.RemoteDisconnected
+        client.close()
+        self.assertIsNone(client.getCa())
+        self.assertEqual(conn.putrequest.call_count, 4)
+        # Nor one that has been idle for too long.
+        conn.getresponse.side_effect = None
+        client.getCa()
+        conn.reset_mock()
+        with patch("time.time", return_value=time.time() + 60):
+            client.getCa()
+        conn.close.assert_called_once()
+        conn.putrequest.assert_called_once()
+
+    def test_rpc_not_modified(self):
+        client = registry.RegistryClient("http://10.0.0.2/")
+        client._conn = conn = Mock()
+        response = fakeResponse(b"a_cert", HTTPStatus.OK)
+        response.msg = {"ETag": '"abc"'}
+        conn.getresponse.return_value = response
+        self.assertEqual(client.getCa(), b"a_cert")
+        conn.getresponse.return_value = fakeResponse(
+            b"", HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(client.getCa(), b"a_cert")
+        conn.putheader.assert_called_with('If-None-Match', '"abc"')
+
 
 class fakeResponse:
 
@@ -80,6 +126,7 @@ class fakeResponse:
         self.body = body
         self.status = status
         self.reason = reason
+        self.msg = {}
 
     def read(self):
         return self.body
@@ -0,0 +1,122 @@
+import http.client
+import socket
+import threading
+import unittest
+from http import HTTPStatus
+
+from re6st import registry, utils
+from re6st.cli.registry import HTTPFrontEnd, RequestHandler
+
+
+class QuietRequestHandler(RequestHandler):
+
+    def log_message(*args):
+        pass
+
+
+class FakeRegistry:
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def getCa(self):
+        return b"a_cert"
+
+    @registry.blocking
+    def getBootstrapPeer(self):
+        self.event.wait(10)
+        return b"a_peer"
+
+    def handle_request(self, request, method, kw):
+        result = getattr(self, method)(**kw)
+        request.send_response(HTTPStatus.OK)
+        request.send_header("Content-Length", str(len(result)))
+        request.end_headers()
+        request.wfile.write(result)
+
+
+class TestHTTPFrontEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = FakeRegistry()
+        self.reactor = reactor = utils.Reactor()
+        self.frontend = frontend = HTTPFrontEnd(reactor, self.registry,
+                                                workers=1, blocking_workers=1)
+        frontend.handler_class = QuietRequestHandler
+        self.port = frontend.listen("127.0.0.1", 0)[1]
+        self.stop = False
+        def loop():
+            while not self.stop:
+                reactor.select()
+        thread = threading.Thread(target=loop)
+        thread.start()
+        def cleanup():
+            self.registry.event.set()
+            self.stop = True
+            frontend.wakeup()
+            thread.join()
+            frontend.close()
+            reactor.close()
+        self.addCleanup(cleanup)
+
+    def get(self, conn, path):
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, response.read()
+
+    def test_keepalive(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port)
+        for _ in range(3):
+            self.assertEqual(self.get(conn, "/getCa"),
+                             (HTTPStatus.OK, b"a_cert"))
+        self.assertEqual(self.get(conn, "/a/getCa")[0],
+                         HTTPStatus.BAD_REQUEST)
+        conn.close()
+        metrics = self.frontend.metrics()
+        self.assertEqual(metrics['accepted'], 1)
+        self.assertEqual(metrics['requests'], 3)
+
+    def test_pipelining(self):
+        # A partial request doesn't hold the only worker.
+        slow = socket.create_connection(("127.0.0.1", self.port))
+        self.addCleanup(slow.close)
+        slow.sendall(b"GET /getCa HTTP/1.1\r\n")
+        conn = http.client.HTTPConnection("127.0.0.1", self.port)
+        self.assertEqual(self.get(conn, "/getCa"), (HTTPStatus.OK, b"a_cert"))
+        conn.close()
+        # Requests received at once are all answered.
+        slow.sendall(b"Host: x\r\n\r\nGET /getCa HTTP/1.1\r\n\r\n")
+        slow.settimeout(10)
+        response = b""
+        while response.count(b"a_cert") < 2:
+            data = slow.recv(4096)
+            self.assertTrue(data)
+            response += data
+        self.assertEqual(response.count(b"200 OK"), 2)
+
+    def test_blocking(self):
+        result = []
+        def getBootstrapPeer():
+            conn = http.client.HTTPConnection("127.0.0.1", self.port)
+            result.append(self.get(conn, "/getBootstrapPeer"))
+            conn.close()
+        thread = threading.Thread(target=getBootstrapPeer)
+        thread.start()
+        # Cheap RPCs are not delayed by blocking ones.
+        conn = http.client.HTTPConnection("127.0.0.1", self.port)
+        self.assertEqual(self.get(conn, "/getCa"), (HTTPStatus.OK, b"a_cert"))
+        self.assertFalse(result)
+        self.registry.event.set()
+        thread.join()
+        self.assertEqual(result, [(HTTPStatus.OK, b"a_peer")])
+        self.assertEqual(self.frontend.metrics()['blocking'], 1)
+        # Requests that waited too long are rejected.
+        self.frontend.deadline = -1
+        self.assertEqual(self.get(conn, "/getCa")[0],
+                         HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertEqual(self.frontend.metrics()['late'], 1)
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from mock import Mock, patch
+
+from re6st import routing, utils
+
+NETWORK = utils.Prefix.fromIp("2001:db8:4200::")[:48]
+
+def ip(x: str) -> bytes:
+    return socket.inet_pton(socket.AF_INET6, x)
+
+def dump(neighbours, routes) -> bytes:
+    b = bytearray(routing.uint16.pack(1))
+    b += struct.pack("!I", 1) + b're6stnet0\0'
+    b += routing.uint16.pack(len(neighbours))
+    for address in neighbours:
+        b += struct.pack("!16sIHHHHHiHH", ip(address), 1,
+                         0xffff, 256, 256, 0, 0, -2, 1, 1)
+    b += routing.uint16.pack(0)
+    b += routing.uint16.pack(len(routes))
+    for prefix, plen, refmetric, address in routes:
+        b += struct.pack("!16sBHHH8siiI16s16sB", ip(prefix), plen, 256, 256,
+                         refmetric, bytes(8), 0, 0, 1, ip(address),
+                         ip(address), 1)
+    return routing.header.pack(1, len(b)) + b
+
+
+class TestBabel(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = Mock()
+        self.babel = routing.Babel("babeld.sock", self.handler, NETWORK,
+                                   Mock(utils.Reactor))
+        self.addCleanup(self.babel._socket.close)
+        self.babel.socket = Mock()
+
+    @patch("logging.trace", create=True)
+    def test_dump(self, log_trace):
+        data = dump(("fe80::1", "fe80::2"), (
+            ("2001:db8:4200:100::", 56, 0, "fe80::1"),
+            ("2001:db8:4200:200::", 56, 256, "fe80::1"),
+            ("2001:db8:4201::", 48, 0, "fe80::2"),
+            ("::", 0, 256, "fe80::2"),
+            ))
+        # Split the packet and append part of another one.
+        self.babel.socket.recv.side_effect = data[:100], data[100:] + b'\0'
+        self.babel._read()
+        self.handler.babel_dump.assert_not_called()
+        self.babel._read()
+        self.handler.babel_dump.assert_called_once_with()
+
+        self.assertEqual(self.babel.interfaces, {1: "re6stnet0"})
+        neighbours = self.babel.neighbours
+        self.assertEqual(sorted(map(str, neighbours)), ["00000001", "None"])
+        neigh, routes = neighbours[utils.Prefix.fromBin("00000001")]
+        self.assertEqual(neigh.address, ip("fe80::1"))
+        self.assertEqual(sorted(map(str, routes)), ["00000001", "00000010"])
+        self.assertEqual(list(neighbours[None][1]), [None])
+        self.assertEqual(self.babel.locked, set())
+
+    def test_records(self):
+        data = dump(("fe80::1",), (("2001:db8:4200:100::", 56, 0, "fe80::1"),
+                                   ("2001:db8:4200:200::", 56, 0, "fe80::1")))
+        _, packet = routing.Packet.response_dict[1](data, routing.header.size)
+        routes = packet.routes
+        self.assertEqual(len(routes), 2)
+        self.assertEqual(routes[-1].prefix, ip("2001:db8:4200:200::"))
+        self.assertEqual([r.plen for r in routes], [56, 56])
+        self.assertEqual(list(routes.unpack())[0][:2],
+                         (ip("2001:db8:4200:100::"), 56))
+        self.assertRaises(IndexError, routes.__getitem__, 2)
+
+    @patch("logging.trace", create=True)
+    def test_monitored_dump(self, log_trace):
+        babel = routing.Babel("babeld.sock", self.handler, NETWORK,
+                              Mock(utils.Reactor), True)
+        self.addCleanup(babel._socket.close)
+        babel.socket = Mock()
+        route = ip("2001:db8:4200:100::"), 56, 256, None, 0, "id", \
+                None, None, 1, ip("fe80::1"), ip("fe80::1"), 1
+        babel.monitor.routes = {"1": route}
+        babel._requestDump()
+        data = dump(("fe80::1",), ())
+        babel.socket.recv.side_effect = data,
+        babel._read()
+        self.handler.babel_dump.assert_called_once_with()
+        self.assertEqual(list(babel.neighbours[utils.Prefix.fromBin(
+            "00000001")][1].values()), [route])
+
+    @patch("logging.trace", create=True)
+    def test_monitored_dump_unknown_neighbour(self, log_trace):
+        babel = routing.Babel("babeld.sock", self.handler, NETWORK,
+                              Mock(utils.Reactor), True)
+        self.addCleanup(babel._socket.close)
+        babel.socket = Mock()
+        route = ip("2001:db8:4200:100::"), 56, 256, None, 0, "id", \
+                None, None, 1, ip("fe80::2"), ip("fe80::2"), 1
+        babel.monitor.routes = {"1": route}
+        babel._requestDump()
+        # fe80::2 appeared after the dump of neighbours.
+        babel.socket.recv.side_effect = dump(("fe80::1",), ()),
+        with patch.object(babel, "send") as send:
+            babel._read()
+        self.handler.babel_dump.assert_not_called()
+        self.assertEqual(send.call_args[0][0].args, (11,)) # full dump
+        babel.socket.recv.side_effect = dump(("fe80::2",), (
+            ("2001:db8:4200:200::", 56, 0, "fe80::2"),)),
+        babel._read()
+        self.handler.babel_dump.assert_called_once_with()
+        self.assertEqual(list(babel.neighbours), [
+            utils.Prefix.fromBin("00000010")])
+
+    def test_configure(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.babel.socket_path = os.path.join(tmpdir.name, "babeld.sock")
+        self.babel._reactor = reactor = utils.Reactor()
+        self.addCleanup(reactor.close)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(routing.localPath(self.babel.socket_path))
+        server.listen(1)
+        def babeld():
+            for _ in range(2):
+                s = server.accept()[0]
+                with s, s.makefile("rwb", buffering=0) as f:
+                    f.write(b"BABEL 1.0\nversion babeld-1.12\nok\n")
+                    for line in f:
+                        f.write(b"bad\n" if b"foo" in line else b"ok\n")
+        t = threading.Thread(target=babeld)
+        t.start()
+        try:
+            self.babel.configure("default hello-interval 4",
+                                 "interface re6stnet1 hello-interval 4")
+            while reactor._selector.get_map():
+                reactor.select()
+            self.handler.babel_configure_failed.assert_not_called()
+            self.babel.configure("foo")
+            while reactor._selector.get_map():
+                reactor.select()
+            self.handler.babel_configure_failed.assert_called_once_with(
+                "'foo': 'bad'")
+            self.assertFalse(reactor._entry) # timeout cancelled
+        finally:
+            t.join()
+        server.close()
+        self.babel.configure("foo")
+        self.assertEqual(self.handler.babel_configure_failed.call_count, 2)
+
+
+class TestMonitor(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "babeld.sock.local")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.listen(1)
+        self.server = server
+        self.reactor = utils.Reactor()
+        self.addCleanup(self.reactor.close)
+        self.callback = Mock()
+        self.monitor = routing.Monitor(path, self.reactor, self.callback)
+        self.monitor.open()
+        self.addCleanup(self.monitor.close)
+        self.babeld = server.accept()[0]
+        self.addCleanup(self.babeld.close)
+        self.assertEqual(self.babeld.recv(100), b"monitor\n")
+
+    def send(self, *lines):
+        self.babeld.sendall("".join(x + "\n" for x in lines).encode())
+        self.reactor.select()
+
+    def test_routes(self):
+        route = ("route %s prefix %s from ::/0 installed %s id 1:2:3:4"
+                 " metric 256 refmetric 0 via fe80::1 if lo")
+        self.send("BABEL 1.0", "ok",
+                  "add neighbour 10 address fe80::1 if lo reach ffff",
+                  "add " + route % (1, "2001:db8:4200:100::/56", "yes"),
+                  "add " + route % (2, "2001:db8:4200:200::/56", "no"),
+                  "add " + route % (3, "10.42.0.0/16", "yes"))
+        self.assertIsNone(self.monitor.routes)
+        self.send("done")
+        self.callback.assert_called_once_with()
+        routes = self.monitor.routes
+        self.assertEqual(list(routes), ["1"])
+        self.assertEqual(routes["1"][:2], (ip("2001:db8:4200:100::"), 56))
+        self.assertEqual(routes["1"][8:10],
+                         (socket.if_nametoindex("lo"), ip("fe80::1")))
+        self.send("change " + route % (2, "2001:db8:4200:200::/56", "yes"),
+                  "flush " + route % (1, "2001:db8:4200:100::/56", "yes"))
+        self.assertEqual(self.callback.call_count, 2)
+        self.assertEqual(list(routes), ["2"])
+        self.send("change neighbour 10 address fe80::1 if lo reach 7fff")
+        self.assertEqual(self.callback.call_count, 3)
+        self.babeld.close()
+        self.reactor.select()
+        self.assertTrue(self.monitor.closed)
+        self.assertIsNone(self.monitor.routes)
+
+    def test_reconnect(self):
+        self.send("BABEL 1.0", "ok", "done")
+        self.assertIsNotNone(self.monitor.routes)
+        # Closing with unread data resets the connection.
+        self.monitor._socket.send(b"x")
+        self.babeld.close()
+        with self.assertLogs(level='INFO') as cm:
+            self.reactor.select()
+        self.assertIn("ConnectionResetError", cm.output[0])
+        self.assertTrue(self.monitor.closed)
+        self.assertIsNone(self.monitor.routes)
+        self.assertIn(self.monitor.open, self.reactor)
+        self.reactor.schedule(0, self.monitor.open) # don't wait
+        self.reactor.select()
+        self.assertFalse(self.monitor.closed)
+        babeld = self.server.accept()[0]
+        self.addCleanup(babeld.close)
+        self.assertEqual(babeld.recv(100), b"monitor\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
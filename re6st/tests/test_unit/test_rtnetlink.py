@@ -0,0 +1,46 @@
+import socket
+import unittest
+from mock import patch
+
+from re6st import rtnetlink
+
+
+@patch("logging.trace", create=True)
+class TestNetlink(unittest.TestCase):
+
+    def setUp(self):
+        self.netlink = rtnetlink.Netlink()
+        self.addCleanup(self.netlink.close)
+
+    def test_route(self, log_trace):
+        with patch.object(self.netlink, "_send") as send:
+            self.netlink.route("add", "10.0.0.0/8", via="10.1.0.1")
+        msg, = send.call_args[0][0]
+        size, type, flags, _, _ = rtnetlink.nlmsghdr.unpack_from(msg)
+        self.assertEqual((size, type), (len(msg), rtnetlink.RTM_NEWROUTE))
+        self.assertTrue(flags & rtnetlink.NLM_F_ACK)
+        rtm = rtnetlink.rtmsg.unpack_from(msg, rtnetlink.nlmsghdr.size)
+        self.assertEqual(rtm[:2], (socket.AF_INET, 8))
+        self.assertIn(rtnetlink._attr(rtnetlink.RTA_GATEWAY,
+                                      socket.inet_aton("10.1.0.1")), msg)
+
+    def test_batch(self, log_trace):
+        # Deleting routes that don't exist fails without side effect,
+        # either because they don't exist or for lack of permission.
+        with patch.object(self.netlink, "_send",
+                          wraps=self.netlink._send) as send:
+            with self.assertRaises(OSError):
+                with self.netlink.batch():
+                    self.netlink.route("del", "2001:db8:1::/64",
+                                       "unreachable")
+                    self.netlink.route("del", "2001:db8:2::/64",
+                                       "unreachable", src="2001:db8::/32")
+                    send.assert_not_called()
+            send.assert_called_once()
+            self.assertEqual(len(send.call_args[0][0]), 2)
+            self.assertRaises(OSError, self.netlink.address,
+                              "del", "2001:db8:1::1/64", "lo")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import random
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    from re6st import simulation
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestSimulation(unittest.TestCase):
+
+    def test_distance(self):
+        network = simulation.Network(4, 1, 1)
+        for a, b in (0, 1), (1, 2):
+            network.connect(network.node_list[a], network.node_list[b])
+        network.update()
+        u = simulation.UNREACHABLE
+        self.assertEqual(network.distance.tolist(), [[0, 1, 2, u],
+                                                     [1, 0, 1, u],
+                                                     [2, 1, 0, u],
+                                                     [u, u, u, 0]])
+        prefix = network.prefix_list
+        neighbours = network.neighbours(1)
+        self.assertEqual(sorted(neighbours), prefix[:3:2])
+        self.assertEqual({p: r[2] for p, r in neighbours[prefix[2]][1].items()},
+                         {prefix[2]: 256})
+        self.assertEqual(network.stats()['unreachable'], .5)
+
+    def test_refresh(self):
+        random.seed(0)
+        network = simulation.Network(100, 5, 10)
+        for _ in range(5):
+            network.refresh()
+        stats = network.stats()
+        self.assertEqual(stats['unreachable'], 0)
+        self.assertLessEqual(len(stats['degree']), 16)
+        for node in network.node_list:
+            self.assertLessEqual(len(node._connection_dict), 5)
+            self.assertLessEqual(len(node._served), 10)
+        network.refresh(.5)
+        self.assertEqual(network.stats()['unreachable'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,10 +3,10 @@ import os
 import sys
 import unittest
 import time
-from mock import patch, Mock
+from mock import patch, MagicMock, Mock
 
 
-from re6st import tunnel
+from re6st import plib, tunnel, utils
 from re6st import x509
 from re6st import cache
 
@@ -31,10 +31,11 @@ class testBaseTunnelManager(unittest.TestCase):
         self.sock = pacher_sock.start()
         self.cache.same_country = False
         self.cache.valid_until = None
+        self.cache.next_renew = time.time() + 86400
 
         address = [(2, [('10.0.0.2', '1194', 'udp'), ('10.0.0.2', '1194', 'tcp')])]
-        self.tunnel = tunnel.BaseTunnelManager(self.control_socket,
-            self.cache, self.cert, None, address)
+        self.tunnel = tunnel.BaseTunnelManager(MagicMock(utils.Reactor),
+            self.control_socket, self.cache, self.cert, None, address)
 
     def tearDown(self):
         self.tunnel.close()
@@ -49,13 +50,15 @@ class testBaseTunnelManager(unittest.TestCase):
             _peers ->  [p1, p3]
             next = p1.stoptime
         """
-        p1 = x509.Peer("00")
-        p2 = x509.Peer("01")
-        p3 = x509.Peer("10")
-        p1.stop_date = time.time() + 1000
-        p2.stop_date = 1
-        p3.stop_date = p1.stop_date + 500
+        p1 = x509.Peer(utils.Prefix.fromBin("00"))
+        p2 = x509.Peer(utils.Prefix.fromBin("01"))
+        p3 = x509.Peer(utils.Prefix.fromBin("10"))
+        stop_date = time.time() + 1000
         self.tunnel._peers = [p1, p2, p3]
+        self.tunnel._setStopDate(p1, stop_date)
+        self.tunnel._setStopDate(p2, 1)
+        self.tunnel._setStopDate(p3, stop_date + 500)
+        selectTimeout.reset_mock()
 
         self.tunnel.invalidatePeers()
 
@@ -70,7 +73,7 @@ class testBaseTunnelManager(unittest.TestCase):
     #     """code is 1, peer and msg not none """
     #     c = b"\x01"
     #     msg = "address"
-    #     peer = x509.Peer("000001")
+    #     peer = x509.Peer(utils.Prefix.fromBin("000001"))
     #     self.tunnel._connecting = {peer}
 
     #     self.tunnel._processPacket(c + msg, peer)
@@ -97,7 +100,7 @@ class testBaseTunnelManager(unittest.TestCase):
         it will truncate address which has more than 3 element
         """
         c = b"\x01"
-        peer = x509.Peer("000001")
+        peer = x509.Peer(utils.Prefix.fromBin("000001"))
         peer.protocol = 1
         self.tunnel._peers.append(peer)
         self.tunnel._address = {1: "1,1,1;0,0,0", 2: "2,2,2,2"}
@@ -113,7 +116,7 @@ class testBaseTunnelManager(unittest.TestCase):
         2 case, one modify the version, one not
         """
         c = b"\x00"
-        peer = x509.Peer("000001")
+        peer = x509.Peer(utils.Prefix.fromBin("000001"))
         version1 = b"00003"
         version2 = b"00007"
         self.tunnel._version = version3 = b"00005"
@@ -127,7 +130,73 @@ class testBaseTunnelManager(unittest.TestCase):
         self.assertEqual(peer.version, version2)
         self.assertEqual(selectTimeout.call_args[0][1], self.tunnel.newVersion)
 
+    def test_handleServerEvent(self):
+        """all queued events are processed, replying when needed"""
+        sock = Mock()
+        sock.recv.side_effect = (
+            b"client-connect\x00" b"1/16\x00re6stnet-tcp\x0012\x0010.0.0.2",
+            b"client-disconnect\x00" b"2/16\x00re6stnet-tcp\x0013\x00::2",
+            BlockingIOError)
+        self.cache.crl = {12}
 
+        self.tunnel.handleServerEvent(sock)
+
+        sock.send.assert_called_once_with(b"\0")
+        self.assertEqual(sock.recv.call_count, 3)
+
+    @patch("logging.trace", create=True)
+    @patch("re6st.tunnel.BaseTunnelManager.selectTimeout")
+    def test_newVersion_revoked(self, selectTimeout, log_trace):
+        """revoked clients are disconnected without restarting"""
+        prefix = utils.Prefix.fromSubnet("1/16")
+        self.tunnel._served[prefix]["re6stnet-tcp"] = 12
+        self.cache.updateConfig.return_value = {"crl"}
+        self.cache.crl = {12}
+        self.cache.min_protocol = 0
+        management = self.tunnel._management["re6stnet-tcp"] = Mock()
+
+        self.tunnel.newVersion()
+
+        management.kill.assert_called_once()
+        self.assertEqual(management.kill.call_args[0][0], "1/16")
+        self.assertNotIn(self.tunnel._restart,
+                         [x[0][1] for x in selectTimeout.call_args_list])
+        # The client may have disconnected in the meantime.
+        management.kill.call_args[0][1](
+            plib.ManagementError("common name '1/16' not found"))
+        self.assertNotIn(self.tunnel._restart,
+                         [x[0][1] for x in selectTimeout.call_args_list])
+        # Fall back to a restart if OpenVPN can't be reached.
+        management.kill.call_args[0][1](None)
+        self.assertEqual(selectTimeout.call_args[0][1], self.tunnel._restart)
+
+    @patch("logging.trace", create=True)
+    @patch("re6st.tunnel.BaseTunnelManager.selectTimeout")
+    def test_newVersion_reconfigure(self, selectTimeout, log_trace):
+        """parameters are applied in place if possible"""
+        self.cache.min_protocol = 0
+        self.cache.crl = ()
+        babel = Mock()
+        self.tunnel.onChange(babel, "hello", "babel_default")
+        self.tunnel.onChange(None, "max_clients")
+
+        self.cache.updateConfig.return_value = ["hello", "babel_default",
+                                                "max_clients"]
+        self.tunnel.newVersion()
+        babel.assert_called_once_with()
+        self.assertNotIn(self.tunnel._restart,
+                         [x[0][1] for x in selectTimeout.call_args_list])
+
+        babel.side_effect = Exception
+        self.tunnel.newVersion()
+        self.assertEqual(selectTimeout.call_args[0][1], self.tunnel._restart)
+
+        babel.reset_mock()
+        selectTimeout.reset_mock()
+        self.cache.updateConfig.return_value = ["hello", "encrypt"]
+        self.tunnel.newVersion()
+        babel.assert_not_called()
+        self.assertEqual(selectTimeout.call_args[0][1], self.tunnel._restart)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import time
+import unittest
+from mock import call, patch, MagicMock, Mock
+
+from re6st import tunnel, utils, x509
+from re6st.tests import tools
+
+
+class testTunnelManager(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        ca_key, ca = tools.create_ca_file("ca.key", "ca.cert")
+        tools.create_cert_file("node.key", "node.cert", ca, ca_key, "00000001", 1)
+        cls.cert = x509.Cert("ca.cert", "node.key", "node.cert")
+
+    def setUp(self):
+        self.cache = Mock()
+        self.cache.same_country = False
+        self.cache.valid_until = None
+        self.cache.next_renew = time.time() + 86400
+        self.cache.tunnel_refresh = 300
+        self.cache.my_address = None
+        for x in "socket.socket", "re6st.utils.setCloexec":
+            patcher = patch(x)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+        patcher = patch("socket.socketpair", return_value=(Mock(), Mock()))
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def tunnelManager(self, iface_pool):
+        tm = tunnel.TunnelManager(MagicMock(utils.Reactor), "babeld.sock",
+            self.cache, self.cert, (), 60, 3, [], None, (), None, None, (),
+            iface_pool=iface_pool)
+        return tm
+
+    @patch("re6st.rtnetlink.tuntap")
+    def test_iface_pool(self, tuntap):
+        tm = self.tunnelManager(2)
+        self.assertEqual(tuntap.call_args_list,
+                         [call("add", "re6stnet1"), call("add", "re6stnet2")])
+        # babeld must know all client interfaces, even those of the pool.
+        self.assertEqual(sorted(tm.clientIfaceList()),
+                         ["re6stnet1", "re6stnet2", "re6stnet3"])
+        a = utils.Prefix.fromBin("0010")
+        self.assertEqual(tm._getFreeInterface(a), "re6stnet1")
+        self.assertEqual(tm._getFreeInterface(a), "re6stnet2")
+        self.assertEqual(tuntap.call_count, 2)
+        self.assertEqual(tm._getFreeInterface(a), "re6stnet3")
+        tuntap.assert_called_with("add", "re6stnet3")
+        self.assertEqual((tm.iface_pool_hits, tm.iface_pool_misses), (2, 1))
+        tm.freeInterface("re6stnet2")
+        self.assertEqual(tm._getFreeInterface(a), "re6stnet2")
+        self.assertEqual((tm.iface_pool_hits, tm.iface_pool_misses), (3, 1))
+
+    @patch("re6st.rtnetlink.tuntap")
+    def test_setClientCount(self, tuntap):
+        tm = self.tunnelManager(1)
+        tm.routing = Mock()
+        tm.setClientCount(5)
+        tm.routing.configure.assert_called_once_with(
+            "interface re6stnet4 type tunnel",
+            "interface re6stnet5 type tunnel")
+        self.assertEqual(list(tm.new_iface_list),
+                         ["re6stnet2", "re6stnet3", "re6stnet4", "re6stnet5"])
+        tm.setClientCount(2)
+        tm.routing.configure.assert_called_once()
+        self.assertEqual(len(tm.new_iface_list), 4)
+        self.assertEqual(tm._client_count, 2)
+
+    @patch("re6st.rtnetlink.tuntap")
+    def test_renewTunnels(self, tuntap):
+        tm = self.tunnelManager(0)
+        a, b, c = map(utils.Prefix.fromBin, ("01", "10", "11"))
+        tm._connection_dict = {a: Mock(), b: Mock(), c: Mock()}
+        self.cache.hello = 15
+        with patch.object(tm, "_kill",
+                          side_effect=tm._connection_dict.pop) as kill, \
+             patch.object(tm, "selectTimeout") as selectTimeout:
+            tm.renewTunnels()
+            kill.assert_called_once_with(a)
+            self.assertEqual(selectTimeout.call_args[0][1], tm._renewNext)
+            # Tunnels that were replaced in the meantime are skipped.
+            tm._connection_dict[b] = Mock()
+            tm._renewNext()
+            kill.assert_called_with(c)
+            selectTimeout.assert_called_once()
+
+    def test_latency_score(self):
+        score = tunnel.LatencyTunnelScore({utils.Prefix.fromBin("11")})
+        a, b, c = map(utils.Prefix.fromBin, ("01", "10", "11"))
+        neighbour = Mock(rtt=40000)
+        routes = dict.fromkeys((a, b, None))
+        # Same number of routes, the slow tunnel is removed first.
+        self.assertLess(score.tunnel(a, neighbour, routes),
+                        score.tunnel(b, Mock(rtt=10000), routes))
+        self.assertLess(score.tunnel(b, neighbour, {None: None}),
+                        score.tunnel(a, neighbour, routes))
+        self.assertGreater(score.tunnel(c, neighbour, routes),
+                           score.tunnel(a, Mock(rtt=0), routes))
+        # Persistent tunnels are made first, and then close peers
+        # are preferred.
+        with patch("random.random", return_value=.5):
+            self.assertGreater(score.newTunnel(a, (None, 0, 256)),
+                               score.newTunnel(b, (None, 0, 1024)))
+            self.assertGreater(score.newTunnel(c, (None, 0, 1024)),
+                               score.newTunnel(a, (None, 0, 256)))
+
+    @patch("re6st.rtnetlink.tuntap", side_effect=(None, PermissionError))
+    def test_iface_pool_error(self, tuntap):
+        self.assertRaises(PermissionError, self.tunnelManager, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
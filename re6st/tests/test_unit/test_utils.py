@@ -0,0 +1,192 @@
+import pickle
+import socket
+import time
+import unittest
+from mock import Mock, patch
+
+from re6st import utils
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = utils.Scheduler()
+
+    def test_order(self):
+        now = time.time()
+        calls = []
+        for x in 3, 1, 2:
+            self.scheduler.schedule(now - x, lambda x=x: calls.append(x))
+        self.scheduler.schedule(now + 10, lambda: calls.append(0))
+        self.scheduler.run()
+        self.assertEqual(calls, [3, 2, 1])
+        self.assertAlmostEqual(self.scheduler.timeout(), 10, 0)
+
+    def test_reschedule(self):
+        now = time.time()
+        callback = Mock()
+        self.scheduler.schedule(now + 10, callback)
+        self.scheduler.schedule(now + 20, callback, False)
+        self.assertAlmostEqual(self.scheduler.timeout(), 10, 0)
+        self.scheduler.schedule(now + 5, callback, False)
+        self.assertAlmostEqual(self.scheduler.timeout(), 5, 0)
+        self.scheduler.schedule(now + 20, callback)
+        self.assertAlmostEqual(self.scheduler.timeout(), 20, 0)
+        self.assertIn(callback, self.scheduler)
+        self.scheduler.cancel(callback)
+        self.assertNotIn(callback, self.scheduler)
+        self.assertIsNone(self.scheduler.timeout())
+        self.scheduler.schedule(float('inf'), callback)
+        self.assertIsNone(self.scheduler.timeout())
+
+    def test_run(self):
+        now = time.time()
+        callback = Mock()
+        self.scheduler.schedule(now + 10, callback)
+        self.scheduler.run()
+        callback.assert_not_called()
+        with patch("time.time", return_value=now + 10):
+            self.scheduler.run()
+            self.scheduler.run()
+        callback.assert_called_once_with()
+        self.assertNotIn(callback, self.scheduler)
+
+    def test_compact(self):
+        callback = Mock()
+        for x in range(1000):
+            self.scheduler.schedule(x, callback)
+        self.assertLess(len(self.scheduler._heap), 100)
+
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = utils.Reactor()
+        self.addCleanup(self.reactor.close)
+        self.a, self.b = socket.socketpair()
+        self.addCleanup(self.a.close)
+        self.addCleanup(self.b.close)
+
+    def test_read(self):
+        read = Mock()
+        self.reactor.addReader(self.a, read)
+        self.reactor.schedule(time.time(), lambda: None)
+        self.reactor.select()
+        read.assert_not_called()
+        self.b.send(b"x")
+        self.reactor.select()
+        read.assert_called_once_with()
+        self.reactor.removeReader(self.a)
+        self.reactor.schedule(time.time(), lambda: None)
+        self.reactor.select()
+        read.assert_called_once_with()
+
+    def test_write(self):
+        read = Mock()
+        write = Mock(side_effect=lambda: self.reactor.removeWriter(self.a))
+        self.reactor.addReader(self.a, read)
+        self.reactor.addWriter(self.a, write)
+        self.reactor.select()
+        write.assert_called_once_with()
+        read.assert_not_called()
+        self.b.send(b"x")
+        self.reactor.select()
+        write.assert_called_once_with()
+        read.assert_called_once_with()
+        self.reactor.unregister(self.a)
+        self.reactor.unregister(self.a)
+
+    def test_timer(self):
+        callback = Mock()
+        self.reactor.schedule(time.time() + .01, callback)
+        self.reactor.select()
+        callback.assert_called_once_with()
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = utils.Reactor()
+        self.addCleanup(self.reactor.close)
+
+    def test_watch(self):
+        callback = Mock()
+        p = utils.Popen(("sh", "-c", "read x"), stdin=-1)
+        self.addCleanup(p.stop)
+        p.watch(self.reactor, callback)
+        p.stdin.close()
+        self.reactor.select()
+        callback.assert_called_once_with()
+        self.assertEqual(p.returncode, 1)
+        p = utils.Popen(("sleep", "10"))
+        p.watch(self.reactor, callback)
+        p.stop()
+        self.assertEqual(len(self.reactor._selector.get_map()), 0)
+
+    def test_restart(self):
+        supervisor = utils.Supervisor(self.reactor)
+        start = Mock(side_effect=lambda: utils.Popen(("false",)))
+        restarted = Mock()
+        supervisor.start("false", start, restarted)
+        self.addCleanup(supervisor.stop, "false")
+        with patch("time.time", return_value=time.time()) as t:
+            self.reactor.select()
+            self.assertEqual(self.reactor._heap[0][0], t() + 1)
+            # Failures that quickly follow restarts increase the delay.
+            t.return_value += 1
+            self.reactor.select()
+            self.assertEqual(supervisor.restart_count, {"false": 1})
+            restarted.assert_called_once_with()
+            with self.assertLogs(level='WARNING') as cm:
+                self.reactor.select()
+            self.assertIn("restarting in 2 seconds (restart #2)",
+                          cm.output[0])
+            self.assertEqual(self.reactor._heap[-1][0], t() + 2)
+        self.assertEqual(start.call_count, 2)
+
+    def test_success(self):
+        supervisor = utils.Supervisor(self.reactor)
+        start = Mock(side_effect=lambda: utils.Popen(("true",)))
+        supervisor.start("true", start, always=False)
+        self.addCleanup(supervisor.stop, "true")
+        self.reactor.select()
+        self.assertFalse(self.reactor._heap)
+        self.assertEqual(start.call_count, 1)
+
+
+class TestPrefix(unittest.TestCase):
+
+    def test_conversions(self):
+        p = utils.Prefix.fromBin("0010")
+        self.assertEqual(str(p), "0010")
+        self.assertEqual(len(p), 4)
+        self.assertEqual(p.subnet, "2/4")
+        self.assertEqual(utils.Prefix.fromSubnet("2/4"), p)
+        self.assertEqual(p.ip(1), "2000::1")
+        self.assertEqual(utils.Prefix.fromIp("2000::1"),
+                         p + utils.Prefix(1, 124))
+        self.assertEqual(str(utils.Prefix.fromBin("")), "")
+        self.assertEqual(pickle.loads(pickle.dumps(p)), p)
+        self.assertRaises(ValueError, utils.Prefix.fromBin, "012")
+        self.assertRaises(ValueError, utils.Prefix.fromSubnet, "4/2")
+
+    def test_ordering(self):
+        texts = ["", "0", "00", "01", "010", "1", "10", "11"]
+        prefixes = sorted(map(utils.Prefix.fromBin, reversed(texts)))
+        self.assertEqual(list(map(str, prefixes)), texts)
+        self.assertEqual(len(set(prefixes)), len(texts))
+        self.assertNotEqual(utils.Prefix.fromBin("0"),
+                            utils.Prefix.fromBin("00"))
+
+    def test_slicing(self):
+        p = utils.Prefix.fromBin("0110100")
+        for i, j in (0, 3), (2, 5), (3, None), (5, 2):
+            self.assertEqual(str(p[i:j]), "0110100"[i:j])
+        self.assertTrue(p.startswith(utils.Prefix.fromBin("011")))
+        self.assertTrue(p.startswith(utils.Prefix()))
+        self.assertFalse(p.startswith(utils.Prefix.fromBin("010")))
+        self.assertFalse(p[:3].startswith(p))
+
+
+if __name__ == "__main__":
+    unittest.main()
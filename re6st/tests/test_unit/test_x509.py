@@ -0,0 +1,132 @@
+import os
+import tempfile
+import time
+import unittest
+from mock import Mock, patch
+
+from OpenSSL import crypto
+
+from re6st import utils, x509
+from re6st.tests import tools
+
+
+class TestCert(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        path = lambda name: os.path.join(cls.tmpdir.name, name)
+        cls.ca_key, cls.ca = tools.create_ca_file(path("ca.key"),
+                                                  path("ca.cert"))
+        tools.create_cert_file(path("node.key"), path("node.cert"),
+                               cls.ca, cls.ca_key, "00000001", 1)
+        cls.cert = x509.Cert(path("ca.cert"), path("node.key"),
+                             path("node.cert"))
+        # Same subject, but different key.
+        cls.other_ca_key, cls.other_ca = tools.create_ca_file(
+            path("other.key"), path("other.cert"))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        self.cert.clearVerifyCache()
+
+    def generate_cert(self, ca, ca_key, serial, not_after=None):
+        _, csr = tools.generate_csr()
+        return tools.generate_cert(ca, ca_key, csr, "00000010", serial,
+                                   not_after)
+
+    def test_loadVerify(self):
+        pem = self.generate_cert(self.ca, self.ca_key, 2)
+        der = crypto.dump_certificate(crypto.FILETYPE_ASN1,
+            crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+
+        cert = self.cert.loadVerify(pem)
+        self.assertEqual(cert.get_serial_number(), 2)
+        cert = self.cert.loadVerify(der, True, crypto.FILETYPE_ASN1)
+        self.assertEqual(x509.subnetFromCert(cert), "2/8")
+
+    def test_loadVerify_errors(self):
+        with self.assertRaises(x509.VerifyError) as cm:
+            self.cert.loadVerify(b"not a certificate", True,
+                                 crypto.FILETYPE_ASN1)
+        self.assertIsNone(cm.exception.args[0])
+        pem = self.generate_cert(self.other_ca, self.other_ca_key, 3)
+        with self.assertRaises(x509.VerifyError) as cm:
+            self.cert.loadVerify(pem, True)
+        self.assertEqual(cm.exception.args[:2], (7, 0))
+        pem = self.generate_cert(self.ca, self.ca_key, 4, time.time() - 10)
+        with self.assertRaises(x509.VerifyError) as cm:
+            self.cert.loadVerify(pem, True)
+        self.assertEqual(cm.exception.args[:2], (10, 0))
+
+    def test_loadVerify_cache(self):
+        pem = self.generate_cert(self.ca, self.ca_key, 5)
+        cert = self.cert.loadVerify(pem, True)
+        with patch("re6st.x509.load_der_x509_certificate",
+                   side_effect=AssertionError):
+            self.assertIs(self.cert.loadVerify(pem, True), cert)
+            self.cert.clearVerifyCache()
+            self.assertRaises(AssertionError,
+                              self.cert.loadVerify, pem, True)
+        # Without 'strict', the certificate is still verified again
+        # once it has expired.
+        cert = self.cert.loadVerify(pem)
+        not_after = x509.notAfter(cert)
+        with patch("re6st.x509.load_der_x509_certificate",
+                   side_effect=AssertionError):
+            self.assertIs(self.cert.loadVerify(pem), cert)
+            with patch("time.time", return_value=not_after + 1):
+                self.assertRaises(AssertionError, self.cert.loadVerify, pem)
+
+    @patch("re6st.x509.VERIFY_CACHE_SIZE", 2)
+    def test_loadVerify_cache_size(self):
+        pem_list = [self.generate_cert(self.ca, self.ca_key, serial)
+                    for serial in (6, 7, 8)]
+        for pem in pem_list:
+            self.cert.loadVerify(pem, True)
+        self.assertEqual(len(self.cert._verified), 2)
+
+
+class TestCookie(unittest.TestCase):
+
+    def test_check(self):
+        cookie = x509.Cookie()
+        address = "2001:db8:42::1", 326
+        c = cookie(address)
+
+        self.assertTrue(cookie.check(address, c))
+        self.assertFalse(cookie.check(("2001:db8:42::2", 326), c))
+        self.assertFalse(cookie.check(address, b""))
+        self.assertFalse(x509.Cookie().check(address, c))
+        with patch("time.time", return_value=time.time() + cookie.period):
+            self.assertTrue(cookie.check(address, c))
+        with patch("time.time",
+                   return_value=time.time() + 2 * cookie.period):
+            self.assertFalse(cookie.check(address, c))
+
+    def test_splitCookie(self):
+        der = b"\x30\x82\x01\x00" + bytes(256)
+        self.assertEqual(x509.splitCookie(der), (der, b""))
+        self.assertEqual(x509.splitCookie(der + b"cookie"), (der, b"cookie"))
+        self.assertEqual(x509.splitCookie(b"\x30\x03abcd"),
+                         (b"\x30\x03abc", b"d"))
+        self.assertEqual(x509.splitCookie(b""), (b"", b""))
+
+    def test_cookieReply(self):
+        cert = Mock()
+        peer = x509.Peer(utils.Prefix.fromBin("0001"))
+        with patch("re6st.x509.Peer._hello0", return_value=b"hello0"):
+            self.assertIsNone(peer.cookieReply(cert, b"cookie"))
+            peer.hello0Sent()
+            self.assertEqual(peer.cookieReply(cert, b"cookie"),
+                             b"hello0cookie")
+            self.assertIsNone(peer.cookieReply(cert, b"cookie"))
+        self.assertTrue(peer.replied())
+        self.assertFalse(peer.replied())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,12 +1,13 @@
-import errno, json, logging, os, platform, random, socket
+import errno, json, logging, math, os, platform, random, socket
 import subprocess, struct, sys, time, weakref
 from collections import defaultdict, deque
 from bisect import bisect, insort
+from heapq import heappop, heappush
 from collections.abc import Iterator, Sequence
 from typing import Callable, TYPE_CHECKING
 
 from OpenSSL import crypto
-from . import plib, routing, utils, version, x509
+from . import plib, routing, rtnetlink, utils, version, x509
 if TYPE_CHECKING:
     from . import cache
 
@@ -38,14 +39,17 @@ def resolve(ip, port, proto: str) \
 
 class MultiGatewayManager(dict):
 
-    def __init__(self, gateway: Callable[[str], str]):
+    def __init__(self, gateway: Callable[[str], str],
+                 netlink: rtnetlink.Netlink):
         self._gw = gateway
+        self._netlink = netlink
+
+    def close(self):
+        self._netlink.close()
 
     def _route(self, cmd: str, dest: str, gw: str):
         if gw:
-            cmd = 'ip', '-4', 'route', cmd, '%s/32' % dest, 'via', gw
-            logging.trace('%r', cmd)
-            subprocess.check_call(cmd)
+            self._netlink.route(cmd, dest + '/32', via=gw)
 
     def add(self, dest: str, route: bool):
         try:
@@ -96,13 +100,16 @@ class Connection:
         self.process = plib.client(
             self.iface, (self.address_list[self._retry],), tm.encrypt,
             '--verify-x509-name',
-                '%u/%u' % (int(self._prefix, 2), len(self._prefix)), 'name',
+                self._prefix.subnet, 'name',
             '--resolv-retry', '0',
             '--connect-retry-max', '3', '--tls-exit',
             '--remap-usr1', 'SIGTERM',
             '--ping-exit', str(tm.timeout),
             '--route-up', '%s %u' % (plib.ovpn_client, tm.write_sock.fileno()),
             *tm.ovpn_args, pass_fds=[tm.write_sock.fileno()])
+        # Check connections as soon as one fails.
+        self.process.watch(tm._reactor,
+            lambda: tm.selectTimeout(time.time(), tm.refresh))
         tm.resetTunnelRefresh()
         self._retry += 1
 
@@ -127,10 +134,9 @@ class Connection:
 
     def refresh(self):
         # Check that the connection is alive
-        if self.process.poll() is not None:
-            logging.info('Connection with %s/%s has failed with return code %s',
-                         int(self._prefix, 2), len(self._prefix),
-                         self.process.returncode)
+        if self.process.returncode is not None:
+            logging.info('Connection with %s has failed with return code %s',
+                         self._prefix.subnet, self.process.returncode)
             if self._retry is None:
                 return 1
             if len(self.address_list) <= self._retry:
@@ -203,11 +209,75 @@ class TunnelKiller:
     locked = unlocking = lambda _: None
 
 
+class TunnelScore:
+    """Policy to choose which tunnels to remove and which ones to make
+
+    Tunnels that carry the fewest routes are removed first, and new
+    tunnels are made to random peers. In both cases, persistent tunnels
+    (see --neighbour option) come first.
+    """
+
+    def __init__(self, neighbour_set: set[utils.Prefix]):
+        self.neighbour_set = neighbour_set
+
+    def tunnel(self, prefix: utils.Prefix, neighbour, routes: dict):
+        """Score of an existing tunnel, the lowest being removed first"""
+        # Ignore the default route, which is redundant with the
+        # border gateway node.
+        n = 0
+        for x in routes:
+            if x:
+                n += 1
+        return (prefix in self.neighbour_set, n) if n else ()
+
+    def newTunnel(self, prefix: utils.Prefix, route: tuple):
+        """Score of a distant peer, the highest being tried first"""
+        return (prefix in self.neighbour_set) + random.random()
+
+
+class LatencyTunnelScore(TunnelScore):
+    """Also take latency into account, as measured by babeld
+
+    The number of routes carried by a tunnel is divided by the square root
+    of its RTT, so that slow tunnels that carry few routes are removed
+    first. Peers are chosen randomly but with a probability inversely
+    proportional to the metric of their routes, which includes the RTT
+    penalty, so that new tunnels tend to be short: long tunnels that
+    shorten paths carry many routes and are kept by the removal policy.
+    """
+
+    # RTT (in µs) under which latency is not considered.
+    min_rtt = 10000
+
+    def tunnel(self, prefix, neighbour, routes):
+        score = super().tunnel(prefix, neighbour, routes)
+        if score:
+            persistent, n = score
+            return persistent, n / math.sqrt(max(neighbour.rtt, self.min_rtt))
+        return score
+
+    def newTunnel(self, prefix, route):
+        # Weighted random sampling (Efraimidis-Spirakis): the highest keys
+        # are those of a random sample with probabilities proportional to
+        # weights, here 256 / metric.
+        return (prefix in self.neighbour_set) + \
+            random.random() ** (max(route[2], 1) / 256)
+
+tunnel_score_dict = {
+    'routes': TunnelScore,
+    'latency': LatencyTunnelScore,
+}
+
+
 class BaseTunnelManager:
 
-    # TODO: To minimize downtime when network parameters change, we should do
-    #       our best to not restart any process. Ideally, this list should be
-    #       empty and the affected subprocesses reloaded.
+    # Parameters that are used by subprocesses or at startup. To minimize
+    # downtime when they change, they are applied in place by the callbacks
+    # registered with onChange, and only the others cause a restart.
+    # babel_hmac_* are never applied in place: statements of the local
+    # interface of babeld can add or replace a key but not remove one, so
+    # the old key of a rotation (see RegistryServer.updateHMAC) would remain
+    # accepted.
     NEED_RESTART = frozenset(('babel_default', 'babel_hmac_accept',
                               'babel_hmac_sign', 'encrypt',
                               'hello', 'ipv4', 'ipv4_sublen'))
@@ -215,15 +285,16 @@ class BaseTunnelManager:
     _geoiplookup = None
     _forward = None
 
-    def __init__(self, control_socket, cache: "cache.Cache", cert: x509.Cert,
-                 conf_country, address=()):
+    def __init__(self, reactor: utils.Reactor, control_socket,
+                 cache: "cache.Cache", cert: x509.Cert, conf_country, address=()):
+        self._reactor = reactor
         self.cert = cert
         self._network = cert.network
         self._prefix = cert.prefix
         self.cache = cache
-        self._connecting = set()
-        self._connection_dict = {}
-        self._served = defaultdict(dict)
+        self._resetTunnels()
+        self._management = {}
+        self._reconfigure = {}
         self._version = cache.version
         self._conf_country = conf_country
 
@@ -274,34 +345,72 @@ class BaseTunnelManager:
         # See also http://stackoverflow.com/questions/597225/
         # about binding and anycast.
         self.sock.bind(('::', PORT))
+        reactor.addReader(self.sock, self.handlePeerEvent)
 
+        self._cookie = x509.Cookie()
         p = x509.Peer(self._prefix)
-        p.stop_date = cache.next_renew
         self._peers = [p]
-        self._timeouts = [(p.stop_date, self.invalidatePeers)]
+        # (stop_date, n, peer), with outdated entries for renewed or
+        # revoked certificates, which are skipped by invalidatePeers
+        self._stop_dates = []
+        self._stop_count = 0
+        self._setStopDate(p, cache.next_renew)
 
         self.routing = routing.Babel(
-            control_socket, weakref.proxy(self), self._network)
+            control_socket, weakref.proxy(self), self._network, reactor, True)
 
-        now = self._next_refresh = time.time()
+        now = time.time()
+        self.selectTimeout(now, self.refresh)
         self._maybe_old_version = None is not cache.valid_until < now
 
+    def _resetTunnels(self):
+        # State of tunnel decisions. The simulator resets it when a
+        # virtual node restarts.
+        self._connecting = set()
+        self._connection_dict = {}
+        self._served = defaultdict(dict)
+
     def close(self):
+        self._reactor.unregister(self.sock)
         self.sock.close()
         self.routing.close()
-
-    def select(self, r, w, t):
-        r[self.sock] = self.handlePeerEvent
-        t += self._timeouts
-        if self._next_refresh:
-            t.append((self._next_refresh, self.refresh))
-        self.routing.select(r, w, t)
+        for management in self._management.values():
+            management.close()
+
+    def addManagement(self, iface: str, socket_path: str):
+        """Register the management socket of the OpenVPN serving 'iface'"""
+        management = self._management.get(iface)
+        if management is not None:
+            management.close()
+        self._management[iface] = plib.Management(socket_path, self._reactor)
+
+    def onChange(self, callback, *names: str):
+        """Call 'callback' when any of the given network parameters change
+
+        If 'callback' is None, changes to these parameters are ignored.
+        """
+        for name in names:
+            callback_list = self._reconfigure.setdefault(name, [])
+            if callback is not None:
+                callback_list.append(callback)
 
     def refresh(self):
-        self._next_refresh = None
         if self._prefix != self.cache.registry_prefix:
             self.__request_dump('check_netconf')
 
+    def resetRouting(self):
+        """Reconnect to babeld, e.g. after it was restarted"""
+        self.routing.reset()
+        try:
+            requesting_dump = self.__requesting_dump
+        except AttributeError:
+            pass
+        else:
+            # Requested dumps are lost.
+            if requesting_dump:
+                self.routing.request_dump()
+        self.selectTimeout(time.time(), self.refresh)
+
     def __request_dump(self, reason):
         try:
             requesting_dump = self.__requesting_dump
@@ -317,43 +426,46 @@ class BaseTunnelManager:
             getattr(self, '_babel_dump_' + x)()
         self.__requesting_dump.clear()
 
+    def babel_changed(self):
+        pass
+
     def selectTimeout(self, next, callback, force=True):
-        t = self._timeouts
-        for i, x in enumerate(t):
-            if x[1] == callback:
-                if not next:
-                    logging.debug("timeout: removing %r (%s)",
-                                  callback.__name__, next)
-                    del t[i]
-                elif force or next < x[0]:
-                    logging.debug("timeout: updating %r (%s)",
-                                  callback.__name__, next)
-                    t[i] = next, callback
-                return
         if next:
-            logging.debug("timeout: adding %r (%s)", callback.__name__, next)
-            t.append((next, callback))
+            logging.debug("timeout: %s %r (%s)",
+                "updating" if callback in self._reactor else "adding",
+                callback.__name__, next)
+        elif callback in self._reactor:
+            logging.debug("timeout: removing %r (%s)", callback.__name__, next)
+        self._reactor.schedule(next or None, callback, force)
+
+    def _setStopDate(self, peer, stop_date):
+        peer.stop_date = stop_date
+        self._stop_count += 1
+        heappush(self._stop_dates, (stop_date, self._stop_count, peer))
+        self.selectTimeout(stop_date, self.invalidatePeers, False)
 
     def invalidatePeers(self):
-        next = float('inf')
         now = time.time()
-        remove = []
-        for i, peer in enumerate(self._peers):
-            if peer.stop_date < now:
-                if peer.prefix == self._prefix:
-                    raise utils.ReexecException("Restart to renew certificate")
-                remove.append(i)
-            elif peer.stop_date < next:
-                next = peer.stop_date
-        for i in reversed(remove):
-            del self._peers[i]
-        self.selectTimeout(next, self.invalidatePeers)
+        stop_dates = self._stop_dates
+        while stop_dates:
+            stop_date, _, peer = stop_dates[0]
+            if now <= stop_date:
+                self.selectTimeout(stop_date, self.invalidatePeers)
+                break
+            heappop(stop_dates)
+            if peer.stop_date != stop_date:
+                continue
+            if peer.prefix == self._prefix:
+                raise utils.ReexecException("Restart to renew certificate")
+            i = bisect(self._peers, peer.prefix) - 1
+            if self._peers[i] is peer:
+                del self._peers[i]
 
     def _getPeer(self, prefix):
         return self._peers[bisect(self._peers, prefix) - 1]
 
-    def sendto(self, prefix: str, msg):
-        to = utils.ipFromBin(self._network + prefix), PORT
+    def sendto(self, prefix: utils.Prefix, msg):
+        to = (self._network + prefix).ip(), PORT
         peer = self._getPeer(prefix)
         if peer.prefix != prefix:
             peer = x509.Peer(prefix)
@@ -385,23 +497,22 @@ class BaseTunnelManager:
         if address[0] == '::1':
             try:
                 prefix, msg = msg.split(b'\0', 1)
-                prefix = prefix.decode()
-                int(prefix, 2)
+                prefix = utils.Prefix.fromBin(prefix.decode())
             except ValueError:
                 return
-            if msg:
+            if prefix and msg:
                 self._forward = to
                 code = msg[0]
                 if prefix == self._prefix:
                     msg = self._processPacket(msg)
                     if msg:
-                        self._sendto(to,
-                                     b'%s\0%c%s' % (prefix.encode(), code, msg))
+                        self._sendto(to, b'%s\0%c%s' % (
+                            str(prefix).encode(), code, msg))
                 else:
                     self.sendto(prefix, bytes([code | 0x80]) + msg[1:])
             return
         try:
-            sender = utils.binFromIp(address[0])
+            sender = utils.Prefix.fromIp(address[0])
         except socket.error:
             return # inet_pton does not parse '<ipv6>%<iface>'
         if len(msg) <= 4 or not sender.startswith(self._network):
@@ -427,9 +538,23 @@ class BaseTunnelManager:
                     if self._sendto(to, b'\0' + self._version, peer) else b''
                 return
             if seqno:
+                if (protocol >= x509.COOKIE_PROTOCOL
+                    and len(msg) == x509.Cookie.size):
+                    # Cookie challenge in reply to our hello0.
+                    if prefix.startswith(peer.prefix):
+                        msg = peer.cookieReply(self.cert.cert, msg)
+                        if msg:
+                            self._sendto(to, msg)
+                    return
                 h = x509.fingerprint(self.cert.cert).digest()
                 seqno = msg.startswith(h)
                 msg = msg[len(h):]
+            msg, cookie = x509.splitCookie(msg)
+            if (self.cache.min_protocol >= x509.COOKIE_PROTOCOL
+                and not self._cookie.check(to, cookie)
+                and not (prefix.startswith(peer.prefix) and peer.replied())):
+                self._sendto(to, self._cookie.challenge(to))
+                return
             try:
                 cert = self.cert.loadVerify(msg,
                     True, crypto.FILETYPE_ASN1)
@@ -443,19 +568,19 @@ class BaseTunnelManager:
                 logging.debug('ignored invalid certificate from %r (%s)',
                               address, e.args[-1])
                 return
-            p = utils.binFromSubnet(x509.subnetFromCert(cert))
+            p = utils.Prefix.fromSubnet(x509.subnetFromCert(cert))
             if p != peer.prefix:
                 if not prefix.startswith(p):
-                    logging.debug('received %s/%s cert from wrong source %r',
-                                  int(p, 2), len(p), address)
+                    logging.debug('received %s cert from wrong source %r',
+                                  p.subnet, address)
                     return
                 peer = x509.Peer(p)
                 insort(self._peers, peer)
             peer.cert = cert
             peer.cert_crypto = x509.load_der_x509_certificate(msg)
             peer.serial = serial
-            peer.stop_date = stop_date
-            self.selectTimeout(stop_date, self.invalidatePeers, False)
+            if peer.stop_date != stop_date:
+                self._setStopDate(peer, stop_date)
             if seqno:
                 self._sendto(to, peer.hello(self.cert, protocol))
             else:
@@ -474,14 +599,14 @@ class BaseTunnelManager:
             answer = self._processPacket(msg, peer.prefix)
             self._sendto(to, msg[0:1] + answer if answer else b'', peer)
 
-    def _processPacket(self, msg: bytes, peer: x509.Peer|str=None):
+    def _processPacket(self, msg: bytes, peer: utils.Prefix=None):
         c = msg[0]
         msg = msg[1:]
         code = c & 0x7f
         if c > 0x7f and msg:
             if peer and self._forward:
                 self._sendto(self._forward,
-                             b'%s\0%c%s' % (peer.encode(), code, msg))
+                             b'%s\0%c%s' % (str(peer).encode(), code, msg))
         elif code == 1: # address
             if msg:
                 if peer:
@@ -538,13 +663,13 @@ class BaseTunnelManager:
             # the registry wants to know the topology for debugging purpose
             if not peer or peer == self.cache.registry_prefix:
                 return (str(len(self._connection_dict)) + ''.join(
-                    ' %s/%s' % (int(x, 2), len(x))
+                    ' ' + x.subnet
                     for x in (self._connection_dict, self._served)
                     for x in x)).encode()
         elif code == 7:
             # XXX: Quick'n dirty way to log in a common place.
             if peer and self._prefix == self.cache.registry_prefix:
-                logging.info("%s/%s: %s", int(peer, 2), len(peer), msg)
+                logging.info("%s: %s", peer.subnet, msg)
 
     @staticmethod
     def _restart():
@@ -553,7 +678,7 @@ class BaseTunnelManager:
 
     def _babel_dump_check_netconf(self):
         now = time.time()
-        self._next_refresh = now + NETCONF_CHECK
+        self.selectTimeout(now + NETCONF_CHECK, self.refresh)
         peers = {prefix
             for neigh_routes in self.routing.neighbours.values()
             for prefix in neigh_routes[1]
@@ -596,32 +721,77 @@ class BaseTunnelManager:
         self.broadcastNewVersion()
         self.cache.warnProtocol()
         crl = self.cache.crl
+        if 'crl' in changed:
+            self.cert.clearVerifyCache()
         for i in reversed([i for i, peer in enumerate(self._peers)
                              if peer.serial in crl]):
             del self._peers[i]
         if self.cert.cert.get_serial_number() in crl:
             raise utils.ReexecException("Our certificate has just been revoked."
                 " Let's try to renew it.")
-        if (not self.NEED_RESTART.isdisjoint(changed)
+        revoked = [(prefix, iface)
+            for prefix, serials in self._served.items()
+            for iface, serial in serials.items()
+            if serial in crl]
+        reconfigure = self._reconfigure
+        if (any(k in self.NEED_RESTART and k not in reconfigure
+                for k in changed)
             or version.protocol < self.cache.min_protocol
-            # TODO: With --management, we could kill clients without restarting.
-            or not all(crl.isdisjoint(serials.values())
-                       for serials in self._served.values())):
-            # Wait at least 1 second to broadcast new version to neighbours.
-            self.selectTimeout(time.time() + 1 + self.cache.delay_restart,
-                               self._restart)
+            or revoked and not self._killServed(revoked)):
+            self._scheduleRestart()
+            return
+        for callback in dict.fromkeys(callback
+                for k in changed for callback in reconfigure.get(k, ())):
+            try:
+                callback()
+            except Exception:
+                logging.warning("failed to apply new network parameters",
+                                exc_info=True)
+                self._scheduleRestart()
+                break
+
+    def babel_configure_failed(self, error: str):
+        logging.warning("failed to apply new network parameters: %s", error)
+        self._scheduleRestart()
+
+    def _scheduleRestart(self):
+        # Wait at least 1 second to broadcast new version to neighbours.
+        self.selectTimeout(time.time() + 1 + self.cache.delay_restart,
+                           self._restart)
+
+    def _killServed(self, revoked: list[tuple[utils.Prefix, str]]) -> bool:
+        """Disconnect served clients, return False if a restart is required"""
+        management = self._management
+        if not all(iface in management for _, iface in revoked):
+            return False
+        def callback(response):
+            # An error is most likely that the client is already
+            # disconnected, and the kill is only redone by a restart
+            # if OpenVPN can't be reached.
+            if response is None:
+                self._scheduleRestart()
+        for prefix, iface in revoked:
+            logging.info("Disconnecting %s from %s (revoked certificate)",
+                         prefix.subnet, iface)
+            if not management[iface].kill(prefix.subnet, callback):
+                return False
+        return True
 
     def handleServerEvent(self, sock: socket.socket):
-        event, args = eval(sock.recv(65536))
-        logging.debug("%s%r", event, args)
-        r = getattr(self, '_ovpn_' + event.replace('-', '_'))(*args)
-        if r is not None:
-            sock.send(bytes([r]))
+        # See ovpn-server. There can be many queued events during
+        # reconnection storms, so process them all.
+        for msg in utils.iterRecv(sock):
+            event, common_name, iface, serial, ip = msg.decode().split('\0')
+            args = common_name, iface, int(serial), ip
+            logging.debug("%s%r", event, args)
+            r = getattr(self, '_ovpn_' + event.replace('-', '_'))(*args)
+            if r is not None:
+                sock.send(bytes([r]))
 
     def _ovpn_client_connect(self, common_name, iface, serial, trusted_ip):
         if serial in self.cache.crl:
             return False
-        prefix = utils.binFromSubnet(common_name)
+        prefix = utils.Prefix.fromSubnet(common_name)
         self._served[prefix][iface] = serial
         if isinstance(self, TunnelManager): # XXX
             if self._gateway_manager is not None:
@@ -632,7 +802,7 @@ class BaseTunnelManager:
         return True
 
     def _ovpn_client_disconnect(self, common_name, iface, serial, trusted_ip):
-        prefix = utils.binFromSubnet(common_name)
+        prefix = utils.Prefix.fromSubnet(common_name)
         serials = self._served.get(prefix)
         try:
             del serials[iface]
@@ -667,40 +837,57 @@ class TunnelManager(BaseTunnelManager):
     NEED_RESTART = BaseTunnelManager.NEED_RESTART.union((
         'client_count', 'max_clients', 'same_country', 'tunnel_refresh'))
 
-    def __init__(self, control_socket, cache, cert, openvpn_args,
+    def __init__(self, reactor, control_socket, cache, cert, openvpn_args,
                  timeout, client_count, iface_list, conf_country, address,
                  ip_changed, remote_gateway: Callable[[str], str],
-                 disable_proto: Sequence[str], neighbour_list=()):
-        super().__init__(control_socket, cache, cert, conf_country, address)
+                 disable_proto: Sequence[str], neighbour_list=(),
+                 iface_pool=0, tunnel_score='routes'):
+        super().__init__(reactor, control_socket, cache, cert,
+                         conf_country, address)
         self.ovpn_args = openvpn_args
         self.timeout = timeout
         self._read_sock, self.write_sock = socket.socketpair(
             socket.AF_UNIX, socket.SOCK_DGRAM)
         utils.setCloexec(self._read_sock)
-        self._disconnected = 0
-        self._distant_peers = []
+        reactor.addReader(self._read_sock, self.handleClientEvent)
         self._iface_to_prefix = {}
         self._iface_list = iface_list
         self._ip_changed = ip_changed
-        self._gateway_manager = MultiGatewayManager(remote_gateway) \
-                                if remote_gateway else None
+        self._gateway_manager = MultiGatewayManager(remote_gateway,
+            rtnetlink.Netlink()) if remote_gateway else None
         self._disable_proto = disable_proto
-        self._neighbour_set = set(map(utils.binFromSubnet, neighbour_list))
-        self._killing = {}
+        self._neighbour_set = set(map(utils.Prefix.fromSubnet, neighbour_list))
+        self._score = tunnel_score_dict[tunnel_score](self._neighbour_set)
 
         self.resetTunnelRefresh()
+        self.onChange(self.resetTunnelRefresh, 'tunnel_refresh')
+        # Client tunnels are then reopened with the new setting.
+        self.onChange(self.renewTunnels, 'encrypt')
+        self._renewing = deque()
 
         self._client_count = client_count
         self.new_iface_list = deque('re6stnet' + str(i)
             for i in range(1, self._client_count + 1))
         self._free_iface_list = []
+        # Pool of free interfaces: a miss means that an interface had to be
+        # created at the time a tunnel was made.
+        self.iface_pool_hits = self.iface_pool_misses = 0
+        self._createInterfaces(iface_pool)
         self._next_netconf_check = float('inf') \
-            if self._prefix == cache.registry_prefix else self._next_refresh
-        self._next_refresh = time.time()
+            if self._prefix == cache.registry_prefix else time.time()
+
+    def _resetTunnels(self):
+        super()._resetTunnels()
+        self._killing = {}
+        self._disconnected = 0
+        self._distant_peers = []
 
     def close(self):
         self.killAll()
         self.delInterfaces()
+        if self._gateway_manager is not None:
+            self._gateway_manager.close()
+        self._reactor.unregister(self._read_sock)
         self._read_sock.close()
         self.write_sock.close()
         super().close()
@@ -715,17 +902,40 @@ class TunnelManager(BaseTunnelManager):
     def _tuntap(self, iface=None):
         if iface:
             self.new_iface_list.appendleft(iface)
-            action = '--rmtun'
+            rtnetlink.tuntap('del', iface)
         else:
             iface = self.new_iface_list.popleft()
-            action = '--mktun'
-        # BBB: do not use 'ip tuntap' which is not available on old dists
-        args = ('openvpn', action, '--verb', '0',
-                '--dev', iface, '--dev-type', 'tap')
-        logging.debug('%r', args)
-        subprocess.check_call(args)
+            rtnetlink.tuntap('add', iface)
         return iface
 
+    def setClientCount(self, client_count):
+        """Change the maximum number of client tunnels
+
+        Extra tunnels are removed progressively, like at each tunnel refresh.
+        """
+        n = (len(self.new_iface_list) + len(self._free_iface_list)
+             + len(self._iface_to_prefix))
+        if n < client_count:
+            # Let babeld know about new interfaces before they're created.
+            new_iface_list = ['re6stnet' + str(i)
+                              for i in range(n + 1, client_count + 1)]
+            self.routing.configure(*('interface %s type tunnel' % iface
+                                     for iface in new_iface_list))
+            self.new_iface_list += new_iface_list
+            self._iface_list += new_iface_list
+        logging.info('Number of client tunnels: %s -> %s',
+                     self._client_count, client_count)
+        self._client_count = client_count
+
+    def clientIfaceList(self) -> list[str]:
+        """Names of all client interfaces, including those of the pool"""
+        return [*self._free_iface_list, *self._iface_to_prefix,
+                *self.new_iface_list]
+
+    def _createInterfaces(self, count):
+        for _ in range(min(count, len(self.new_iface_list))):
+            self._free_iface_list.insert(0, self._tuntap())
+
     def delInterfaces(self):
         iface_list = self._free_iface_list
         iface_list += self._iface_to_prefix
@@ -736,8 +946,10 @@ class TunnelManager(BaseTunnelManager):
     def _getFreeInterface(self, prefix):
         try:
             iface = self._free_iface_list.pop()
+            self.iface_pool_hits += 1
         except IndexError:
             iface = self._tuntap()
+            self.iface_pool_misses += 1
         self._iface_to_prefix[iface] = prefix
         return iface
 
@@ -745,36 +957,31 @@ class TunnelManager(BaseTunnelManager):
         self._free_iface_list.append(iface)
         del self._iface_to_prefix[iface]
 
-    def select(self, r, w, t):
-        super().select(r, w, t)
-        r[self._read_sock] = self.handleClientEvent
-
     def refresh(self):
         logging.debug('Checking tunnels...')
         if self._cleanDeads() or \
            self._next_tunnel_refresh < time.time() or \
            self._killing or \
            self._makeNewTunnels(False):
-            self._next_refresh = None
             # At startup, the following line calls babel_dump immediately.
             self.routing.request_dump()
         else:
-            self._next_refresh = time.time() + 5
+            self.selectTimeout(time.time() + 5, self.refresh)
 
     def babel_dump(self):
         t = time.time()
         if self._next_netconf_check < t:
             self._babel_dump_check_netconf()
-            self._next_netconf_check = self._next_refresh
+            self._next_netconf_check = t + NETCONF_CHECK
         logging.debug('babel_dump: self._killing=%r', self._killing)
         if self._killing:
             for prefix, tunnel_killer in list(self._killing.items()):
                 if tunnel_killer.timeout < t:
                     if tunnel_killer.state != 'unlocking':
                         logging.info(
-                            'Abort destruction of tunnel %s %s/%s (state: %s)',
+                            'Abort destruction of tunnel %s %s (state: %s)',
                             'to' if tunnel_killer.client else 'from',
-                            int(prefix, 2), len(prefix), tunnel_killer.state)
+                            prefix.subnet, tunnel_killer.state)
                     tunnel_killer.unlock()
                     del self._killing[prefix]
                 else:
@@ -784,6 +991,9 @@ class TunnelManager(BaseTunnelManager):
             self._removeSomeTunnels()
             self.resetTunnelRefresh()
             self.cache.log()
+            logging.debug('Interface pool: %u hits, %u misses, %u free',
+                self.iface_pool_hits, self.iface_pool_misses,
+                len(self._free_iface_list))
         self._makeNewTunnels(True)
         # XXX: Commented code is an attempt to clean up unused interfaces
         #      but babeld does not leave ipv6 membership for deleted taps,
@@ -792,7 +1002,13 @@ class TunnelManager(BaseTunnelManager):
         #      to see each other.
         #if remove and len(self._connecting) < len(self._free_iface_list):
         #    self._tuntap(self._free_iface_list.pop())
-        self._next_refresh = time.time() + 5
+        self.selectTimeout(time.time() + 5, self.refresh)
+
+    def babel_changed(self):
+        # Tunnel killers wait for routes to change:
+        # don't wait for the next periodic refresh.
+        if self._killing:
+            self.selectTimeout(time.time(), self.refresh)
 
     def _cleanDeads(self):
         disconnected = False
@@ -804,15 +1020,8 @@ class TunnelManager(BaseTunnelManager):
         return disconnected
 
     def _tunnelScore(self, prefix):
-        # First try to not kill a persistent tunnel (see --neighbour option).
-        # Then sort by the number of routed nodes.
-        n = 0
         try:
-            for x in self.routing.neighbours[prefix][1]:
-                # Ignore the default route, which is redundant with the
-                # border gateway node.
-                if x:
-                    n += 1
+            neighbour, routes = self.routing.neighbours[prefix]
         except KeyError:
             # XXX: The route for this neighbour is not direct. In this case,
             #      a KeyError was raised because babeld dump doesn't give us
@@ -822,8 +1031,8 @@ class TunnelManager(BaseTunnelManager):
             #      In order not to remain indefinitely in a state where we
             #      never delete any tunnel because we would always select an
             #      unkillable one, we should return an higher score.
-            pass
-        return (prefix in self._neighbour_set, n) if n else ()
+            return ()
+        return self._score.tunnel(prefix, neighbour, routes)
 
     def _removeSomeTunnels(self):
         # Get the candidates to killing
@@ -848,8 +1057,7 @@ class TunnelManager(BaseTunnelManager):
                 del self._killing[prefix]
 
     def _kill(self, prefix):
-        logging.info('Killing the connection with %u/%u...',
-                     int(prefix, 2), len(prefix))
+        logging.info('Killing the connection with %s...', prefix.subnet)
         self._abortTunnelKiller(prefix)
         connection = self._connection_dict.pop(prefix)
         self.freeInterface(connection.iface)
@@ -857,11 +1065,7 @@ class TunnelManager(BaseTunnelManager):
         if self._gateway_manager is not None:
             for ip in connection:
                 self._gateway_manager.remove(ip)
-        logging.trace('Connection with %u/%u killed',
-                      int(prefix, 2), len(prefix))
-
-    def _newTunnelScore(self, prefix):
-        return (prefix in self._neighbour_set) + random.random()
+        logging.trace('Connection with %s killed', prefix.subnet)
 
     def _makeTunnel(self, prefix, address):
         if prefix in self._served or prefix in self._connection_dict:
@@ -891,8 +1095,7 @@ class TunnelManager(BaseTunnelManager):
         self.cache.connecting(prefix, True)
         if not address_list:
             return False
-        logging.info('Establishing a connection with %u/%u',
-                     int(prefix, 2), len(prefix))
+        logging.info('Establishing a connection with %s', prefix.subnet)
         with utils.exit:
             iface = self._getFreeInterface(prefix)
             self._connection_dict[prefix] = c = Connection(
@@ -907,7 +1110,7 @@ class TunnelManager(BaseTunnelManager):
         count = self._client_count - len(self._connection_dict)
         logging.debug('_makeNewTunnels(route_dumped=%s,count=%s)',
                       route_dumped, count)
-        if not count:
+        if count <= 0:
             return
         # CAVEAT: Forget any peer that didn't reply to our previous address
         #         request, either because latency is too high or some packet
@@ -917,14 +1120,15 @@ class TunnelManager(BaseTunnelManager):
         distant_peers = self._distant_peers
         if route_dumped:
             neighbours = self.routing.neighbours
-            # Collect all nodes known by Babel
-            peers = {prefix
+            # Collect all nodes known by Babel, with their routes.
+            peers = {prefix: route
                 for neigh_routes in neighbours.values()
-                for prefix in neigh_routes[1]
+                for prefix, route in neigh_routes[1].items()
                 if prefix}
             # Keep only distant peers.
-            distant_peers[:] = peers.difference(neighbours)
-            distant_peers.sort(key=self._newTunnelScore)
+            distant_peers[:] = peers.keys() - neighbours.keys()
+            score = self._score.newTunnel
+            distant_peers.sort(key=lambda prefix: score(prefix, peers[prefix]))
             # Check whether we're connected to the network.
             registry = self.cache.registry_prefix
             if registry == self._prefix:
@@ -1004,16 +1208,41 @@ class TunnelManager(BaseTunnelManager):
                         break
 
     def killAll(self):
+        self._renewing.clear()
+        self.selectTimeout(None, self._renewNext)
         for prefix in list(self._connection_dict):
             self._kill(prefix)
 
+    def renewTunnels(self):
+        """Close client tunnels one at a time, so that they're reopened
+
+        Closing them all at once would disrupt routing.
+        """
+        self._renewing = deque(self._connection_dict.items())
+        self._renewNext()
+
+    def _renewNext(self):
+        renewing = self._renewing
+        while renewing:
+            prefix, connection = renewing.popleft()
+            if self._connection_dict.get(prefix) is connection:
+                self._kill(prefix)
+                break
+        if renewing:
+            self.selectTimeout(time.time() + 4 * self.cache.hello,
+                               self._renewNext)
+
     def handleClientEvent(self):
-        msg = self._read_sock.recv(65536)
-        logging.debug("handleClientEvent(%s)", msg)
-        common_name, time, serial, ip = eval(msg)
-        prefix = utils.binFromSubnet(common_name)
+        # See ovpn-client.
+        for msg in utils.iterRecv(self._read_sock):
+            logging.debug("handleClientEvent(%s)", msg)
+            common_name, time, serial, ip = msg.decode().split('\0')
+            self._routeUp(common_name, float(time), int(serial), ip)
+
+    def _routeUp(self, common_name, time, serial, ip):
+        prefix = utils.Prefix.fromSubnet(common_name)
         c = self._connection_dict.get(prefix)
-        if c and c.time < float(time):
+        if c and c.time < time:
             try:
                 c.connected(serial)
             except (KeyError, TypeError) as e:
@@ -29,7 +29,8 @@ class Forwarder:
         n = cls._lcg_n = (n * cls._lcg_a + cls._lcg_c) % 8192
         return 32768 + n
 
-    def __init__(self, description):
+    def __init__(self, scheduler, description):
+        self._scheduler = scheduler
         self._description = description
         self._u = miniupnpc.UPnP()
         self._u.discoverdelay = 200
@@ -44,9 +45,6 @@ class Forwarder:
                 raise UPnPException(str(e))
         return wraps(wrapped)(wrapper)
 
-    def select(self, r, w, t):
-        t.append((self.next_refresh, self.refresh))
-
     def checkExternalIp(self, ip=None):
         if not ip:
             ip = self.refresh()
@@ -61,6 +59,12 @@ class Forwarder:
         self._rules.append([local_port, proto, None])
 
     def refresh(self):
+        try:
+            return self._tryRefresh()
+        finally:
+            self._scheduler.schedule(self.next_refresh, self.refresh)
+
+    def _tryRefresh(self):
         if self._next_retry:
             if time.time() < self._next_retry:
                 return
@@ -1,7 +1,7 @@
-import argparse, errno, fcntl, hashlib, logging, os, select as _select
-import shlex, signal, socket, sqlite3, struct, subprocess
+import argparse, errno, fcntl, hashlib, heapq, logging, os
+import selectors, shlex, signal, socket, sqlite3, struct, subprocess
 import sys, textwrap, threading, time, traceback
-from collections.abc import Iterator, Mapping
+from collections.abc import Iterator
 
 HMAC_LEN = len(hashlib.sha1(b'').digest())
 
@@ -163,7 +163,44 @@ class Popen(subprocess.Popen):
         assert self.returncode is None
         os.kill(self.pid, sig)
 
+    _unwatch = None
+
+    def watch(self, reactor: "Reactor", callback):
+        """Call 'callback' from the reactor as soon as the process exits
+
+        A pidfd is used if possible, otherwise the process is polled.
+        """
+        self.unwatch()
+        fd = None
+        if self.returncode is None:
+            try:
+                fd = os.pidfd_open(self.pid)
+            except OSError: # Linux < 5.3
+                pass
+        def exited():
+            if self.poll() is None:
+                reactor.schedule(time.time() + 1, exited)
+            else:
+                self.unwatch()
+                callback()
+        if fd is None:
+            unwatch = lambda: reactor.cancel(exited)
+            reactor.schedule(time.time(), exited)
+        else:
+            def unwatch():
+                reactor.unregister(fd)
+                os.close(fd)
+            reactor.addReader(fd, exited)
+        self._unwatch = unwatch
+
+    def unwatch(self):
+        unwatch = self._unwatch
+        if unwatch:
+            del self._unwatch
+            unwatch()
+
     def stop(self):
+        self.unwatch()
         if self.pid and self.returncode is None:
             self.terminate()
             t = threading.Timer(5, self.kill)
@@ -173,26 +210,220 @@ class Popen(subprocess.Popen):
             self.poll()
 
 
+class Supervisor:
+    """Keep subprocesses running
+
+    Each process is started by calling a function that returns a Popen
+    object, and called again when the process exits, after a delay that
+    doubles for processes that keep failing. 'restart_count' is the number
+    of restarts of each process, by name.
+    """
+
+    min_delay = 1
+    max_delay = 60
+    # A process that ran at least this time is considered to have succeeded.
+    stable = 60
+
+    class _Supervised:
+
+        process = None
+
+        def __init__(self, name, start, restart, delay, always):
+            self.name = name
+            self.start = start
+            self.restart = restart
+            self.delay = delay
+            self.always = always
+
+    def __init__(self, reactor: "Reactor"):
+        self._reactor = reactor
+        self._dict = {}
+        self.restart_count = {}
+
+    def start(self, name: str, start, restarted=None, always=True):
+        """Start a process and keep it running
+
+        'restarted' is called without argument after each restart.
+        If 'always' is false, a process that exits with status 0 is not
+        restarted.
+        """
+        assert name not in self._dict, name
+        def restart():
+            self.restart_count[name] += 1
+            self._start(x)
+            if restarted:
+                restarted()
+        self._dict[name] = x = self._Supervised(
+            name, start, restart, self.min_delay, always)
+        self.restart_count[name] = 0
+        self._start(x)
+
+    def _start(self, x: _Supervised):
+        x.process = process = x.start()
+        x.time = time.time()
+        process.watch(self._reactor, lambda: self._exited(x))
+
+    def _exited(self, x: _Supervised):
+        if not (x.always or x.process.returncode):
+            logging.info("%s exited successfully", x.name)
+            return
+        t = time.time()
+        if x.time + self.stable < t:
+            x.delay = self.min_delay
+        delay = x.delay
+        x.delay = min(2 * delay, self.max_delay)
+        logging.warning(
+            "%s exited with status %s, restarting in %s seconds (restart #%s)",
+            x.name, x.process.returncode, delay,
+            self.restart_count[x.name] + 1)
+        self._reactor.schedule(t + delay, x.restart)
+
+    def restart(self, name: str):
+        """Restart a process now, e.g. to apply a new configuration"""
+        x = self._dict[name]
+        self._stop(x)
+        self._start(x)
+
+    def _stop(self, x: _Supervised):
+        self._reactor.cancel(x.restart)
+        x.process.stop()
+
+    def stop(self, name: str):
+        """Stop a process, which is not watched anymore"""
+        self._stop(self._dict.pop(name))
+
+
 def setCloexec(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFD)
     fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
-def select(R: Mapping, W: Mapping, T):
-    try:
-        r, w, _ = _select.select(R, W, (),
-            max(0, min(T)[0] - time.time()) if T else None)
-    except _select.error as e:
-        if e.args[0] != errno.EINTR:
-            raise
-        return
-    for r in r:
-        R[r]()
-    for w in w:
-        W[w]()
-    t = time.time()
-    for next_refresh, refresh in T:
-        if next_refresh <= t:
-            refresh()
+class Scheduler:
+    """Timers kept in a heap
+
+    A callback is scheduled at most once: scheduling it again moves it.
+    Moved or cancelled entries are left in the heap and skipped when they
+    reach the top. Safe to use from other threads, but a thread that is
+    blocked in select() is not woken up.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entry = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def schedule(self, next: float | None, callback, force=True):
+        """Call 'callback' at time 'next', or never if it is None
+
+        If the callback is already scheduled, it is moved unless 'force' is
+        false and 'next' is later.
+        """
+        with self._lock:
+            entry = self._entry.get(callback)
+            if entry:
+                if next is not None and not (force or next < entry[0]):
+                    return
+                entry[2] = None
+                del self._entry[callback]
+            if next is not None:
+                self._count += 1
+                entry = self._entry[callback] = [next, self._count, callback]
+                heap = self._heap
+                heapq.heappush(heap, entry)
+                if len(heap) > 2 * len(self._entry) + 64:
+                    heap[:] = self._entry.values()
+                    heapq.heapify(heap)
+
+    def cancel(self, callback):
+        self.schedule(None, callback)
+
+    def __contains__(self, callback):
+        return callback in self._entry
+
+    def timeout(self) -> float | None:
+        """Seconds until the first callback is due, None if there is none"""
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][2] is None:
+                heapq.heappop(heap)
+            if heap:
+                next = heap[0][0]
+                if next != float('inf'):
+                    return max(0, next - time.time())
+
+    def run(self):
+        """Call (once) all callbacks that are due"""
+        t = time.time()
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= t:
+                callback = heapq.heappop(heap)[2]
+                if callback is not None:
+                    del self._entry[callback]
+                    due.append(callback)
+        for callback in due:
+            callback()
+
+class Reactor(Scheduler):
+    """Main loop: timers, and file descriptors that are registered once
+
+    Unlike select.select, there is no limit on file descriptor numbers and
+    the interest in a file descriptor is only updated when it changes.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._selector = selectors.DefaultSelector()
+
+    def close(self):
+        self._selector.close()
+
+    def _update(self, fileobj, i: int, callback):
+        selector = self._selector
+        try:
+            callbacks = selector.get_key(fileobj).data
+        except KeyError:
+            if callback:
+                callbacks = [None, None]
+                callbacks[i] = callback
+                selector.register(fileobj, 1 << i, callbacks)
+            return
+        callbacks[i] = callback
+        events = (callbacks[0] and selectors.EVENT_READ or 0) \
+               | (callbacks[1] and selectors.EVENT_WRITE or 0)
+        if events:
+            selector.modify(fileobj, events, callbacks)
+        else:
+            selector.unregister(fileobj)
+
+    def addReader(self, fileobj, callback):
+        self._update(fileobj, 0, callback)
+
+    def removeReader(self, fileobj):
+        self._update(fileobj, 0, None)
+
+    def addWriter(self, fileobj, callback):
+        self._update(fileobj, 1, callback)
+
+    def removeWriter(self, fileobj):
+        self._update(fileobj, 1, None)
+
+    def unregister(self, fileobj):
+        try:
+            self._selector.unregister(fileobj)
+        except KeyError:
+            pass
+
+    def select(self):
+        """Wait for events and process them, as well as due timers"""
+        for key, events in self._selector.select(self.timeout()):
+            callbacks = key.data
+            if events & selectors.EVENT_READ and callbacks[0]:
+                callbacks[0]()
+            if events & selectors.EVENT_WRITE and callbacks[1]:
+                callbacks[1]()
+        self.run()
 
 def makedirs(*args):
     try:
@@ -201,22 +432,126 @@ def makedirs(*args):
         if e.errno != errno.EEXIST:
             raise
 
-def binFromIp(ip: str) -> str:
-    return binFromRawIp(socket.inet_pton(socket.AF_INET6, ip))
-
-def binFromRawIp(ip: bytes) -> str:
-    ip1, ip2 = struct.unpack('>QQ', ip)
-    return bin(ip1)[2:].rjust(64, '0') + bin(ip2)[2:].rjust(64, '0')
-
+class Prefix:
+    """Bit string (e.g. an IPv6 prefix) as an integer and a length
+
+    Instances must not be modified. Ordering is the same as for the text
+    representation ('0101...'), which is used on the wire and in databases.
+    """
+
+    __slots__ = 'bits', 'len'
+
+    def __init__(self, bits=0, length=0):
+        self.bits = bits
+        self.len = length
+
+    @classmethod
+    def fromBin(cls, prefix: str):
+        if prefix.strip('01'):
+            raise ValueError("invalid prefix: %r" % prefix)
+        return cls(int(prefix, 2) if prefix else 0, len(prefix))
+
+    @classmethod
+    def fromSubnet(cls, subnet: str):
+        p, l = subnet.split('/')
+        p = int(p)
+        l = int(l)
+        if p >> l:
+            raise ValueError("invalid subnet: %r" % subnet)
+        return cls(p, l)
+
+    @classmethod
+    def fromRawIp(cls, ip: bytes):
+        return cls(int.from_bytes(ip, 'big'), 128)
+
+    @classmethod
+    def fromIp(cls, ip: str):
+        return cls.fromRawIp(socket.inet_pton(socket.AF_INET6, ip))
+
+    def __str__(self):
+        return bin(self.bits)[2:].rjust(self.len, '0') if self.len else ''
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, str(self))
+
+    def __reduce__(self):
+        return self.__class__, (self.bits, self.len)
+
+    @property
+    def subnet(self) -> str:
+        return '%u/%u' % (self.bits, self.len)
+
+    def ip(self, suffix=0) -> str:
+        n = 128 - self.len
+        if n < 0:
+            sys.exit("Prefix exceeds 128 bits")
+        return socket.inet_ntop(socket.AF_INET6,
+            (self.bits << n | suffix).to_bytes(16, 'big'))
+
+    def __len__(self):
+        return self.len
+
+    def __hash__(self):
+        return hash(self.bits << 8 | self.len)
+
+    def __eq__(self, other):
+        if type(other) is Prefix:
+            return self.bits == other.bits and self.len == other.len
+        return NotImplemented
+
+    def __ne__(self, other):
+        if type(other) is Prefix:
+            return self.bits != other.bits or self.len != other.len
+        return NotImplemented
+
+    def _key(self):
+        return self.bits << 128 - self.len, self.len
+
+    def __lt__(self, other):
+        if type(other) is Prefix:
+            return self._key() < other._key()
+        return NotImplemented
+    def __le__(self, other):
+        if type(other) is Prefix:
+            return self._key() <= other._key()
+        return NotImplemented
+    def __gt__(self, other):
+        if type(other) is Prefix:
+            return self._key() > other._key()
+        return NotImplemented
+    def __ge__(self, other):
+        if type(other) is Prefix:
+            return self._key() >= other._key()
+        return NotImplemented
+
+    def startswith(self, prefix) -> bool:
+        n = self.len - prefix.len
+        return n >= 0 and self.bits >> n == prefix.bits
+
+    def __add__(self, other):
+        return Prefix(self.bits << other.len | other.bits,
+                      self.len + other.len)
+
+    def __getitem__(self, key: slice):
+        i, j, step = key.indices(self.len)
+        assert step == 1, key
+        if j <= i:
+            return Prefix()
+        n = j - i
+        return Prefix(self.bits >> self.len - j & (1 << n) - 1, n)
+
+# Prefixes are stored as text in databases.
+sqlite3.register_adapter(Prefix, str)
+
+
+def iterRecv(sock: socket.socket, bufsize=65536) -> Iterator[bytes]:
+    """Receive all queued datagrams, without blocking"""
+    while True:
+        try:
+            yield sock.recv(bufsize, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
 
-def ipFromBin(ip: str, suffix='') -> str:
-    suffix_len = 128 - len(ip)
-    if suffix_len > 0:
-        ip += suffix.rjust(suffix_len, '0')
-    elif suffix_len:
-        sys.exit("Prefix exceeds 128 bits")
-    return socket.inet_ntop(socket.AF_INET6,
-        struct.pack('>QQ', int(ip[:64], 2), int(ip[64:], 2)))
 
 def dump_address(address: str) -> str:
     return ';'.join(map(','.join, address))
@@ -232,10 +567,6 @@ def parse_address(address_list: str) -> Iterator[tuple[str, str, str, str]]:
             logging.warning("Failed to parse node address %r (%s)",
                             address, e)
 
-def binFromSubnet(subnet: str) -> str:
-    p, l = subnet.split('/')
-    return bin(int(p))[2:].rjust(int(l), '0')
-
 def _newHmacSecret():
     from random import getrandbits as g
     pack = struct.Struct(">QQI").pack
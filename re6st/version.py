@@ -30,7 +30,7 @@ if dirty:
 # they are intended to the network admin.
 # Only 'protocol' is important and it must be increased whenever they would be
 # a wish to force an update of nodes.
-protocol = 10
+protocol = 11
 min_protocol = 1
 
 if __name__ == "__main__":
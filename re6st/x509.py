@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
-import calendar, hashlib, hmac, logging, os, struct, subprocess, time
+import calendar, hashlib, hmac, logging, os, struct, time
+from collections import OrderedDict
 from typing import Callable
 
 from OpenSSL import crypto
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.hazmat.primitives.serialization import \
+    Encoding, load_pem_private_key
 from cryptography.x509 import \
     load_der_x509_certificate, load_pem_x509_certificate
 
@@ -16,12 +18,17 @@ from .version import protocol
 PADDING = padding.PKCS1v15()
 PADDING_HASH = PADDING, hashes.SHA512()
 
+# Maximum number of certificates remembered by Cert.loadVerify.
+VERIFY_CACHE_SIZE = 1024
+
 def newHmacSecret() -> bytes:
     return utils.newHmacSecret(int(time.time() * 1000000))
 
-def networkFromCa(ca: crypto.X509) -> str:
+def networkFromCa(ca: crypto.X509) -> utils.Prefix:
     # TODO: will be ca.serial_number after migration to cryptography
-    return bin(ca.get_serial_number())[3:]
+    serial = ca.get_serial_number()
+    n = serial.bit_length() - 1
+    return utils.Prefix(serial ^ 1 << n, n)
 
 def subnetFromCert(cert: crypto.X509) -> str:
     return cert.get_subject().CN
@@ -90,6 +97,7 @@ class Cert:
         self.ca_path = ca
         self.cert_path = cert
         self.key_path = key
+        self._verified = OrderedDict()
         # TODO: finish migration from old OpenSSL module to cryptography
         with open(ca, "rb") as f:
             ca_pem = f.read()
@@ -104,11 +112,11 @@ class Cert:
                 self.cert = self.loadVerify(f.read())
 
     @property
-    def prefix(self) -> str:
-        return utils.binFromSubnet(subnetFromCert(self.cert))
+    def prefix(self) -> utils.Prefix:
+        return utils.Prefix.fromSubnet(subnetFromCert(self.cert))
 
     @property
-    def network(self) -> str:
+    def network(self) -> utils.Prefix:
         return networkFromCa(self.ca)
 
     @property
@@ -125,39 +133,68 @@ class Cert:
         self.cert, next_renew = maybe_renew(self.cert_path, self.cert,
               "Certificate", lambda: registry.renewCertificate(self.prefix),
               self.cert.get_serial_number() in crl)
-        self.ca, ca_renew = maybe_renew(self.ca_path, self.ca,
+        ca, ca_renew = maybe_renew(self.ca_path, self.ca,
               "CA Certificate", registry.getCa)
+        if ca is not self.ca:
+            self.ca = ca
+            self.ca_crypto = ca.to_cryptography()
+            self.clearVerifyCache()
         return min(next_renew, ca_renew)
 
-    def loadVerify(self, cert, strict=False, type=crypto.FILETYPE_PEM):
+    def loadVerify(self, cert: bytes, strict=False,
+                   type=crypto.FILETYPE_PEM) -> crypto.X509:
+        """Load a certificate and check it is signed by our CA
+
+        Successfully verified certificates are remembered (by fingerprint of
+        their DER serialization) until they expire, so that certificates
+        received repeatedly from peers are verified only once. Error codes
+        are the same as 'openssl verify'.
+        """
         try:
-            r = crypto.load_certificate(type, cert)
-        except crypto.Error as e:
+            if type == crypto.FILETYPE_PEM:
+                cert = load_pem_x509_certificate(cert).public_bytes(
+                    Encoding.DER)
+            key = hashlib.sha1(cert).digest(), strict
+            verified = self._verified
+            try:
+                r, expires = verified[key]
+            except KeyError:
+                pass
+            else:
+                if time.time() < expires:
+                    verified.move_to_end(key)
+                    return r
+                del verified[key]
+            c = load_der_x509_certificate(cert)
+        except ValueError as e:
             raise VerifyError(None, None, 'unable to load certificate') from e
-        if type != crypto.FILETYPE_PEM:
-            cert = crypto.dump_certificate(crypto.FILETYPE_PEM, r)
-        args = ['openssl', 'verify', '-CAfile', self.ca_path]
-        if not strict:
-            args += '-attime', str(min(int(time.time()),
-                max(notBefore(self.ca), notBefore(r))))
-        p = utils.Popen(args, stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-        out, err = p.communicate(cert)
-        if 1: # BBB: Old OpenSSL could return 0 in case of errors.
-          if err is None: # utils.Popen failed with ENOMEM
-            raise VerifyError(None, None,
-                "error running openssl, assuming cert is invalid")
-          # BBB: With old versions of openssl, detailed
-          #      error is printed to standard output.
-          for stream in err, out:
-            for x in stream.decode(errors='replace').splitlines():
-                if x.startswith('error '):
-                    x, msg = x.split(':', 1)
-                    _, code, _, depth, _ = x.split(None, 4)
-                    raise VerifyError(int(code), int(depth), msg.strip())
+        try:
+            c.verify_directly_issued_by(self.ca_crypto)
+        except ValueError as e:
+            raise VerifyError(20, 0,
+                'unable to get local issuer certificate') from e
+        except (InvalidSignature, TypeError) as e:
+            raise VerifyError(7, 0, 'certificate signature failure') from e
+        r = crypto.X509.from_cryptography(c)
+        now = time.time()
+        t = now if strict else min(now, max(notBefore(self.ca), notBefore(r)))
+        expires = float('inf')
+        for depth, x in enumerate((r, self.ca)):
+            if t < notBefore(x):
+                raise VerifyError(9, depth, 'certificate is not yet valid')
+            x = notAfter(x)
+            if x < t:
+                raise VerifyError(10, depth, 'certificate has expired')
+            expires = min(expires, x)
+        verified[key] = r, expires
+        if len(verified) > VERIFY_CACHE_SIZE:
+            verified.popitem(False)
         return r
 
+    def clearVerifyCache(self):
+        """Forget verified certificates, e.g. when the CRL or CA changes"""
+        self._verified.clear()
+
     def verify(self, *args):
         self.ca_crypto.public_key().verify(*args, *PADDING_HASH)
 
@@ -176,6 +213,55 @@ class Cert:
 
 
 PACKED_PROTOCOL = utils.packInteger(protocol)
+# Minimum protocol of nodes that can reply to cookie challenges.
+COOKIE_PROTOCOL = 11
+
+
+def splitCookie(msg: bytes) -> tuple[bytes, bytes]:
+    """Split a DER certificate from the cookie that may follow it"""
+    try:
+        if msg[0] == 0x30: # SEQUENCE
+            n = msg[1]
+            i = 2
+            if n & 0x80:
+                i += n & 0x7f
+                n = int.from_bytes(msg[2:i], 'big')
+            n += i
+            return msg[:n], msg[n:]
+    except IndexError:
+        pass
+    return msg, b''
+
+
+class Cookie:
+    """
+    Stateless challenge of the source address of hello0 packets
+
+    A cookie is a HMAC of the address with a secret that never leaves this
+    node, and of the current time bucket. The previous bucket is also
+    accepted so that a cookie is valid between 1 and 2 periods.
+    """
+    period = 30
+    size = 16
+
+    def __init__(self):
+        self._secret = os.urandom(16)
+
+    def __call__(self, address: tuple[str, int], bucket=None) -> bytes:
+        if bucket is None:
+            bucket = int(time.time() // self.period)
+        return hmac.HMAC(self._secret, b'%s %u %u' % (
+            address[0].encode(), address[1], bucket),
+            hashlib.sha1).digest()[:self.size]
+
+    def check(self, address: tuple[str, int], cookie: bytes) -> bool:
+        bucket = int(time.time() // self.period)
+        return len(cookie) == self.size and any(
+            hmac.compare_digest(cookie, self(address, bucket - i))
+            for i in (0, 1))
+
+    def challenge(self, address: tuple[str, int]) -> bytes:
+        return b'\0\0\0\1' + PACKED_PROTOCOL + self(address)
 
 
 class Peer:
@@ -197,22 +283,35 @@ class Peer:
     - The limited size of packets, but they are big enough for a network
       using 4096-bits RSA keys.
     - hello0 packets (0 & 1) are subject to DoS, because verifying a
-      certificate uses much CPU. A solution would be to use TCP until the
-      secret is exchanged and continue with UDP.
+      certificate uses much CPU. This is mitigated by cookies, see below.
 
     The fingerprint is only used to quickly know if peer's certificate has
     changed. It must be short enough to not exceed packet size when using
     certificates with 4096-bit keys. A weak algorithm is ok as long as there
     is no accidental collision. So SHA-1 looks fine.
+
+    Cookies (see Cookie class):
+
+    UDP:    A <───────────────────────────────────────────── B
+
+    cookie:    1, C = hmac(B secret, address of A, time)
+
+    If the network requires at least COOKIE_PROTOCOL, B does not process
+    a hello0 from A unless it ends with a valid C, which A gets by replying
+    to the cookie challenge with its hello0 again, followed by C. Older
+    nodes can't be challenged, because they would not reply and they would
+    not parse a certificate followed by a cookie. Replies to our own hello0
+    are accepted once without cookie.
     """
     _hello = _last = 0
+    _challenged = _waiting = False
     _key = newHmacSecret()
     serial = None
     stop_date = float('inf')
     version = b''
     cert: crypto.X509
 
-    def __init__(self, prefix: str):
+    def __init__(self, prefix: utils.Prefix):
         self.prefix = prefix
 
     @property
@@ -224,24 +323,44 @@ class Peer:
     __eq__ = __ge__ = __le__ = __ne__
 
     def __gt__(self, other):
-        return self.prefix > (other if type(other) is str else other.prefix)
+        return self.prefix > (other if type(other) is utils.Prefix
+                              else other.prefix)
     def __lt__(self, other):
-        return self.prefix < (other if type(other) is str else other.prefix)
+        return self.prefix < (other if type(other) is utils.Prefix
+                              else other.prefix)
+
+    def _hello0(self, cert: crypto.X509) -> bytes:
+        try:
+            # Always assume peer is not old, in case it has just upgraded,
+            # else we would be stuck with the old protocol.
+            msg = (b'\0\0\0\1'
+                + PACKED_PROTOCOL
+                + fingerprint(self.cert).digest())
+        except AttributeError:
+            msg = b'\0\0\0\0'
+        return msg + crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
 
     def hello0(self, cert: crypto.X509) -> bytes:
         if self._hello < time.time():
-            try:
-                # Always assume peer is not old, in case it has just upgraded,
-                # else we would be stuck with the old protocol.
-                msg = (b'\0\0\0\1'
-                    + PACKED_PROTOCOL
-                    + fingerprint(self.cert).digest())
-            except AttributeError:
-                msg = b'\0\0\0\0'
-            return msg + crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+            return self._hello0(cert)
 
     def hello0Sent(self):
         self._hello = time.time() + 60
+        self._challenged = self._waiting = True
+
+    def cookieReply(self, cert: crypto.X509, cookie: bytes) -> bytes:
+        # Only reply once to a challenge for a hello0 we've just sent,
+        # so that a spoofed challenge can't be used for amplification.
+        if self._challenged and time.time() < self._hello:
+            self._challenged = False
+            return self._hello0(cert) + cookie
+
+    def replied(self) -> bool:
+        """Whether we are waiting for the hello0 of this peer"""
+        if self._waiting and time.time() < self._hello:
+            self._waiting = False
+            return True
+        return False
 
     def hello(self, cert: Cert, protocol: int) -> bytes:
         key = self._key = newHmacSecret()